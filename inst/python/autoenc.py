@@ -2,15 +2,19 @@
 Unified dense autoencoder used by daltoolboxdp via reticulate.
 """
 
-from typing import List, Optional, Tuple
+import copy
+import functools
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, TensorDataset
 
 from autoenc_common import AutoencTrainingConfig, StopController, build_dense_stack, split_indices, validate_strategy
+from distributed_common import DataParallelShard, data_parallel_fit, distributed_options, epoch_context, in_data_parallel_rank, shard_indices
+from parallel_common import thread_limits, uses_model_threads, validate_num_threads
+from stream_common import ChunkStream, split_rows, stream_options, stream_or_array
+from torch_common import ExportGraph, FitTelemetry, ForwardCompiler, LossAccumulator, TrainingCheckpoint, as_float32_array, batch_iterator, batched_inference, checkpoint_options, export_model, input_tensor, load_model, partial_fit_args, profiling, save_model, serializable, validate_batch_engine, validate_loss_weighting
 
 
 class Autoencoder(nn.Module):
@@ -47,6 +51,7 @@ class Autoencoder(nn.Module):
         return self.decoder(self.encoder(x))
 
 
+@serializable
 class DenseAutoencoderModel:
     def __init__(
         self,
@@ -59,8 +64,13 @@ class DenseAutoencoderModel:
         negative_slope: float = 0.2,
         validation_strategy: str = "static",
         stopping_rule: str = "none",
+        compile: bool = False,
+        precision: str = "fp32",
+        num_threads: Optional[int] = None,
     ):
         self.validation_strategy, self.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
+        self.compiler = ForwardCompiler(compile, precision)
+        self.num_threads = validate_num_threads(num_threads)
         self.model = Autoencoder(
             int(input_size),
             int(encoding_size),
@@ -73,93 +83,269 @@ class DenseAutoencoderModel:
         self.train_loss: List[float] = []
         self.val_loss: List[float] = []
         self.epochs_done: int = 0
+        self.telemetry = FitTelemetry()
 
     @staticmethod
     def _array(data) -> np.ndarray:
-        if isinstance(data, pd.DataFrame):
-            return data.to_numpy().astype(np.float32)
-        return np.asarray(data, dtype=np.float32)
+        return as_float32_array(data)
 
-    def _loader(self, array: np.ndarray, batch_size: int, shuffle: bool) -> DataLoader:
-        tensor = torch.from_numpy(array.astype(np.float32))
-        return DataLoader(TensorDataset(tensor, tensor), batch_size=int(batch_size), shuffle=shuffle, drop_last=False)
+    def _loader(self, array: np.ndarray, batch_size: int, shuffle: bool, batch_engine: str = "tensor", indices=None):
+        if isinstance(array, ChunkStream):
+            return array.batches(batch_size, shuffle, indices)
+        tensor = input_tensor(np.ascontiguousarray(array, dtype=np.float32))
+        return batch_iterator((tensor,), batch_size, shuffle, batch_engine=batch_engine, indices=indices)
 
-    def _run_epoch(self, loader: DataLoader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module) -> float:
-        losses: List[float] = []
+    def _run_epoch(self, loader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module, loss_weighting: str = "batch", shard: Optional[DataParallelShard] = None) -> float:
+        losses = LossAccumulator(loss_weighting)
         if optimizer is None:
             self.model.eval()
             with torch.no_grad():
-                for xb, yb in loader:
-                    losses.append(float(criterion(self.model(xb.float()), yb.float()).item()))
+                for (xb,) in loader:
+                    losses.add(criterion(self.compiler(self.model)(xb.float()), xb.float()), xb.size(0))
         else:
-            self.model.train()
-            for xb, yb in loader:
-                optimizer.zero_grad()
-                loss = criterion(self.model(xb.float()), yb.float())
-                loss.backward()
-                optimizer.step()
-                losses.append(float(loss.item()))
-        return float(np.mean(losses)) if losses else 0.0
+            model = self.model if shard is None else shard.module
+            model.train()
+            with epoch_context(shard):
+                for (xb,) in loader:
+                    optimizer.zero_grad()
+                    loss = criterion(self.compiler(model)(xb.float()), xb.float())
+                    loss.backward()
+                    optimizer.step()
+                    losses.add(loss, xb.size(0))
+        if shard is not None:
+            shard.reduce(losses)
+        return losses.value()
 
     def fit(self, data, config: AutoencTrainingConfig):
 
-        array = self._array(data)
+        array = stream_or_array(data, config.stream, self._array)
+        if config.distributed is not None and not in_data_parallel_rank():
+            return data_parallel_fit(self, array, config, "model", ("train_loss", "val_loss", "epochs_done", "telemetry"))
+        shard = None if config.distributed is None else DataParallelShard(self.model)
         criterion = nn.MSELoss()
         optimizer = torch.optim.Adam(self.model.parameters(), lr=float(config.learning_rate))
-        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value)
+        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value, lazy_best=config.lazy_best)
 
-        self.train_loss = []
-        self.val_loss = []
-        self.epochs_done = 0
+        if not config.warm_start:
+            self.train_loss = []
+            self.val_loss = []
+            self.epochs_done = 0
+        self.telemetry = FitTelemetry(compiler=self.compiler)
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, ("train_loss", "val_loss", "epochs_done"), {"model": self.model}, warm_start=config.warm_start, keep_state=config.keep_training_state)
+        checkpoint.begin()
 
         if self.validation_strategy == "static" and self.stopping_rule != "none":
-            train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-            train_loader = self._loader(array[train_idx], config.batch_size, True)
-            val_loader = self._loader(array[val_idx], config.batch_size, False)
+            train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=shard_indices(shard, train_idx, len(array)))
+            val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=shard_indices(shard, val_idx, len(array)))
         elif self.validation_strategy == "static":
-            train_loader = self._loader(array, config.batch_size, True)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=shard_indices(shard, None, len(array)))
             val_loader = None
         else:
             train_loader = None
             val_loader = None
 
-        for epoch in range(int(config.num_epochs)):
+        for epoch in checkpoint.epochs(int(config.num_epochs), {"optimizer": optimizer}, stopper):
+            self.telemetry.start_epoch()
             self.epochs_done += 1
             if self.validation_strategy == "dynamic":
-                train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-                train_loader = self._loader(array[train_idx], config.batch_size, True)
-                val_loader = self._loader(array[val_idx], config.batch_size, False)
+                train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+                train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=shard_indices(shard, train_idx, len(array)))
+                val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=shard_indices(shard, val_idx, len(array)))
 
-            self.train_loss.append(self._run_epoch(train_loader, optimizer, criterion))
+            self.train_loss.append(self._run_epoch(self.telemetry.batches(train_loader), optimizer, criterion, config.loss_weighting, shard))
             if val_loader is not None:
-                val_loss = self._run_epoch(val_loader, None, criterion)
+                with self.telemetry.phase("validation"):
+                    val_loss = self._run_epoch(val_loader, None, criterion, config.loss_weighting, shard)
                 self.val_loss.append(val_loss)
-                if stopper.step(self.model, val_loss):
+                with self.telemetry.phase("snapshot"):
+                    stop = stopper.step(self.model, val_loss)
+                if shard is not None:
+                    stop = shard.agree(stop)
+                if stop:
                     break
 
+        self.telemetry.stop()
+        checkpoint.close()
         if stopper.best_state is not None:
             self.model.load_state_dict(stopper.best_state)
         return self
 
     def encode(self, data, batch_size: int = 32):
-        array = self._array(data)
-        loader = self._loader(array, batch_size, False)
-        encoded = []
         self.model.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                encoded.append(self.model.encoder(xb.float()).detach().numpy())
-        return np.concatenate(encoded, axis=0)
+        return batched_inference(self.compiler(self.model.encoder), self._array(data), batch_size)
 
     def encode_decode(self, data, batch_size: int = 32):
-        array = self._array(data)
-        loader = self._loader(array, batch_size, False)
-        decoded = []
         self.model.eval()
+        return batched_inference(self.compiler(self.model), self._array(data), batch_size)
+
+    def _export_graphs(self):
+        args = self.init_args
+        return {
+            "encoder": ExportGraph(self.model.encoder, (args["input_size"],)),
+            "decoder": ExportGraph(self.model.decoder, (args["encoding_size"],)),
+        }
+
+
+# Activations with f(0) == 0: zero-padded hidden units then stay exactly zero
+# (no signal forward, zero gradient backward), so models of different widths
+# can share one padded stack without changing their results.
+_ZERO_PRESERVING_ACTIVATIONS = {"relu", "leaky_relu", "elu", "gelu", "selu", "tanh", "identity", "none"}
+
+
+class _StackedSlice:
+    """``state_dict`` view of one model inside a stacked parameter set, trimmed to its own shapes."""
+
+    def __init__(self, params: Dict[str, torch.Tensor], row: int, shapes: Dict[str, torch.Size]):
+        self.params = params
+        self.row = row
+        self.shapes = shapes
+
+    def state_dict(self):
+        return {name: self.params[name][self.row][tuple(slice(0, d) for d in shape)] for name, shape in self.shapes.items()}
+
+
+class BatchedAutoencoderTrainer:
+    """Train several ``DenseAutoencoderModel`` instances at once over shared minibatches.
+
+    Models with the same input size, depth and activations form one group.
+    Their parameters are zero-padded to the widest layer of the group, stacked
+    with a leading model axis and trained through ``torch.func.vmap`` over
+    ``functional_call``, so every minibatch runs one batched forward/backward
+    for the whole group. Adam is elementwise, so one optimizer over the
+    stacked tensors updates each model as its own optimizer would. Every model
+    keeps its own ``StopController`` and best weights; a model that stops is
+    written back and dropped from the stack (with its optimizer state) so the
+    remaining ones no longer pay for it. Padding requires hidden activations
+    with ``f(0) == 0``; groups using other activations only stack models of
+    identical shape.
+    """
+
+    def __init__(self, models: Sequence[DenseAutoencoderModel]):
+        self.models = list(models)
+
+    @staticmethod
+    def _group_key(model: DenseAutoencoderModel):
+        args = model.init_args
+        state = model.model.state_dict()
+        key = (args["input_size"], tuple(state), str(args["activation"]).lower(), str(args["output_activation"]).lower(), float(args["negative_slope"]))
+        if key[2] not in _ZERO_PRESERVING_ACTIVATIONS:
+            key += (tuple(tuple(t.shape) for t in state.values()),)
+        return key
+
+    def groups(self) -> List[List[int]]:
+        groups: Dict[Any, List[int]] = {}
+        for i, model in enumerate(self.models):
+            groups.setdefault(self._group_key(model), []).append(i)
+        return list(groups.values())
+
+    @staticmethod
+    def _loss(base: nn.Module, params: Dict[str, torch.Tensor], xb: torch.Tensor) -> torch.Tensor:
+        return nn.functional.mse_loss(torch.func.functional_call(base, params, (xb,)), xb)
+
+    def _run_epoch(self, batched_loss, params, loader, optimizer: Optional[torch.optim.Optimizer], loss_weighting: str) -> np.ndarray:
+        losses = LossAccumulator(loss_weighting)
+        if optimizer is None:
+            with torch.no_grad():
+                for (xb,) in loader:
+                    losses.add(batched_loss(params, xb.float()), xb.size(0))
+        else:
+            for (xb,) in loader:
+                optimizer.zero_grad()
+                loss = batched_loss(params, xb.float())
+                loss.sum().backward()
+                optimizer.step()
+                losses.add(loss, xb.size(0))
+        return losses.values()
+
+    @staticmethod
+    def _compact(params, optimizer, keep: List[int], learning_rate: float):
+        index = torch.tensor(keep, dtype=torch.long)
+        kept = {name: p.detach().index_select(0, index).requires_grad_() for name, p in params.items()}
+        compacted = torch.optim.Adam(kept.values(), lr=learning_rate)
+        for old, new in zip(params.values(), kept.values()):
+            state = optimizer.state.get(old)
+            if state:
+                compacted.state[new] = {k: (v.index_select(0, index) if torch.is_tensor(v) and v.dim() > 0 else copy.deepcopy(v)) for k, v in state.items()}
+        return kept, compacted
+
+    def _fit_group(self, members: List[int], tensor: torch.Tensor, array: np.ndarray, config: AutoencTrainingConfig):
+        models = [self.models[i] for i in members]
+        states = [model.model.state_dict() for model in models]
+        shapes = [{name: t.shape for name, t in state.items()} for state in states]
+        padded = {name: torch.Size(max(dims) for dims in zip(*(s[name] for s in shapes))) for name in shapes[0]}
         with torch.no_grad():
-            for xb, _ in loader:
-                decoded.append(self.model(xb.float()).detach().numpy())
-        return np.concatenate(decoded, axis=0)
+            params = {}
+            for name, shape in padded.items():
+                stacked = torch.zeros((len(models),) + tuple(shape), dtype=states[0][name].dtype)
+                for row, state in enumerate(states):
+                    stacked[row][tuple(slice(0, d) for d in state[name].shape)] = state[name]
+                params[name] = stacked.requires_grad_()
+        base = copy.deepcopy(models[0].model).to("meta")
+        batched_loss = torch.func.vmap(functools.partial(self._loss, base), in_dims=(0, None))
+        learning_rate = float(config.learning_rate)
+        optimizer = torch.optim.Adam(params.values(), lr=learning_rate)
+        stoppers = [StopController(model.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value, lazy_best=config.lazy_best) for model in models]
+        for model in models:
+            model.train_loss = []
+            model.val_loss = []
+            model.epochs_done = 0
+            model.telemetry = FitTelemetry()
+
+        def write_back(row: int, k: int):
+            with torch.no_grad():
+                models[k].model.load_state_dict(_StackedSlice(params, row, shapes[k]).state_dict())
+
+        strategy, rule = models[0].validation_strategy, models[0].stopping_rule
+        loader = lambda shuffle, indices=None: batch_iterator((tensor,), config.batch_size, shuffle, config.batch_engine, indices=indices)
+        if strategy == "static" and rule != "none":
+            train_idx, val_idx = split_indices(len(array), config.val_ratio)
+            train_loader, val_loader = loader(True, train_idx), loader(False, val_idx)
+        elif strategy == "static":
+            train_loader, val_loader = loader(True), None
+        else:
+            train_loader, val_loader = None, None
+
+        active = list(range(len(models)))
+        for _ in range(int(config.num_epochs)):
+            if strategy == "dynamic":
+                train_idx, val_idx = split_indices(len(array), config.val_ratio)
+                train_loader, val_loader = loader(True, train_idx), loader(False, val_idx)
+            train_loss = self._run_epoch(batched_loss, params, train_loader, optimizer, config.loss_weighting)
+            val_loss = None if val_loader is None else self._run_epoch(batched_loss, params, val_loader, None, config.loss_weighting)
+            keep = []
+            for row, k in enumerate(active):
+                models[k].epochs_done += 1
+                models[k].train_loss.append(float(train_loss[row]))
+                stop = False
+                if val_loss is not None:
+                    models[k].val_loss.append(float(val_loss[row]))
+                    stop = stoppers[k].step(_StackedSlice(params, row, shapes[k]), float(val_loss[row]))
+                if stop:
+                    write_back(row, k)
+                else:
+                    keep.append(row)
+            if not keep:
+                active = []
+                break
+            if len(keep) < len(active):
+                params, optimizer = self._compact(params, optimizer, keep, learning_rate)
+                active = [active[row] for row in keep]
+
+        for row, k in enumerate(active):
+            write_back(row, k)
+        for model, stopper in zip(models, stoppers):
+            if stopper.best_state is not None:
+                model.model.load_state_dict(stopper.best_state)
+
+    def fit(self, data, config: AutoencTrainingConfig) -> List[DenseAutoencoderModel]:
+        if not self.models:
+            return []
+        array = DenseAutoencoderModel._array(data)
+        tensor = input_tensor(np.ascontiguousarray(array, dtype=np.float32))
+        for members in self.groups():
+            self._fit_group(members, tensor, array, config)
+        return self.models
 
 
 def autoenc_create(
@@ -172,7 +358,19 @@ def autoenc_create(
     negative_slope=0.2,
     validation_strategy="static",
     stopping_rule="none",
+    compile=False,
+    precision="fp32",
+    num_threads=None,
 ):
+    """Create a dense autoencoder.
+
+    ``compile=True`` runs the forwards through ``torch.compile`` and
+    ``precision="bf16"`` under bfloat16 autocast. The telemetry of every fit
+    then holds ``compile``: graphs built and the seconds spent compiling, in
+    compiled steps and in eager fallback, to judge whether compiling pays off;
+    ``model.compiler.report()`` has the same counters over the model's
+    lifetime, predictions included.
+    """
     return DenseAutoencoderModel(
         input_size,
         encoding_size,
@@ -183,9 +381,13 @@ def autoenc_create(
         negative_slope=negative_slope,
         validation_strategy=validation_strategy,
         stopping_rule=stopping_rule,
+        compile=compile,
+        precision=precision,
+        num_threads=num_threads,
     )
 
 
+@uses_model_threads
 def autoenc_fit(
     autoencoder,
     data,
@@ -201,6 +403,15 @@ def autoenc_fit(
     ema_alpha=0.2,
     test_window=30,
     p_value=0.05,
+    batch_engine="tensor",
+    loss_weighting="batch",
+    lazy_best=False,
+    profile=None,
+    checkpoint=None,
+    distributed=None,
+    stream=None,
+    warm_start=False,
+    keep_training_state=True,
 ):
     autoencoder.validation_strategy, autoencoder.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
     config = AutoencTrainingConfig(
@@ -216,14 +427,86 @@ def autoenc_fit(
         ema_alpha=float(ema_alpha),
         test_window=int(test_window),
         p_value=float(p_value),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+        checkpoint=checkpoint_options(checkpoint),
+        distributed=distributed_options(distributed),
+        stream=stream_options(stream),
+        warm_start=bool(warm_start),
+        keep_training_state=bool(keep_training_state),
     )
-    autoencoder.fit(data, config)
-    return autoencoder, np.array(autoencoder.train_loss), np.array(autoencoder.val_loss)
+    with profiling(profile, "autoenc_fit", steps=True):
+        autoencoder.fit(data, config)
+    return autoencoder, np.array(autoencoder.train_loss), np.array(autoencoder.val_loss), autoencoder.telemetry.as_dict()
+
+
+def autoenc_partial_fit(autoencoder, data, num_epochs=1, **kwargs):
+    return autoenc_fit(autoencoder, data, num_epochs=num_epochs, **partial_fit_args(autoencoder, kwargs))
+
+
+def autoenc_fit_many(
+    autoencoders,
+    data,
+    batch_size=32,
+    num_epochs=100,
+    learning_rate=0.001,
+    validation_strategy="static",
+    stopping_rule="none",
+    val_ratio=0.3,
+    patience=100,
+    min_delta=1e-4,
+    sma_window=5,
+    ema_alpha=0.2,
+    test_window=30,
+    p_value=0.05,
+    batch_engine="tensor",
+    loss_weighting="batch",
+    lazy_best=False,
+):
+    autoencoders = list(autoencoders)
+    for autoencoder in autoencoders:
+        autoencoder.validation_strategy, autoencoder.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
+    config = AutoencTrainingConfig(
+        batch_size=int(batch_size),
+        num_epochs=int(num_epochs),
+        learning_rate=float(learning_rate),
+        validation_strategy=str(validation_strategy).lower(),
+        stopping_rule=str(stopping_rule).lower(),
+        val_ratio=float(val_ratio),
+        patience=int(patience),
+        min_delta=float(min_delta),
+        sma_window=int(sma_window),
+        ema_alpha=float(ema_alpha),
+        test_window=int(test_window),
+        p_value=float(p_value),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+    )
+    with thread_limits(autoencoders[0].num_threads if autoencoders else None):
+        return BatchedAutoencoderTrainer(autoencoders).fit(data, config)
+
+
+@uses_model_threads
+def autoenc_encode(autoencoder, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_encode"):
+        return autoencoder.encode(data, batch_size=batch_size)
+
+
+@uses_model_threads
+def autoenc_encode_decode(autoencoder, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_encode_decode"):
+        return autoencoder.encode_decode(data, batch_size=batch_size)
+
+
+def autoenc_save(autoencoder, path, include_training_state=False):
+    return save_model(autoencoder, path, include_training_state=include_training_state)
 
 
-def autoenc_encode(autoencoder, data, batch_size=32):
-    return autoencoder.encode(data, batch_size=batch_size)
+def autoenc_load(path, mmap=True):
+    return load_model(path, DenseAutoencoderModel, mmap=mmap)
 
 
-def autoenc_encode_decode(autoencoder, data, batch_size=32):
-    return autoencoder.encode_decode(data, batch_size=batch_size)
+def autoenc_export(autoencoder, path, formats=("torchscript", "onnx"), opset=17):
+    return export_model(autoencoder, path, formats=formats, opset=opset)
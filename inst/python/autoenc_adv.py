@@ -5,13 +5,14 @@ Unified adversarial autoencoder used by daltoolboxdp via reticulate.
 from typing import Dict, List, Optional
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, TensorDataset
 
 from autoenc_common import AutoencTrainingConfig, StopController, ensure_int_list, split_indices, validate_strategy
+from parallel_common import uses_model_threads, validate_num_threads
+from stream_common import ChunkStream, split_rows, stream_options, stream_or_array
+from torch_common import ExportGraph, FitTelemetry, ForwardCompiler, LossAccumulator, TrainingCheckpoint, as_float32_array, batch_iterator, batched_inference, checkpoint_options, export_model, input_tensor, load_model, partial_fit_args, profiling, save_model, serializable, validate_batch_engine, validate_loss_weighting
 
 
 def _activation(name: str, x: torch.Tensor) -> torch.Tensor:
@@ -55,6 +56,7 @@ class FeedForwardNet(nn.Module):
         return x
 
 
+@serializable
 class AdversarialAutoencoderModel:
     def __init__(
         self,
@@ -72,8 +74,13 @@ class AdversarialAutoencoderModel:
         lr_discriminator: Optional[float] = None,
         validation_strategy: str = "static",
         stopping_rule: str = "none",
+        compile: bool = False,
+        precision: str = "fp32",
+        num_threads: Optional[int] = None,
     ):
         self.validation_strategy, self.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
+        self.compiler = ForwardCompiler(compile, precision)
+        self.num_threads = validate_num_threads(num_threads)
         self.input_size = int(input_size)
         self.encoding_size = int(encoding_size)
         self.encoder_hidden_sizes = [60, 60] if encoder_hidden_sizes is None else encoder_hidden_sizes
@@ -95,6 +102,7 @@ class AdversarialAutoencoderModel:
         self.train_loss: List[float] = []
         self.val_loss: List[float] = []
         self.epochs_done: int = 0
+        self.telemetry = FitTelemetry()
 
     def _reset_optimizers(self):
         encoder_lr = 1e-4 if self.lr_encoder is None else self.lr_encoder
@@ -108,18 +116,18 @@ class AdversarialAutoencoderModel:
 
     @staticmethod
     def _array(data):
-        if isinstance(data, pd.DataFrame):
-            return data.to_numpy().astype(np.float32)
-        return np.asarray(data, dtype=np.float32)
+        return as_float32_array(data)
 
     @staticmethod
-    def _loader(array: np.ndarray, batch_size: int, shuffle: bool):
-        tensor = torch.from_numpy(array.astype(np.float32))
-        return DataLoader(TensorDataset(tensor, tensor), batch_size=int(batch_size), shuffle=shuffle, drop_last=False)
+    def _loader(array: np.ndarray, batch_size: int, shuffle: bool, batch_engine: str = "tensor", indices=None):
+        if isinstance(array, ChunkStream):
+            return array.batches(batch_size, shuffle, indices)
+        tensor = input_tensor(np.ascontiguousarray(array, dtype=np.float32))
+        return batch_iterator((tensor,), batch_size, shuffle, batch_engine=batch_engine, indices=indices)
 
     def _reconstruction_loss(self, x: torch.Tensor) -> torch.Tensor:
-        z = self.Q(x)
-        recon = self.P(z)
+        z = self.compiler(self.Q)(x)
+        recon = self.compiler(self.P)(z)
         return nn.MSELoss()(recon, x)
 
     def _zero_all(self):
@@ -127,17 +135,25 @@ class AdversarialAutoencoderModel:
         self.Q.zero_grad()
         self.D_gauss.zero_grad()
 
-    def _train_epoch(self, loader):
+    def _optimizers(self):
+        return {
+            "encoder": self.encoder_opt,
+            "decoder": self.decoder_opt,
+            "generator": self.generator_opt,
+            "discriminator": self.discriminator_opt,
+        }
+
+    def _train_epoch(self, loader, loss_weighting: str = "batch"):
         tiny = 1e-15
-        losses = []
+        losses = LossAccumulator(loss_weighting)
         self.Q.train()
         self.P.train()
         self.D_gauss.train()
-        for xb, _ in loader:
+        for (xb,) in loader:
             xb = xb.float().view(xb.size(0), -1)
 
-            z_sample = self.Q(xb)
-            x_sample = self.P(z_sample)
+            z_sample = self.compiler(self.Q)(xb)
+            x_sample = self.compiler(self.P)(z_sample)
             recon_loss = nn.MSELoss()(x_sample + tiny, xb + tiny)
             recon_loss.backward()
             self.decoder_opt.step()
@@ -146,41 +162,41 @@ class AdversarialAutoencoderModel:
 
             self.Q.eval()
             z_real = torch.randn(len(xb), self.encoding_size) * self.latent_prior_scale
-            z_fake = self.Q(xb)
-            d_real = self.D_gauss(z_real)
-            d_fake = self.D_gauss(z_fake)
+            z_fake = self.compiler(self.Q)(xb)
+            d_real = self.compiler(self.D_gauss)(z_real)
+            d_fake = self.compiler(self.D_gauss)(z_fake)
             d_loss = -torch.mean(torch.log(d_real + tiny) + torch.log(1 - d_fake + tiny))
             d_loss.backward()
             self.discriminator_opt.step()
             self._zero_all()
 
             self.Q.train()
-            z_fake = self.Q(xb)
-            d_fake = self.D_gauss(z_fake)
+            z_fake = self.compiler(self.Q)(xb)
+            d_fake = self.compiler(self.D_gauss)(z_fake)
             g_loss = -torch.mean(torch.log(d_fake + tiny))
             g_loss.backward()
             self.generator_opt.step()
             self._zero_all()
-            losses.append(float(recon_loss.item()))
-        return float(np.mean(losses)) if losses else 0.0
+            losses.add(recon_loss, xb.size(0))
+        return losses.value()
 
-    def _eval_epoch(self, loader):
-        losses = []
+    def _eval_epoch(self, loader, loss_weighting: str = "batch"):
+        losses = LossAccumulator(loss_weighting)
         self.Q.eval()
         self.P.eval()
         with torch.no_grad():
-            for xb, _ in loader:
+            for (xb,) in loader:
                 xb = xb.float().view(xb.size(0), -1)
-                z = self.Q(xb)
-                recon = self.P(z)
-                losses.append(float(nn.MSELoss()(recon, xb).item()))
-        return float(np.mean(losses)) if losses else 0.0
+                z = self.compiler(self.Q)(xb)
+                recon = self.compiler(self.P)(z)
+                losses.add(nn.MSELoss()(recon, xb), xb.size(0))
+        return losses.value()
 
     def _state_dict(self):
         return {
-            "Q": {k: v.detach().clone() for k, v in self.Q.state_dict().items()},
-            "P": {k: v.detach().clone() for k, v in self.P.state_dict().items()},
-            "D": {k: v.detach().clone() for k, v in self.D_gauss.state_dict().items()},
+            "Q": self.Q.state_dict(),
+            "P": self.P.state_dict(),
+            "D": self.D_gauss.state_dict(),
         }
 
     def _load_state(self, state: Dict[str, Dict[str, torch.Tensor]]):
@@ -202,69 +218,73 @@ class AdversarialAutoencoderModel:
                 self.lr_discriminator = base_lr * 0.5
         self._reset_optimizers()
 
-        array = self._array(data)
-        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value)
-        self.train_loss = []
-        self.val_loss = []
-        self.epochs_done = 0
+        array = stream_or_array(data, config.stream, self._array)
+        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value, lazy_best=config.lazy_best)
+        if not config.warm_start:
+            self.train_loss = []
+            self.val_loss = []
+            self.epochs_done = 0
+        self.telemetry = FitTelemetry(compiler=self.compiler)
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, ("train_loss", "val_loss", "epochs_done"), {"Q": self.Q, "P": self.P, "D": self.D_gauss}, warm_start=config.warm_start, keep_state=config.keep_training_state)
+        checkpoint.begin()
 
         if self.validation_strategy == "static" and self.stopping_rule != "none":
-            train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-            train_loader = self._loader(array[train_idx], config.batch_size, True)
-            val_loader = self._loader(array[val_idx], config.batch_size, False)
+            train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=train_idx)
+            val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=val_idx)
         elif self.validation_strategy == "static":
-            train_loader = self._loader(array, config.batch_size, True)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine)
             val_loader = None
         else:
             train_loader = None
             val_loader = None
 
-        for epoch in range(int(config.num_epochs)):
+        for epoch in checkpoint.epochs(int(config.num_epochs), self._optimizers(), stopper):
+            self.telemetry.start_epoch()
             self.epochs_done += 1
             if self.validation_strategy == "dynamic":
-                train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-                train_loader = self._loader(array[train_idx], config.batch_size, True)
-                val_loader = self._loader(array[val_idx], config.batch_size, False)
-            self.train_loss.append(self._train_epoch(train_loader))
+                train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+                train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=train_idx)
+                val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=val_idx)
+            self.train_loss.append(self._train_epoch(self.telemetry.batches(train_loader), config.loss_weighting))
             if val_loader is not None:
-                val_loss = self._eval_epoch(val_loader)
+                with self.telemetry.phase("validation"):
+                    val_loss = self._eval_epoch(val_loader, config.loss_weighting)
                 self.val_loss.append(val_loss)
-                if self.stopping_rule == "none":
-                    stopper.best_state = self._state_dict()
-                elif stopper.step(self, val_loss):
+                with self.telemetry.phase("snapshot"):
+                    stop = stopper.step(self, val_loss)
+                if stop:
                     break
+        self.telemetry.stop()
+        checkpoint.close()
         if stopper.best_state is not None:
             self._load_state(stopper.best_state)
         return self
 
     def state_dict(self):
-        # StopController clones model.state_dict() by default. For AAE the model spans three modules.
+        # StopController snapshots model.state_dict() in place. For AAE the model spans three modules.
         return self._state_dict()
 
     def load_state_dict(self, state):
         self._load_state(state)
 
     def encode(self, data, batch_size=32):
-        array = self._array(data)
-        loader = self._loader(array, batch_size, False)
-        outs = []
         self.Q.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                outs.append(self.Q(xb.float().view(xb.size(0), -1)).detach().numpy())
-        return np.concatenate(outs, axis=0)
+        encoder = self.compiler(self.Q)
+        return batched_inference(lambda xb: encoder(xb.flatten(1)), self._array(data), batch_size)
 
     def encode_decode(self, data, batch_size=350):
-        array = self._array(data)
-        loader = self._loader(array, batch_size, False)
-        outs = []
         self.Q.eval()
         self.P.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                flat = xb.float().view(xb.size(0), -1)
-                outs.append(self.P(self.Q(flat)).detach().numpy())
-        return np.concatenate(outs, axis=0)
+        encoder = self.compiler(self.Q)
+        decoder = self.compiler(self.P)
+        return batched_inference(lambda xb: decoder(encoder(xb.flatten(1))), self._array(data), batch_size)
+
+    def _export_graphs(self):
+        return {
+            "encoder": ExportGraph(self.Q, (self.input_size,)),
+            "decoder": ExportGraph(self.P, (self.encoding_size,)),
+        }
 
 
 def autoenc_adv_create(
@@ -282,7 +302,19 @@ def autoenc_adv_create(
     lr_discriminator=None,
     validation_strategy="static",
     stopping_rule="none",
+    compile=False,
+    precision="fp32",
+    num_threads=None,
 ):
+    """Create an adversarial autoencoder.
+
+    ``compile=True`` runs the forwards through ``torch.compile`` and
+    ``precision="bf16"`` under bfloat16 autocast. The telemetry of every fit
+    then holds ``compile``: graphs built and the seconds spent compiling, in
+    compiled steps and in eager fallback, to judge whether compiling pays off;
+    ``model.compiler.report()`` has the same counters over the model's
+    lifetime, predictions included.
+    """
     return AdversarialAutoencoderModel(
         input_size,
         encoding_size,
@@ -298,10 +330,14 @@ def autoenc_adv_create(
         lr_discriminator=lr_discriminator,
         validation_strategy=validation_strategy,
         stopping_rule=stopping_rule,
+        compile=compile,
+        precision=precision,
+        num_threads=num_threads,
     )
 
 
-def autoenc_adv_fit(aae, data, batch_size=350, num_epochs=100, learning_rate=0.001, validation_strategy="static", stopping_rule="none", val_ratio=0.3, patience=100, min_delta=1e-4, sma_window=5, ema_alpha=0.2, test_window=30, p_value=0.05):
+@uses_model_threads
+def autoenc_adv_fit(aae, data, batch_size=350, num_epochs=100, learning_rate=0.001, validation_strategy="static", stopping_rule="none", val_ratio=0.3, patience=100, min_delta=1e-4, sma_window=5, ema_alpha=0.2, test_window=30, p_value=0.05, batch_engine="tensor", loss_weighting="batch", lazy_best=False, profile=None, checkpoint=None, stream=None, warm_start=False, keep_training_state=True):
     aae.validation_strategy, aae.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
     config = AutoencTrainingConfig(
         batch_size=int(batch_size),
@@ -316,14 +352,42 @@ def autoenc_adv_fit(aae, data, batch_size=350, num_epochs=100, learning_rate=0.0
         ema_alpha=float(ema_alpha),
         test_window=int(test_window),
         p_value=float(p_value),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+        checkpoint=checkpoint_options(checkpoint),
+        stream=stream_options(stream),
+        warm_start=bool(warm_start),
+        keep_training_state=bool(keep_training_state),
     )
-    aae.fit(data, config)
-    return aae, np.array(aae.train_loss), np.array(aae.val_loss)
+    with profiling(profile, "autoenc_adv_fit", steps=True):
+        aae.fit(data, config)
+    return aae, np.array(aae.train_loss), np.array(aae.val_loss), aae.telemetry.as_dict()
+
+
+def autoenc_adv_partial_fit(aae, data, num_epochs=1, **kwargs):
+    return autoenc_adv_fit(aae, data, num_epochs=num_epochs, **partial_fit_args(aae, kwargs))
+
+
+@uses_model_threads
+def autoenc_adv_encode(aae, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_adv_encode"):
+        return aae.encode(data, batch_size=batch_size)
+
+
+@uses_model_threads
+def autoenc_adv_encode_decode(aae, data, batch_size=350, profile=None):
+    with profiling(profile, "autoenc_adv_encode_decode"):
+        return aae.encode_decode(data, batch_size=batch_size)
+
+
+def autoenc_adv_save(aae, path, include_training_state=False):
+    return save_model(aae, path, include_training_state=include_training_state)
 
 
-def autoenc_adv_encode(aae, data, batch_size=32):
-    return aae.encode(data, batch_size=batch_size)
+def autoenc_adv_load(path, mmap=True):
+    return load_model(path, AdversarialAutoencoderModel, mmap=mmap)
 
 
-def autoenc_adv_encode_decode(aae, data, batch_size=350):
-    return aae.encode_decode(data, batch_size=batch_size)
+def autoenc_adv_export(aae, path, formats=("torchscript", "onnx"), opset=17):
+    return export_model(aae, path, formats=formats, opset=opset)
@@ -7,7 +7,8 @@ from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
 import torch.nn as nn
-from scipy.stats import ttest_ind
+
+from torch_common import RollingStopStats, StateSnapshot
 
 
 VALIDATION_STRATEGIES = {"static", "dynamic"}
@@ -28,6 +29,14 @@ class AutoencTrainingConfig:
     ema_alpha: float = 0.2
     test_window: int = 30
     p_value: float = 0.05
+    batch_engine: str = "tensor"
+    loss_weighting: str = "batch"
+    lazy_best: bool = False
+    checkpoint: Optional[dict] = None
+    distributed: Optional[dict] = None
+    stream: Optional[dict] = None
+    warm_start: bool = False
+    keep_training_state: bool = True
 
 
 def ensure_int_list(values, default: Optional[Sequence[int]] = None, allow_empty: bool = False) -> List[int]:
@@ -103,7 +112,7 @@ def split_indices(n_samples: int, val_ratio: float) -> Tuple[np.ndarray, np.ndar
 
 
 class StopController:
-    def __init__(self, rule: str, min_delta: float, patience: int, sma_window: int, ema_alpha: float, test_window: int, p_value: float):
+    def __init__(self, rule: str, min_delta: float, patience: int, sma_window: int, ema_alpha: float, test_window: int, p_value: float, lazy_best: bool = False):
         self.rule = str(rule).lower()
         self.min_delta = float(min_delta)
         self.patience = int(patience)
@@ -116,30 +125,30 @@ class StopController:
         self.patience_ctr = 0
         self.ema_value = None
         self.val_history: List[float] = []
+        self.lazy_best = bool(lazy_best)
+        self.snapshot = StateSnapshot()
+        self.stats = RollingStopStats(self.sma_window, self.test_window)
 
     def clone_state(self, model):
-        def _clone(value):
-            if isinstance(value, dict):
-                return {k: _clone(v) for k, v in value.items()}
-            return value.detach().clone()
-
-        return {k: _clone(v) for k, v in model.state_dict().items()}
+        return self.snapshot.capture(model.state_dict())
 
     def _h_improved(self) -> bool:
-        if len(self.val_history) < 2 * self.test_window:
-            if len(self.val_history) == 1:
-                return True
-            return self.val_history[-1] < min(self.val_history[:-1])
-        previous = self.val_history[-2 * self.test_window : -self.test_window]
-        recent = self.val_history[-self.test_window :]
-        _, p_value = ttest_ind(previous, recent, equal_var=False, alternative="greater")
+        p_value = self.stats.welch_p_value()
+        if p_value is None:
+            # Until both windows are full, improvement means a new minimum.
+            return self.stats.is_new_min
         return bool(p_value < self.p_value)
 
     def step(self, model, current: float) -> bool:
         self.val_history.append(float(current))
+        self.stats.push(current)
 
         if self.rule == "none":
-            self.best_state = self.clone_state(model)
+            if not self.lazy_best:
+                self.best_state = self.clone_state(model)
+            elif (self.best_value - float(current)) > self.min_delta:
+                self.best_value = float(current)
+                self.best_state = self.clone_state(model)
             return False
 
         if self.rule == "h":
@@ -154,7 +163,7 @@ class StopController:
         if self.rule == "patience":
             monitor_value = float(current)
         elif self.rule == "sma":
-            monitor_value = float(np.mean(self.val_history[-self.sma_window :]))
+            monitor_value = self.stats.sma()
         elif self.rule == "ema":
             if self.ema_value is None:
                 self.ema_value = current
@@ -9,12 +9,13 @@ stores the observed series and input_size is the temporal length.
 from typing import List, Optional
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, TensorDataset
 
 from autoenc_common import AutoencTrainingConfig, StopController, split_indices, validate_strategy
+from parallel_common import uses_model_threads, validate_num_threads
+from stream_common import ChunkStream, split_rows, stream_options, stream_or_array
+from torch_common import ExportGraph, FitTelemetry, ForwardCompiler, LossAccumulator, TrainingCheckpoint, as_float32_array, batch_iterator, batched_inference, checkpoint_options, export_model, input_tensor, load_model, partial_fit_args, profiling, save_model, serializable, validate_batch_engine, validate_loss_weighting
 
 
 class ConvAutoencoder(nn.Module):
@@ -48,115 +49,134 @@ class ConvAutoencoder(nn.Module):
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         return self.encoder_projection(self.encoder_features(x))
 
+    def decode(self, z: torch.Tensor) -> torch.Tensor:
+        return self.decoder(self.decoder_projection(z))
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        latent = self.encode(x)
-        decoded = self.decoder_projection(latent)
-        return self.decoder(decoded)
+        return self.decode(self.encode(x))
 
 
+@serializable
 class ConvAutoencoderModel:
-    def __init__(self, input_size: int, encoding_size: int, validation_strategy: str = "static", stopping_rule: str = "none"):
+    def __init__(self, input_size: int, encoding_size: int, validation_strategy: str = "static", stopping_rule: str = "none", compile: bool = False, precision: str = "fp32", num_threads: Optional[int] = None):
         self.validation_strategy, self.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
+        self.compiler = ForwardCompiler(compile, precision)
+        self.num_threads = validate_num_threads(num_threads)
         self.input_size = int(input_size)
         self.model = ConvAutoencoder(self.input_size, encoding_size).float()
         self.train_loss: List[float] = []
         self.val_loss: List[float] = []
         self.epochs_done: int = 0
+        self.telemetry = FitTelemetry()
 
     def _array(self, data):
-        if isinstance(data, pd.DataFrame):
-            array = data.to_numpy().astype(np.float32)
-        else:
-            array = np.asarray(data, dtype=np.float32)
+        array = as_float32_array(data)
         if array.ndim != 2:
             raise ValueError("Conv autoencoder expects a 2D array with shape (n_samples, input_size).")
         if array.shape[1] != self.input_size:
             raise ValueError(f"Expected {self.input_size} input features, got {array.shape[1]}.")
         return array[:, np.newaxis, :]
 
-    def _loader(self, array: np.ndarray, batch_size: int, shuffle: bool):
-        tensor = torch.from_numpy(array.astype(np.float32))
-        return DataLoader(TensorDataset(tensor, tensor), batch_size=int(batch_size), shuffle=shuffle, drop_last=False)
+    def _loader(self, array: np.ndarray, batch_size: int, shuffle: bool, batch_engine: str = "tensor", indices=None):
+        if isinstance(array, ChunkStream):
+            return array.batches(batch_size, shuffle, indices)
+        tensor = input_tensor(np.ascontiguousarray(array, dtype=np.float32))
+        return batch_iterator((tensor,), batch_size, shuffle, batch_engine=batch_engine, indices=indices)
 
-    def _run_epoch(self, loader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module) -> float:
-        losses: List[float] = []
+    def _run_epoch(self, loader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module, loss_weighting: str = "batch") -> float:
+        losses = LossAccumulator(loss_weighting)
         if optimizer is None:
             self.model.eval()
             with torch.no_grad():
-                for xb, yb in loader:
-                    losses.append(float(criterion(self.model(xb.float()), yb.float()).item()))
+                for (xb,) in loader:
+                    losses.add(criterion(self.compiler(self.model)(xb.float()), xb.float()), xb.size(0))
         else:
             self.model.train()
-            for xb, yb in loader:
+            for (xb,) in loader:
                 optimizer.zero_grad()
-                loss = criterion(self.model(xb.float()), yb.float())
+                loss = criterion(self.compiler(self.model)(xb.float()), xb.float())
                 loss.backward()
                 optimizer.step()
-                losses.append(float(loss.item()))
-        return float(np.mean(losses)) if losses else 0.0
+                losses.add(loss, xb.size(0))
+        return losses.value()
 
     def fit(self, data, config: AutoencTrainingConfig):
-        array = self._array(data)
+        array = stream_or_array(data, config.stream, self._array)
         criterion = nn.MSELoss()
         optimizer = torch.optim.Adam(self.model.parameters(), lr=float(config.learning_rate))
-        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value)
-        self.train_loss = []
-        self.val_loss = []
-        self.epochs_done = 0
+        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value, lazy_best=config.lazy_best)
+        if not config.warm_start:
+            self.train_loss = []
+            self.val_loss = []
+            self.epochs_done = 0
+        self.telemetry = FitTelemetry(compiler=self.compiler)
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, ("train_loss", "val_loss", "epochs_done"), {"model": self.model}, warm_start=config.warm_start, keep_state=config.keep_training_state)
+        checkpoint.begin()
 
         if self.validation_strategy == "static" and self.stopping_rule != "none":
-            train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-            train_loader = self._loader(array[train_idx], config.batch_size, True)
-            val_loader = self._loader(array[val_idx], config.batch_size, False)
+            train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=train_idx)
+            val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=val_idx)
         elif self.validation_strategy == "static":
-            train_loader = self._loader(array, config.batch_size, True)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine)
             val_loader = None
         else:
             train_loader = None
             val_loader = None
 
-        for epoch in range(int(config.num_epochs)):
+        for epoch in checkpoint.epochs(int(config.num_epochs), {"optimizer": optimizer}, stopper):
+            self.telemetry.start_epoch()
             self.epochs_done += 1
             if self.validation_strategy == "dynamic":
-                train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-                train_loader = self._loader(array[train_idx], config.batch_size, True)
-                val_loader = self._loader(array[val_idx], config.batch_size, False)
-            self.train_loss.append(self._run_epoch(train_loader, optimizer, criterion))
+                train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+                train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=train_idx)
+                val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=val_idx)
+            self.train_loss.append(self._run_epoch(self.telemetry.batches(train_loader), optimizer, criterion, config.loss_weighting))
             if val_loader is not None:
-                val_loss = self._run_epoch(val_loader, None, criterion)
+                with self.telemetry.phase("validation"):
+                    val_loss = self._run_epoch(val_loader, None, criterion, config.loss_weighting)
                 self.val_loss.append(val_loss)
-                if stopper.step(self.model, val_loss):
+                with self.telemetry.phase("snapshot"):
+                    stop = stopper.step(self.model, val_loss)
+                if stop:
                     break
+        self.telemetry.stop()
+        checkpoint.close()
         if stopper.best_state is not None:
             self.model.load_state_dict(stopper.best_state)
         return self
 
     def encode(self, data, batch_size=32):
-        array = self._array(data)
-        loader = self._loader(array, batch_size, False)
-        outs = []
         self.model.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                outs.append(self.model.encode(xb.float()).detach().numpy())
-        return np.concatenate(outs, axis=0)
+        return batched_inference(self.compiler(self.model.encode), self._array(data), batch_size)
 
     def encode_decode(self, data, batch_size=32):
-        array = self._array(data)
-        loader = self._loader(array, batch_size, False)
-        outs = []
         self.model.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                outs.append(self.model(xb.float()).detach().numpy().squeeze(1))
-        return np.concatenate(outs, axis=0)
+        model = self.compiler(self.model)
+        return batched_inference(lambda xb: model(xb).squeeze(1), self._array(data), batch_size)
+
+    def _export_graphs(self):
+        return {
+            "encoder": ExportGraph(self.model, (1, self.input_size), method="encode"),
+            "decoder": ExportGraph(self.model, (self.init_args["encoding_size"],), method="decode"),
+        }
 
 
-def autoenc_conv_create(input_size, encoding_size, validation_strategy="static", stopping_rule="none"):
-    return ConvAutoencoderModel(input_size, encoding_size, validation_strategy=validation_strategy, stopping_rule=stopping_rule)
+def autoenc_conv_create(input_size, encoding_size, validation_strategy="static", stopping_rule="none", compile=False, precision="fp32", num_threads=None):
+    """Create a convolutional autoencoder.
 
+    ``compile=True`` runs the forwards through ``torch.compile`` and
+    ``precision="bf16"`` under bfloat16 autocast. The telemetry of every fit
+    then holds ``compile``: graphs built and the seconds spent compiling, in
+    compiled steps and in eager fallback, to judge whether compiling pays off;
+    ``model.compiler.report()`` has the same counters over the model's
+    lifetime, predictions included.
+    """
+    return ConvAutoencoderModel(input_size, encoding_size, validation_strategy=validation_strategy, stopping_rule=stopping_rule, compile=compile, precision=precision, num_threads=num_threads)
 
-def autoenc_conv_fit(cae, data, batch_size=32, num_epochs=100, learning_rate=0.001, validation_strategy="static", stopping_rule="none", val_ratio=0.3, patience=100, min_delta=1e-4, sma_window=5, ema_alpha=0.2, test_window=30, p_value=0.05):
+
+@uses_model_threads
+def autoenc_conv_fit(cae, data, batch_size=32, num_epochs=100, learning_rate=0.001, validation_strategy="static", stopping_rule="none", val_ratio=0.3, patience=100, min_delta=1e-4, sma_window=5, ema_alpha=0.2, test_window=30, p_value=0.05, batch_engine="tensor", loss_weighting="batch", lazy_best=False, profile=None, checkpoint=None, stream=None, warm_start=False, keep_training_state=True):
     cae.validation_strategy, cae.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
     config = AutoencTrainingConfig(
         batch_size=int(batch_size),
@@ -171,14 +191,42 @@ def autoenc_conv_fit(cae, data, batch_size=32, num_epochs=100, learning_rate=0.0
         ema_alpha=float(ema_alpha),
         test_window=int(test_window),
         p_value=float(p_value),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+        checkpoint=checkpoint_options(checkpoint),
+        stream=stream_options(stream),
+        warm_start=bool(warm_start),
+        keep_training_state=bool(keep_training_state),
     )
-    cae.fit(data, config)
-    return cae, np.array(cae.train_loss), np.array(cae.val_loss)
+    with profiling(profile, "autoenc_conv_fit", steps=True):
+        cae.fit(data, config)
+    return cae, np.array(cae.train_loss), np.array(cae.val_loss), cae.telemetry.as_dict()
+
+
+def autoenc_conv_partial_fit(cae, data, num_epochs=1, **kwargs):
+    return autoenc_conv_fit(cae, data, num_epochs=num_epochs, **partial_fit_args(cae, kwargs))
+
+
+@uses_model_threads
+def autoenc_conv_encode(cae, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_conv_encode"):
+        return cae.encode(data, batch_size=batch_size)
+
+
+@uses_model_threads
+def autoenc_conv_encode_decode(cae, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_conv_encode_decode"):
+        return cae.encode_decode(data, batch_size=batch_size)
+
+
+def autoenc_conv_save(cae, path, include_training_state=False):
+    return save_model(cae, path, include_training_state=include_training_state)
 
 
-def autoenc_conv_encode(cae, data, batch_size=32):
-    return cae.encode(data, batch_size=batch_size)
+def autoenc_conv_load(path, mmap=True):
+    return load_model(path, ConvAutoencoderModel, mmap=mmap)
 
 
-def autoenc_conv_encode_decode(cae, data, batch_size=32):
-    return cae.encode_decode(data, batch_size=batch_size)
+def autoenc_conv_export(cae, path, formats=("torchscript", "onnx"), opset=17):
+    return export_model(cae, path, formats=formats, opset=opset)
@@ -5,12 +5,13 @@ Unified stacked autoencoder used by daltoolboxdp via reticulate.
 from typing import List, Optional
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, TensorDataset
 
 from autoenc_common import AutoencTrainingConfig, StopController, build_dense_stack, ensure_int_list, split_indices, validate_strategy
+from parallel_common import uses_model_threads, validate_num_threads
+from stream_common import ChunkStream, split_rows, stream_options, stream_or_array
+from torch_common import ExportGraph, FitTelemetry, ForwardCompiler, LossAccumulator, TrainingCheckpoint, as_float32_array, batch_iterator, batched_inference, checkpoint_options, export_model, input_tensor, load_model, partial_fit_args, profiling, save_model, serializable, validate_batch_engine, validate_loss_weighting
 
 
 class StackUnit(nn.Module):
@@ -47,6 +48,7 @@ class StackUnit(nn.Module):
         return self.decoder(self.encoder(x))
 
 
+@serializable
 class StackedAutoencoderModel:
     def __init__(
         self,
@@ -61,8 +63,13 @@ class StackedAutoencoderModel:
         negative_slope: float = 0.2,
         validation_strategy: str = "static",
         stopping_rule: str = "none",
+        compile: bool = False,
+        precision: str = "fp32",
+        num_threads: Optional[int] = None,
     ):
         self.validation_strategy, self.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
+        self.compiler = ForwardCompiler(compile, precision)
+        self.num_threads = validate_num_threads(num_threads)
         self.encoding_sizes = ensure_int_list(encoding_sizes, default=[int(encoding_size)] * int(k))
         self.stage_count = len(self.encoding_sizes)
         self.stack: List[StackUnit] = []
@@ -84,6 +91,7 @@ class StackedAutoencoderModel:
         self.train_loss: List[float] = []
         self.val_loss: List[float] = []
         self.epochs_done: int = 0
+        self.telemetry = FitTelemetry()
 
     @staticmethod
     def _expand_stage_param(value, n_stages: int, default=None):
@@ -97,106 +105,103 @@ class StackedAutoencoderModel:
 
     @staticmethod
     def _array(data):
-        if isinstance(data, pd.DataFrame):
-            return data.to_numpy().astype(np.float32)
-        return np.asarray(data, dtype=np.float32)
+        return as_float32_array(data)
 
     @staticmethod
-    def _loader(array: np.ndarray, batch_size: int, shuffle: bool):
-        tensor = torch.from_numpy(array.astype(np.float32))
-        return DataLoader(TensorDataset(tensor, tensor), batch_size=int(batch_size), shuffle=shuffle, drop_last=False)
+    def _loader(array: np.ndarray, batch_size: int, shuffle: bool, batch_engine: str = "tensor", indices=None):
+        if isinstance(array, ChunkStream):
+            return array.batches(batch_size, shuffle, indices)
+        tensor = input_tensor(np.ascontiguousarray(array, dtype=np.float32))
+        return batch_iterator((tensor,), batch_size, shuffle, batch_engine=batch_engine, indices=indices)
 
-    @staticmethod
-    def _run_epoch(unit: nn.Module, loader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module):
-        losses: List[float] = []
+    def _run_epoch(self, unit: nn.Module, loader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module, loss_weighting: str = "batch"):
+        losses = LossAccumulator(loss_weighting)
         if optimizer is None:
             unit.eval()
             with torch.no_grad():
-                for xb, yb in loader:
-                    losses.append(float(criterion(unit(xb.float()), yb.float()).item()))
+                for (xb,) in loader:
+                    losses.add(criterion(self.compiler(unit)(xb.float()), xb.float()), xb.size(0))
         else:
             unit.train()
-            for xb, yb in loader:
+            for (xb,) in loader:
                 optimizer.zero_grad()
-                loss = criterion(unit(xb.float()), yb.float())
+                loss = criterion(self.compiler(unit)(xb.float()), xb.float())
                 loss.backward()
                 optimizer.step()
-                losses.append(float(loss.item()))
-        return float(np.mean(losses)) if losses else 0.0
+                losses.add(loss, xb.size(0))
+        return losses.value()
 
-    def _fit_unit(self, unit: nn.Module, array: np.ndarray, config: AutoencTrainingConfig):
+    def _fit_unit(self, unit: nn.Module, array: np.ndarray, config: AutoencTrainingConfig, checkpoint: TrainingCheckpoint, stage: int = 0) -> int:
         criterion = nn.MSELoss()
         optimizer = torch.optim.Adam(unit.parameters(), lr=float(config.learning_rate))
-        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value)
-        train_hist: List[float] = []
-        val_hist: List[float] = []
-        epochs_done = 0
+        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value, lazy_best=config.lazy_best)
+        # Histories of the layer being trained live on the model so checkpoints capture them.
+        self.train_loss = []
+        self.val_loss = []
+        checkpoint.begin(stage)
 
         if self.validation_strategy == "static" and self.stopping_rule != "none":
-            train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-            train_loader = self._loader(array[train_idx], config.batch_size, True)
-            val_loader = self._loader(array[val_idx], config.batch_size, False)
+            train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=train_idx)
+            val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=val_idx)
         elif self.validation_strategy == "static":
-            train_loader = self._loader(array, config.batch_size, True)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine)
             val_loader = None
         else:
             train_loader = None
             val_loader = None
 
-        for epoch in range(int(config.num_epochs)):
-            epochs_done += 1
+        for epoch in checkpoint.epochs(int(config.num_epochs), {"optimizer": optimizer}, stopper):
+            self.telemetry.start_epoch(stage)
             if self.validation_strategy == "dynamic":
-                train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-                train_loader = self._loader(array[train_idx], config.batch_size, True)
-                val_loader = self._loader(array[val_idx], config.batch_size, False)
-            train_hist.append(self._run_epoch(unit, train_loader, optimizer, criterion))
+                train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+                train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=train_idx)
+                val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=val_idx)
+            self.train_loss.append(self._run_epoch(unit, self.telemetry.batches(train_loader), optimizer, criterion, config.loss_weighting))
             if val_loader is not None:
-                val_loss = self._run_epoch(unit, val_loader, None, criterion)
-                val_hist.append(val_loss)
-                if stopper.step(unit, val_loss):
+                with self.telemetry.phase("validation"):
+                    val_loss = self._run_epoch(unit, val_loader, None, criterion, config.loss_weighting)
+                self.val_loss.append(val_loss)
+                with self.telemetry.phase("snapshot"):
+                    stop = stopper.step(unit, val_loss)
+                if stop:
                     break
+        self.telemetry.stop()
+        checkpoint.close()
         if stopper.best_state is not None:
             unit.load_state_dict(stopper.best_state)
-        return train_hist, val_hist, epochs_done
+        return checkpoint.epoch
 
     def _encode_decode_unit(self, unit: nn.Module, array: np.ndarray, batch_size: int):
-        loader = self._loader(array, batch_size, False)
-        outs = []
         unit.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                outs.append(unit(xb.float()).detach().numpy())
-        return np.concatenate(outs, axis=0)
+        return batched_inference(self.compiler(unit), array, batch_size)
 
     def _encode_unit(self, unit: nn.Module, array: np.ndarray, batch_size: int):
-        loader = self._loader(array, batch_size, False)
-        outs = []
         unit.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                outs.append(unit.encoder(xb.float()).detach().numpy())
-        return np.concatenate(outs, axis=0)
+        return batched_inference(self.compiler(unit.encoder), array, batch_size)
 
     def _decode_unit(self, unit: nn.Module, array: np.ndarray, batch_size: int):
-        loader = self._loader(array, batch_size, False)
-        outs = []
         unit.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                outs.append(unit.decoder(xb.float()).detach().numpy())
-        return np.concatenate(outs, axis=0)
+        return batched_inference(self.compiler(unit.decoder), array, batch_size)
 
     def fit(self, data, config: AutoencTrainingConfig):
-        current = self._array(data)
+        current = stream_or_array(data, config.stream, self._array)
         self.train_loss = []
         self.val_loss = []
-        self.epochs_done = 0
-        for unit in self.stack:
-            train_hist, val_hist, done = self._fit_unit(unit, current, config)
-            self.train_loss = train_hist
-            self.val_loss = val_hist
-            self.epochs_done += done
-            current = self._encode_unit(unit, current, config.batch_size)
+        if not config.warm_start:
+            self.epochs_done = 0
+        self.telemetry = FitTelemetry(compiler=self.compiler)
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, ("train_loss", "val_loss", "epochs_done"), {str(i): unit for i, unit in enumerate(self.stack)}, warm_start=config.warm_start, keep_state=config.keep_training_state)
+        for stage, unit in enumerate(self.stack):
+            # Layers finished before the checkpoint keep their restored weights.
+            if stage >= checkpoint.stage:
+                done = self._fit_unit(unit, current, config, checkpoint, stage)
+                self.epochs_done += done
+            if isinstance(current, ChunkStream):
+                # Streamed inputs are encoded chunk by chunk as the next layer reads them.
+                current = current.map(lambda arrays, unit=unit: (self._encode_unit(unit, arrays[0], config.batch_size),))
+            else:
+                current = self._encode_unit(unit, current, config.batch_size)
         return self
 
     def encode(self, data, batch_size=32):
@@ -216,6 +221,12 @@ class StackedAutoencoderModel:
             reconstructed = self._decode_unit(unit, reconstructed, batch_size)
         return reconstructed
 
+    def _export_graphs(self):
+        return {
+            "encoder": ExportGraph(nn.Sequential(*[unit.encoder for unit in self.stack]), (self.init_args["input_size"],)),
+            "decoder": ExportGraph(nn.Sequential(*[unit.decoder for unit in reversed(self.stack)]), (self.encoding_sizes[-1],)),
+        }
+
 
 def autoenc_stacked_create(
     input_size,
@@ -229,7 +240,19 @@ def autoenc_stacked_create(
     negative_slope=0.2,
     validation_strategy="static",
     stopping_rule="none",
+    compile=False,
+    precision="fp32",
+    num_threads=None,
 ):
+    """Create a stacked autoencoder.
+
+    ``compile=True`` runs the forwards through ``torch.compile`` and
+    ``precision="bf16"`` under bfloat16 autocast. The telemetry of every fit
+    then holds ``compile``: graphs built and the seconds spent compiling, in
+    compiled steps and in eager fallback, to judge whether compiling pays off;
+    ``model.compiler.report()`` has the same counters over the model's
+    lifetime, predictions included.
+    """
     return StackedAutoencoderModel(
         input_size,
         encoding_size,
@@ -242,10 +265,14 @@ def autoenc_stacked_create(
         negative_slope=negative_slope,
         validation_strategy=validation_strategy,
         stopping_rule=stopping_rule,
+        compile=compile,
+        precision=precision,
+        num_threads=num_threads,
     )
 
 
-def autoenc_stacked_fit(stack, data, batch_size=32, num_epochs=100, learning_rate=0.001, validation_strategy="static", stopping_rule="none", val_ratio=0.3, patience=100, min_delta=1e-4, sma_window=5, ema_alpha=0.2, test_window=30, p_value=0.05):
+@uses_model_threads
+def autoenc_stacked_fit(stack, data, batch_size=32, num_epochs=100, learning_rate=0.001, validation_strategy="static", stopping_rule="none", val_ratio=0.3, patience=100, min_delta=1e-4, sma_window=5, ema_alpha=0.2, test_window=30, p_value=0.05, batch_engine="tensor", loss_weighting="batch", lazy_best=False, profile=None, checkpoint=None, stream=None, warm_start=False, keep_training_state=True):
     stack.validation_strategy, stack.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
     config = AutoencTrainingConfig(
         batch_size=int(batch_size),
@@ -260,14 +287,42 @@ def autoenc_stacked_fit(stack, data, batch_size=32, num_epochs=100, learning_rat
         ema_alpha=float(ema_alpha),
         test_window=int(test_window),
         p_value=float(p_value),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+        checkpoint=checkpoint_options(checkpoint),
+        stream=stream_options(stream),
+        warm_start=bool(warm_start),
+        keep_training_state=bool(keep_training_state),
     )
-    stack.fit(data, config)
-    return stack, np.array(stack.train_loss), np.array(stack.val_loss)
+    with profiling(profile, "autoenc_stacked_fit", steps=True):
+        stack.fit(data, config)
+    return stack, np.array(stack.train_loss), np.array(stack.val_loss), stack.telemetry.as_dict()
+
+
+def autoenc_stacked_partial_fit(stack, data, num_epochs=1, **kwargs):
+    return autoenc_stacked_fit(stack, data, num_epochs=num_epochs, **partial_fit_args(stack, kwargs))
+
+
+@uses_model_threads
+def autoenc_stacked_encode(sae, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_stacked_encode"):
+        return sae.encode(data, batch_size=batch_size)
+
+
+@uses_model_threads
+def autoenc_stacked_encode_decode(sae, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_stacked_encode_decode"):
+        return sae.encode_decode(data, batch_size=batch_size)
+
+
+def autoenc_stacked_save(sae, path, include_training_state=False):
+    return save_model(sae, path, include_training_state=include_training_state)
 
 
-def autoenc_stacked_encode(sae, data, batch_size=32):
-    return sae.encode(data, batch_size=batch_size)
+def autoenc_stacked_load(path, mmap=True):
+    return load_model(path, StackedAutoencoderModel, mmap=mmap)
 
 
-def autoenc_stacked_encode_decode(sae, data, batch_size=32):
-    return sae.encode_decode(data, batch_size=batch_size)
+def autoenc_stacked_export(sae, path, formats=("torchscript", "onnx"), opset=17):
+    return export_model(sae, path, formats=formats, opset=opset)
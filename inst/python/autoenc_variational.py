@@ -5,12 +5,14 @@ Unified variational autoencoder used by daltoolboxdp via reticulate.
 from typing import List, Optional
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, TensorDataset
 
 from autoenc_common import AutoencTrainingConfig, StopController, activation_module, build_dense_stack, ensure_int_list, split_indices, validate_strategy
+from distributed_common import DataParallelShard, data_parallel_fit, distributed_options, epoch_context, in_data_parallel_rank, shard_indices
+from parallel_common import uses_model_threads, validate_num_threads
+from stream_common import ChunkStream, split_rows, stream_options, stream_or_array
+from torch_common import ExportGraph, FitTelemetry, ForwardCompiler, LossAccumulator, TrainingCheckpoint, as_float32_array, batch_iterator, batched_inference, checkpoint_options, export_model, input_tensor, load_model, partial_fit_args, profiling, save_model, serializable, validate_batch_engine, validate_loss_weighting
 
 
 class VariationalAutoencoder(nn.Module):
@@ -75,6 +77,7 @@ def _vae_loss(outputs, inputs, mean, var, reconstruction_loss: str = "bce"):
     return reproduction_loss + kld
 
 
+@serializable
 class VariationalAutoencoderModel:
     def __init__(
         self,
@@ -88,8 +91,13 @@ class VariationalAutoencoderModel:
         reconstruction_loss: str = "bce",
         validation_strategy: str = "static",
         stopping_rule: str = "none",
+        compile: bool = False,
+        precision: str = "fp32",
+        num_threads: Optional[int] = None,
     ):
         self.validation_strategy, self.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
+        self.compiler = ForwardCompiler(compile, precision)
+        self.num_threads = validate_num_threads(num_threads)
         self.model = VariationalAutoencoder(
             input_size,
             encoding_size,
@@ -103,92 +111,107 @@ class VariationalAutoencoderModel:
         self.train_loss: List[float] = []
         self.val_loss: List[float] = []
         self.epochs_done: int = 0
+        self.telemetry = FitTelemetry()
 
     @staticmethod
     def _array(data):
-        if isinstance(data, pd.DataFrame):
-            return data.to_numpy().astype(np.float32)
-        return np.asarray(data, dtype=np.float32)
+        return as_float32_array(data)
 
-    def _loader(self, array: np.ndarray, batch_size: int, shuffle: bool):
-        tensor = torch.from_numpy(array.astype(np.float32))
-        return DataLoader(TensorDataset(tensor, tensor), batch_size=int(batch_size), shuffle=shuffle, drop_last=False)
+    def _loader(self, array: np.ndarray, batch_size: int, shuffle: bool, batch_engine: str = "tensor", indices=None):
+        if isinstance(array, ChunkStream):
+            return array.batches(batch_size, shuffle, indices)
+        tensor = input_tensor(np.ascontiguousarray(array, dtype=np.float32))
+        return batch_iterator((tensor,), batch_size, shuffle, batch_engine=batch_engine, indices=indices)
 
-    def _run_epoch(self, loader, optimizer: Optional[torch.optim.Optimizer]) -> float:
-        losses: List[float] = []
+    def _run_epoch(self, loader, optimizer: Optional[torch.optim.Optimizer], loss_weighting: str = "batch", shard: Optional[DataParallelShard] = None) -> float:
+        losses = LossAccumulator(loss_weighting)
         if optimizer is None:
             self.model.eval()
             with torch.no_grad():
-                for xb, yb in loader:
-                    out, mean, var = self.model(xb.float())
-                    losses.append(float(_vae_loss(out, yb.float(), mean, var, reconstruction_loss=self.reconstruction_loss).item()))
+                for (xb,) in loader:
+                    out, mean, var = self.compiler(self.model)(xb.float())
+                    losses.add(_vae_loss(out, xb.float(), mean, var, reconstruction_loss=self.reconstruction_loss), xb.size(0))
         else:
-            self.model.train()
-            for xb, yb in loader:
-                optimizer.zero_grad()
-                out, mean, var = self.model(xb.float())
-                loss = _vae_loss(out, yb.float(), mean, var, reconstruction_loss=self.reconstruction_loss)
-                loss.backward()
-                optimizer.step()
-                losses.append(float(loss.item()))
-        return float(np.mean(losses)) if losses else 0.0
+            model = self.model if shard is None else shard.module
+            model.train()
+            with epoch_context(shard):
+                for (xb,) in loader:
+                    optimizer.zero_grad()
+                    out, mean, var = self.compiler(model)(xb.float())
+                    loss = _vae_loss(out, xb.float(), mean, var, reconstruction_loss=self.reconstruction_loss)
+                    loss.backward()
+                    optimizer.step()
+                    losses.add(loss, xb.size(0))
+        if shard is not None:
+            shard.reduce(losses)
+        return losses.value()
 
     def fit(self, data, config: AutoencTrainingConfig):
-        array = self._array(data)
+        array = stream_or_array(data, config.stream, self._array)
+        if config.distributed is not None and not in_data_parallel_rank():
+            return data_parallel_fit(self, array, config, "model", ("train_loss", "val_loss", "epochs_done", "telemetry"))
+        shard = None if config.distributed is None else DataParallelShard(self.model)
         optimizer = torch.optim.Adam(self.model.parameters(), lr=float(config.learning_rate))
-        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value)
-        self.train_loss = []
-        self.val_loss = []
-        self.epochs_done = 0
+        stopper = StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value, lazy_best=config.lazy_best)
+        if not config.warm_start:
+            self.train_loss = []
+            self.val_loss = []
+            self.epochs_done = 0
+        self.telemetry = FitTelemetry(compiler=self.compiler)
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, ("train_loss", "val_loss", "epochs_done"), {"model": self.model}, warm_start=config.warm_start, keep_state=config.keep_training_state)
+        checkpoint.begin()
 
         if self.validation_strategy == "static" and self.stopping_rule != "none":
-            train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-            train_loader = self._loader(array[train_idx], config.batch_size, True)
-            val_loader = self._loader(array[val_idx], config.batch_size, False)
+            train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=shard_indices(shard, train_idx, len(array)))
+            val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=shard_indices(shard, val_idx, len(array)))
         elif self.validation_strategy == "static":
-            train_loader = self._loader(array, config.batch_size, True)
+            train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=shard_indices(shard, None, len(array)))
             val_loader = None
         else:
             train_loader = None
             val_loader = None
 
-        for epoch in range(int(config.num_epochs)):
+        for epoch in checkpoint.epochs(int(config.num_epochs), {"optimizer": optimizer}, stopper):
+            self.telemetry.start_epoch()
             self.epochs_done += 1
             if self.validation_strategy == "dynamic":
-                train_idx, val_idx = split_indices(array.shape[0], config.val_ratio)
-                train_loader = self._loader(array[train_idx], config.batch_size, True)
-                val_loader = self._loader(array[val_idx], config.batch_size, False)
-            self.train_loss.append(self._run_epoch(train_loader, optimizer))
+                train_idx, val_idx = split_rows(array, len(array), config.val_ratio, split_indices)
+                train_loader = self._loader(array, config.batch_size, True, config.batch_engine, indices=shard_indices(shard, train_idx, len(array)))
+                val_loader = self._loader(array, config.batch_size, False, config.batch_engine, indices=shard_indices(shard, val_idx, len(array)))
+            self.train_loss.append(self._run_epoch(self.telemetry.batches(train_loader), optimizer, config.loss_weighting, shard))
             if val_loader is not None:
-                val_loss = self._run_epoch(val_loader, None)
+                with self.telemetry.phase("validation"):
+                    val_loss = self._run_epoch(val_loader, None, config.loss_weighting, shard)
                 self.val_loss.append(val_loss)
-                if stopper.step(self.model, val_loss):
+                with self.telemetry.phase("snapshot"):
+                    stop = stopper.step(self.model, val_loss)
+                if shard is not None:
+                    stop = shard.agree(stop)
+                if stop:
                     break
+        self.telemetry.stop()
+        checkpoint.close()
         if stopper.best_state is not None:
             self.model.load_state_dict(stopper.best_state)
         return self
 
     def encode(self, data, batch_size=32):
-        array = self._array(data)
-        loader = self._loader(array, batch_size, False)
-        outs = []
         self.model.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                _, mean, var = self.model(xb.float())
-                outs.append(np.concatenate([mean.detach().numpy(), var.detach().numpy()], axis=1))
-        return np.concatenate(outs, axis=0)
+        model = self.compiler(self.model)
+        return batched_inference(lambda xb: torch.cat(model(xb)[1:], dim=1), self._array(data), batch_size)
 
     def encode_decode(self, data, batch_size=32):
-        array = self._array(data)
-        loader = self._loader(array, batch_size, False)
-        outs = []
         self.model.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                decoded, _, _ = self.model(xb.float())
-                outs.append(decoded.detach().numpy())
-        return np.concatenate(outs, axis=0)
+        model = self.compiler(self.model)
+        return batched_inference(lambda xb: model(xb)[0], self._array(data), batch_size)
+
+    def _export_graphs(self):
+        args = self.init_args
+        return {
+            "encoder": ExportGraph(self.model, (args["input_size"],), method="encode"),
+            "decoder": ExportGraph(self.model, (args["encoding_size"],), method="decode"),
+        }
 
 
 def autoenc_variational_create(
@@ -202,7 +225,19 @@ def autoenc_variational_create(
     reconstruction_loss="bce",
     validation_strategy="static",
     stopping_rule="none",
+    compile=False,
+    precision="fp32",
+    num_threads=None,
 ):
+    """Create a variational autoencoder.
+
+    ``compile=True`` runs the forwards through ``torch.compile`` and
+    ``precision="bf16"`` under bfloat16 autocast. The telemetry of every fit
+    then holds ``compile``: graphs built and the seconds spent compiling, in
+    compiled steps and in eager fallback, to judge whether compiling pays off;
+    ``model.compiler.report()`` has the same counters over the model's
+    lifetime, predictions included.
+    """
     return VariationalAutoencoderModel(
         input_size,
         encoding_size,
@@ -214,10 +249,14 @@ def autoenc_variational_create(
         reconstruction_loss=reconstruction_loss,
         validation_strategy=validation_strategy,
         stopping_rule=stopping_rule,
+        compile=compile,
+        precision=precision,
+        num_threads=num_threads,
     )
 
 
-def autoenc_variational_fit(vae, data, batch_size=32, num_epochs=100, learning_rate=0.001, validation_strategy="static", stopping_rule="none", val_ratio=0.3, patience=100, min_delta=1e-4, sma_window=5, ema_alpha=0.2, test_window=30, p_value=0.05):
+@uses_model_threads
+def autoenc_variational_fit(vae, data, batch_size=32, num_epochs=100, learning_rate=0.001, validation_strategy="static", stopping_rule="none", val_ratio=0.3, patience=100, min_delta=1e-4, sma_window=5, ema_alpha=0.2, test_window=30, p_value=0.05, batch_engine="tensor", loss_weighting="batch", lazy_best=False, profile=None, checkpoint=None, distributed=None, stream=None, warm_start=False, keep_training_state=True):
     vae.validation_strategy, vae.stopping_rule = validate_strategy(validation_strategy, stopping_rule)
     config = AutoencTrainingConfig(
         batch_size=int(batch_size),
@@ -232,14 +271,43 @@ def autoenc_variational_fit(vae, data, batch_size=32, num_epochs=100, learning_r
         ema_alpha=float(ema_alpha),
         test_window=int(test_window),
         p_value=float(p_value),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+        checkpoint=checkpoint_options(checkpoint),
+        distributed=distributed_options(distributed),
+        stream=stream_options(stream),
+        warm_start=bool(warm_start),
+        keep_training_state=bool(keep_training_state),
     )
-    vae.fit(data, config)
-    return vae, np.array(vae.train_loss), np.array(vae.val_loss)
+    with profiling(profile, "autoenc_variational_fit", steps=True):
+        vae.fit(data, config)
+    return vae, np.array(vae.train_loss), np.array(vae.val_loss), vae.telemetry.as_dict()
+
+
+def autoenc_variational_partial_fit(vae, data, num_epochs=1, **kwargs):
+    return autoenc_variational_fit(vae, data, num_epochs=num_epochs, **partial_fit_args(vae, kwargs))
+
+
+@uses_model_threads
+def autoenc_variational_encode(vae, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_variational_encode"):
+        return vae.encode(data, batch_size=batch_size)
+
+
+@uses_model_threads
+def autoenc_variational_encode_decode(vae, data, batch_size=32, profile=None):
+    with profiling(profile, "autoenc_variational_encode_decode"):
+        return vae.encode_decode(data, batch_size=batch_size)
+
+
+def autoenc_variational_save(vae, path, include_training_state=False):
+    return save_model(vae, path, include_training_state=include_training_state)
 
 
-def autoenc_variational_encode(vae, data, batch_size=32):
-    return vae.encode(data, batch_size=batch_size)
+def autoenc_variational_load(path, mmap=True):
+    return load_model(path, VariationalAutoencoderModel, mmap=mmap)
 
 
-def autoenc_variational_encode_decode(vae, data, batch_size=32):
-    return vae.encode_decode(data, batch_size=batch_size)
+def autoenc_variational_export(vae, path, formats=("torchscript", "onnx"), opset=17):
+    return export_model(vae, path, formats=formats, opset=opset)
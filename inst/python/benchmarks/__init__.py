@@ -0,0 +1,6 @@
+"""
+Benchmarks for the daltoolboxdp Python backends.
+
+Run from ``inst/python`` so the backend modules are importable, e.g.
+``python -m benchmarks.batching``.
+"""
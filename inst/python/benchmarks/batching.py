@@ -0,0 +1,65 @@
+"""
+Epoch-time comparison between the tensor and DataLoader batch engines.
+
+Usage (from inst/python):
+  python -m benchmarks.batching --rows 100000 --cols 32 --epochs 3
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from autoenc import DenseAutoencoderModel
+from torch_common import BATCH_ENGINES, batch_iterator
+
+
+def time_iteration(array: np.ndarray, batch_engine: str, batch_size: int, epochs: int) -> float:
+    loader = batch_iterator((torch.from_numpy(array),), batch_size, True, batch_engine=batch_engine)
+    timings = []
+    for _ in range(int(epochs)):
+        start = time.perf_counter()
+        for _batch in loader:
+            pass
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def time_epochs(array: np.ndarray, batch_engine: str, batch_size: int, epochs: int) -> float:
+    model = DenseAutoencoderModel(array.shape[1], max(2, array.shape[1] // 4))
+    optimizer = torch.optim.Adam(model.model.parameters(), lr=1e-3)
+    criterion = nn.MSELoss()
+    loader = batch_iterator((torch.from_numpy(array),), batch_size, True, batch_engine=batch_engine)
+    timings = []
+    for _ in range(int(epochs)):
+        start = time.perf_counter()
+        model._run_epoch(loader, optimizer, criterion)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--cols", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    torch.manual_seed(0)
+    array = np.random.default_rng(0).random((args.rows, args.cols), dtype=np.float32)
+    result = {"rows": args.rows, "cols": args.cols, "batch_size": args.batch_size, "iteration_seconds": {}, "epoch_seconds": {}}
+    for engine in sorted(BATCH_ENGINES):
+        result["iteration_seconds"][engine] = time_iteration(array, engine, args.batch_size, args.epochs)
+        result["epoch_seconds"][engine] = time_epochs(array, engine, args.batch_size, args.epochs)
+    result["iteration_speedup"] = result["iteration_seconds"]["dataloader"] / result["iteration_seconds"]["tensor"]
+    result["epoch_speedup"] = result["epoch_seconds"]["dataloader"] / result["epoch_seconds"]["tensor"]
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Training throughput of the dense and variational autoencoders by number of gloo ranks.
+
+Each world size fits the same synthetic array for a few epochs with
+``distributed=`` (1 rank trains in the calling process without a process
+group) and reports the wall time, the rows per second of the training passes
+and the final training loss. Use ``--threads`` to fix the torch threads per
+rank, e.g. ``--ranks 1,2,4,8 --threads 8`` on a 64-core host. Correctness
+(1 rank against the in-process fit, N-rank convergence, stop agreement) is
+checked by ``benchmarks.data_parallel_check``.
+
+Usage (from inst/python):
+  python -m benchmarks.data_parallel --rows 1000000 --cols 64 --ranks 1,2,4
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def measure(model: str, X: np.ndarray, ranks: int, threads: int, epochs: int, batch_size: int) -> dict:
+    import autoenc
+    import autoenc_variational
+
+    np.random.seed(0)
+    module, prefix = (autoenc, "autoenc") if model == "autoenc" else (autoenc_variational, "autoenc_variational")
+    created = getattr(module, f"{prefix}_create")(X.shape[1], max(2, X.shape[1] // 8))
+    distributed = None if ranks == 1 else {"world_size": ranks, "threads_per_rank": threads}
+    if distributed is None:
+        import torch
+
+        torch.set_num_threads(threads)
+    start = time.perf_counter()
+    _, train_loss, _, telemetry = getattr(module, f"{prefix}_fit")(created, X, batch_size=batch_size, num_epochs=epochs, distributed=distributed)
+    seconds = time.perf_counter() - start
+    # Rank 0 measured its own shard; every rank trains the same number of rows.
+    rows_per_second = float(np.median(telemetry["samples_per_second"])) * ranks
+    return {"ranks": ranks, "threads_per_rank": threads, "seconds": seconds, "rows_per_second": rows_per_second, "final_train_loss": float(train_loss[-1])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("models", nargs="*", default=["autoenc", "autoenc_variational"])
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--cols", type=int, default=64)
+    parser.add_argument("--ranks", default="1,2")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args(argv)
+
+    X = np.random.default_rng(0).random((args.rows, args.cols), dtype=np.float32)
+    result = {"rows": args.rows, "cols": args.cols, "models": {}}
+    for model in args.models:
+        result["models"][model] = [measure(model, X, int(r), args.threads, args.epochs, args.batch_size) for r in args.ranks.split(",")]
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Correctness check for ``distributed=`` training of the dense and variational autoencoders.
+
+For each model and validation/stopping setting the same seeded fit runs in
+the calling process and with ``distributed=``:
+
+- one rank must reproduce the in-process fit exactly (loss histories and
+  weights);
+- ``--ranks`` ranks must reach the in-process final training (and
+  validation) loss within ``--rtol``; they average the gradients of
+  ``--ranks`` shards, so they take fewer, larger steps and only the
+  converged loss is comparable;
+- with an early stopping rule every rank must stop after the same epoch:
+  ``data_parallel_fit`` gathers each rank's epoch count and raises when
+  they differ, and the histories must match that count. A forced stop
+  (``min_delta`` larger than any improvement) must also end after the same
+  epoch as the in-process fit.
+
+The run fails (non-zero exit) on any violation.
+
+Usage (from inst/python):
+  python -m benchmarks.data_parallel_check --ranks 2 --epochs 20
+"""
+
+import argparse
+import json
+
+import numpy as np
+import torch
+
+import autoenc
+import autoenc_variational
+
+
+MODELS = {"autoenc": autoenc, "autoenc_variational": autoenc_variational}
+# (label, validation strategy, stopping rule, overrides). "forced_stop" ends after the
+# second epoch, long before convergence, so only its stop epoch is compared.
+SETTINGS = (
+    ("static/none", "static", "none", None),
+    ("static/patience", "static", "patience", None),
+    ("dynamic/h", "dynamic", "h", None),
+    ("forced_stop", "static", "patience", {"patience": 1, "min_delta": 1e9}),
+)
+
+
+def _fit(name: str, X: np.ndarray, distributed, **kwargs):
+    module = MODELS[name]
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model = getattr(module, f"{name}_create")(X.shape[1], max(2, X.shape[1] // 4))
+    fitted, train_loss, val_loss, _ = getattr(module, f"{name}_fit")(model, X, distributed=distributed, **kwargs)
+    return fitted, list(train_loss), list(val_loss)
+
+
+def _same_weights(a, b) -> bool:
+    return all(torch.equal(x, y) for x, y in zip(a.model.state_dict().values(), b.model.state_dict().values()))
+
+
+def _relative(a: float, b: float) -> float:
+    return abs(a - b) / max(abs(b), 1e-12)
+
+
+def check(name: str, X: np.ndarray, ranks: int, epochs: int, batch_size: int, rtol: float) -> dict:
+    entry, violations = {}, []
+    for setting, strategy, rule, overrides in SETTINGS:
+        kwargs = dict(num_epochs=epochs, batch_size=batch_size, validation_strategy=strategy, stopping_rule=rule, patience=3, min_delta=1e-4)
+        kwargs.update(overrides or {})
+        label = f"{name} {setting}"
+        local, local_train, local_val = _fit(name, X, None, **kwargs)
+        one, one_train, one_val = _fit(name, X, 1, **kwargs)
+        if one_train != local_train or one_val != local_val or not _same_weights(one, local):
+            violations.append(f"{label}: world_size=1 differs from the in-process fit")
+        try:
+            many, many_train, many_val = _fit(name, X, {"world_size": ranks, "threads_per_rank": 1}, **kwargs)
+        except RuntimeError as exc:
+            violations.append(f"{label}: {exc}")
+            continue
+        if not (many.epochs_done == len(many_train) and (not many_val or len(many_val) == many.epochs_done)):
+            violations.append(f"{label}: histories do not match the {many.epochs_done} epochs run")
+        drift = {"train": _relative(many_train[-1], local_train[-1])}
+        if local_val and many_val:
+            drift["val"] = _relative(min(many_val), min(local_val))
+        if overrides is not None:
+            if many.epochs_done != len(local_train):
+                violations.append(f"{label}: {ranks} ranks stopped after {many.epochs_done} epochs, the in-process fit after {len(local_train)}")
+        else:
+            violations.extend(f"{label}: {ranks}-rank {kind} loss drift {value:.4f} > {rtol}" for kind, value in drift.items() if value > rtol)
+        entry[setting] = {
+            "epochs": {"local": len(local_train), "ranks": many.epochs_done},
+            "final_train_loss": {"local": local_train[-1], "ranks": many_train[-1]},
+            "loss_drift": drift,
+        }
+    return {"settings": entry, "violations": violations}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("models", nargs="*", default=sorted(MODELS))
+    parser.add_argument("--rows", type=int, default=4000)
+    parser.add_argument("--cols", type=int, default=16)
+    parser.add_argument("--ranks", type=int, default=2)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--rtol", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    X = np.random.default_rng(0).random((args.rows, args.cols), dtype=np.float32)
+    result = {"rows": args.rows, "cols": args.cols, "ranks": args.ranks, "epochs": args.epochs, "models": {}, "violations": []}
+    for name in args.models:
+        entry = check(name, X, args.ranks, args.epochs, args.batch_size, args.rtol)
+        result["violations"].extend(entry.pop("violations"))
+        result["models"][name] = entry
+    print(json.dumps(result, indent=2))
+    if result["violations"]:
+        raise SystemExit(1)
+    return result
+
+
+if __name__ == "__main__":
+    main()
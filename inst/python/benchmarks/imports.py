@@ -0,0 +1,103 @@
+"""
+Import-time comparison between re-sourcing a backend and the dp_backend registry.
+
+``source_python`` executes the module file on every wrapper call; the registry
+imports it once per session. Each module is measured in a fresh interpreter so
+the cold import cost (torch, sklearn, ...) is included. ``--check`` enforces the
+cold-start budget: a wall-clock ceiling per backend family and the heavy
+packages it may load (sklearn classifiers must not import torch, torch backends
+must not import scipy or pandas).
+
+Usage (from inst/python):
+  python -m benchmarks.imports --calls 20 autoenc torch_cla_mlp skcla_nb
+  python -m benchmarks.imports --check
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import dp_backend
+
+
+HEAVY_PACKAGES = ("torch", "pandas", "scipy", "sklearn", "imblearn")
+
+# Backend family prefix -> (heavy packages a cold import may load, seconds).
+# Measured at ~2.5s for torch backends and ~1.8-2.0s for sklearn/imblearn ones
+# on a single-CPU machine; the ceilings leave headroom for slower disks.
+COLD_START_BUDGETS = {
+    "autoenc": ({"torch"}, 4.0),
+    "torch_": ({"torch"}, 4.0),
+    "ts_": ({"torch"}, 4.0),
+    "skcla_": ({"pandas", "scipy", "sklearn"}, 3.0),
+    "skimb_": ({"pandas", "scipy", "sklearn", "imblearn"}, 3.5),
+}
+
+
+_PROBE = r"""
+import json, runpy, sys, time
+sys.path.insert(0, {path!r})
+name, calls = {name!r}, {calls}
+start = time.perf_counter()
+import dp_backend
+dp_backend.load(name)
+cold = time.perf_counter() - start
+heavy = [p for p in {heavy!r} if p in sys.modules]
+start = time.perf_counter()
+for _ in range(calls):
+    dp_backend.load(name)
+registry = (time.perf_counter() - start) / calls
+start = time.perf_counter()
+for _ in range(calls):
+    runpy.run_path({file!r})
+sourced = (time.perf_counter() - start) / calls
+print(json.dumps({{"cold_import_seconds": cold, "registry_call_seconds": registry, "source_call_seconds": sourced, "heavy_packages": heavy}}))
+"""
+
+
+def measure(name: str, calls: int) -> dict:
+    code = _PROBE.format(
+        path=dp_backend.PYTHON_DIR,
+        name=name,
+        calls=int(calls),
+        heavy=HEAVY_PACKAGES,
+        file=os.path.join(dp_backend.PYTHON_DIR, f"{name}.py"),
+    )
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result["source_over_registry"] = result["source_call_seconds"] / max(result["registry_call_seconds"], 1e-12)
+    return result
+
+
+def budget_violations(name: str, result: dict) -> list:
+    family = max((p for p in COLD_START_BUDGETS if name.startswith(p)), key=len, default=None)
+    if family is None:
+        return []
+    allowed, seconds = COLD_START_BUDGETS[family]
+    violations = [f"{name} imports {p}" for p in result["heavy_packages"] if p not in allowed]
+    if result["cold_import_seconds"] > seconds:
+        violations.append(f"{name} cold import took {result['cold_import_seconds']:.2f}s (budget {seconds:.2f}s)")
+    return violations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=list(dp_backend.BACKEND_MODULES))
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--check", action="store_true", help="exit non-zero when a module exceeds its cold-start budget")
+    args = parser.parse_args(argv)
+
+    result = {"calls": args.calls, "modules": {}, "violations": []}
+    for name in args.modules:
+        result["modules"][name] = measure(name, args.calls)
+        result["violations"].extend(budget_violations(name, result["modules"][name]))
+    print(json.dumps(result, indent=2))
+    if args.check and result["violations"]:
+        raise SystemExit(1)
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Memory cost of turning training inputs into model arrays, before and after ``ingest_common``.
+
+For a float32 numpy array (target in the last column), a float64 DataFrame
+and an Arrow table (target column ``t0``), the feature block and target are
+extracted once the way the backends used to (``drop(columns=...)``,
+``to_numpy()``, ``astype(np.float32)``, and for the sklearn wrappers
+``pd.DataFrame`` plus ``fillna(0)``) and once with
+``feature_matrix``/``column_array``. Peak
+allocations are traced with ``tracemalloc`` (numpy and pandas buffers are
+included) and reported in MB and in multiples of the float32 feature block.
+
+Usage (from inst/python):
+  python -m benchmarks.ingestion --rows 1000000 --cols 64
+"""
+
+import argparse
+import gc
+import json
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from ingest_common import column_array, feature_matrix
+
+
+def _frame(data):
+    return data.to_pandas() if hasattr(data, "to_pandas") else pd.DataFrame(data)
+
+
+def _legacy_torch(data, target):
+    df = _frame(data)
+    X = df.drop(columns=[target]).to_numpy().astype(np.float32)
+    y = df[target].to_numpy().astype(np.float32)
+    return X, y
+
+
+def _ingest_torch(data, target):
+    return feature_matrix(data, exclude=[target]), column_array(data, target, np.float32)
+
+
+def _legacy_sklearn(data, target):
+    df = pd.DataFrame(_frame(data))
+    X = df.drop(columns=[target])
+    y = df[target].values
+    if X.isnull().values.any():
+        X = X.fillna(0)
+    # sklearn's check_array then reads the frame as one float64 array.
+    return np.asarray(X, dtype=np.float64), y
+
+
+def _ingest_sklearn(data, target):
+    return feature_matrix(data, exclude=[target], dtype=np.float64, fill_value=0.0, order="K"), column_array(data, target)
+
+
+def _peak_mb(fn, data, target) -> float:
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = fn(data, target)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak / 2**20
+
+
+def _inputs(rows: int, cols: int):
+    rng = np.random.default_rng(0)
+    values = rng.random((rows, cols + 1), dtype=np.float32)
+    names = [f"x{i}" for i in range(cols)] + ["t0"]
+    inputs = {
+        "numpy_float32": (values, cols),
+        "pandas_float64": (pd.DataFrame(values.astype(np.float64), columns=names), "t0"),
+    }
+    try:
+        import pyarrow as pa
+
+        inputs["arrow_float32"] = (pa.table({name: values[:, i].copy() for i, name in enumerate(names)}), "t0")
+    except ImportError:  # pyarrow is optional
+        pass
+    return inputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--cols", type=int, default=64)
+    args = parser.parse_args(argv)
+
+    block_mb = args.rows * args.cols * 4 / 2**20
+    result = {"rows": args.rows, "cols": args.cols, "feature_block_mb": block_mb, "inputs": {}}
+    for name, (data, target) in _inputs(args.rows, args.cols).items():
+        entry = {}
+        for path, legacy, ingest in (("torch", _legacy_torch, _ingest_torch), ("sklearn", _legacy_sklearn, _ingest_sklearn)):
+            before, after = _peak_mb(legacy, data, target), _peak_mb(ingest, data, target)
+            entry[path] = {"legacy_mb": before, "ingest_mb": after, "legacy_blocks": before / block_mb, "ingest_blocks": after / block_mb}
+        result["inputs"][name] = entry
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
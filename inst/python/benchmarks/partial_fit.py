@@ -0,0 +1,104 @@
+"""
+Cost of updating a model with new rows: full retraining against ``partial_fit``.
+
+A regression MLP and a dense autoencoder are fitted on an initial block of
+synthetic rows. A new block then arrives and the model is brought up to date
+twice: once by retraining from scratch on all rows for the same number of
+epochs, once by ``partial_fit`` on the new rows only, which continues the
+previous optimizer and stop controller state. Both are timed and scored on a
+held-out block drawn from the same distribution.
+
+Usage (from inst/python):
+  python -m benchmarks.partial_fit --rows 200000 --new-rows 20000 --epochs 20
+"""
+
+import argparse
+import copy
+import json
+import time
+
+import numpy as np
+
+
+def _frame(values: np.ndarray):
+    import pandas as pd
+
+    return pd.DataFrame(values, columns=[f"x{i}" for i in range(values.shape[1] - 1)] + ["t0"])
+
+
+def _score(model: str, fitted, holdout: np.ndarray) -> float:
+    if model == "autoenc":
+        import autoenc
+
+        return float(np.mean((autoenc.autoenc_encode_decode(fitted, holdout, batch_size=4096) - holdout) ** 2))
+    import torch_reg_mlp
+
+    predictions = np.asarray(torch_reg_mlp.torch_reg_mlp_predict(fitted, _frame(holdout), batch_size=4096))
+    return float(np.mean((predictions.reshape(-1) - holdout[:, -1]) ** 2))
+
+
+def _update(model: str, base, data: np.ndarray, epochs: int, batch_size: int, partial: bool):
+    import autoenc
+    import torch_reg_mlp
+
+    start = time.perf_counter()
+    if model == "autoenc":
+        fit = autoenc.autoenc_partial_fit if partial else autoenc.autoenc_fit
+        fitted = fit(base, data, batch_size=batch_size, num_epochs=epochs)[0]
+    else:
+        fit = torch_reg_mlp.torch_reg_mlp_partial_fit if partial else torch_reg_mlp.torch_reg_mlp_fit
+        fitted = fit(base, _frame(data), epochs=epochs, batch_size=batch_size)
+    return fitted, time.perf_counter() - start
+
+
+def measure(model: str, old: np.ndarray, new: np.ndarray, holdout: np.ndarray, epochs: int, partial_epochs: int, batch_size: int) -> dict:
+    import torch
+
+    import autoenc
+    import torch_reg_mlp
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    if model == "autoenc":
+        create = lambda: autoenc.autoenc_create(old.shape[1], max(2, old.shape[1] // 4))
+    else:
+        create = lambda: torch_reg_mlp.torch_reg_mlp_create(old.shape[1] - 1, [64, 32])
+    initial, initial_seconds = _update(model, create(), old, epochs, batch_size, partial=False)
+    retrained, retrain_seconds = _update(model, create(), np.concatenate([old, new]), epochs, batch_size, partial=False)
+    updated, update_seconds = _update(model, copy.deepcopy(initial), new, partial_epochs, batch_size, partial=True)
+    return {
+        "initial": {"seconds": initial_seconds, "holdout_mse": _score(model, initial, holdout)},
+        "retrain_all_rows": {"seconds": retrain_seconds, "holdout_mse": _score(model, retrained, holdout)},
+        "partial_fit_new_rows": {"seconds": update_seconds, "holdout_mse": _score(model, updated, holdout)},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("models", nargs="*", default=["torch_reg_mlp", "autoenc"])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--new-rows", type=int, default=10_000)
+    parser.add_argument("--cols", type=int, default=16)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--partial-epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    weights = rng.normal(size=args.cols)
+
+    def block(n: int) -> np.ndarray:
+        X = rng.normal(size=(n, args.cols)).astype(np.float32)
+        y = np.tanh(X @ weights / np.sqrt(args.cols)) + 0.05 * rng.normal(size=n)
+        return np.column_stack([X, y]).astype(np.float32)
+
+    old, new, holdout = block(args.rows), block(args.new_rows), block(args.new_rows)
+    result = {"rows": args.rows, "new_rows": args.new_rows, "epochs": args.epochs, "partial_epochs": args.partial_epochs, "models": {}}
+    for model in args.models:
+        result["models"][model] = measure(model, old, new, holdout, args.epochs, args.partial_epochs, args.batch_size)
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
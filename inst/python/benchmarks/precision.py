@@ -0,0 +1,115 @@
+"""
+Accuracy-drift check for ``precision="bf16"`` against float32 training.
+
+Each model is trained twice from the same seed, once in fp32 and once under
+bfloat16 autocast, and the final training loss and the encode/predict outputs
+are compared. The run fails (non-zero exit) when the relative loss drift or
+the output drift exceeds its bound.
+
+Usage (from inst/python):
+  python -m benchmarks.precision --rows 2000 --epochs 5
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+import autoenc
+import torch_cla_mlp
+import torch_reg_mlp
+import ts_lstm
+
+
+def _seed():
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+
+def run_autoenc(X: np.ndarray, precision: str, epochs: int):
+    _seed()
+    model = autoenc.autoenc_create(X.shape[1], max(2, X.shape[1] // 4), precision=precision)
+    autoenc.autoenc_fit(model, X, num_epochs=epochs, batch_size=64)
+    return model.train_loss[-1], autoenc.autoenc_encode_decode(model, X)
+
+
+def run_cla(X: np.ndarray, precision: str, epochs: int):
+    _seed()
+    df = pd.DataFrame(X)
+    df["y"] = np.where(X[:, 0] + X[:, 1] > 1.0, "a", "b")
+    model = torch_cla_mlp.torch_cla_mlp_create(X.shape[1], [32, 16], 2, precision=precision)
+    torch_cla_mlp.torch_cla_mlp_fit(model, df, "y", epochs=epochs, batch_size=64)
+    return model.train_loss_hist[-1], np.asarray(torch_cla_mlp.torch_cla_mlp_predict_scores(model, df.drop(columns=["y"])))
+
+
+def run_reg(X: np.ndarray, precision: str, epochs: int):
+    _seed()
+    df = pd.DataFrame(X)
+    df["t0"] = X.sum(axis=1) / X.shape[1]
+    model = torch_reg_mlp.torch_reg_mlp_create(X.shape[1], [32, 16], precision=precision)
+    torch_reg_mlp.torch_reg_mlp_fit(model, df, target_col="t0", epochs=epochs, batch_size=64)
+    return model.train_loss_hist[-1], torch_reg_mlp.torch_reg_mlp_predict(model, df, target_col="t0")
+
+
+def run_ts_lstm(X: np.ndarray, precision: str, epochs: int):
+    _seed()
+    df = pd.DataFrame(X[:, :8], columns=[f"t{i}" for i in range(8, 0, -1)])
+    df["t0"] = X[:, :8].mean(axis=1)
+    model = ts_lstm.ts_lstm_create(16, 8, precision=precision)
+    ts_lstm.ts_lstm_fit(model, df, n_epochs=epochs, batch_size=64)
+    return model.train_loss_hist[-1], ts_lstm.ts_lstm_predict(model, df)
+
+
+MODELS = {
+    "autoenc": run_autoenc,
+    "torch_cla_mlp": run_cla,
+    "torch_reg_mlp": run_reg,
+    "ts_lstm": run_ts_lstm,
+}
+
+
+def compare(name: str, X: np.ndarray, epochs: int) -> dict:
+    result = {}
+    outputs = {}
+    for precision in ("fp32", "bf16"):
+        start = time.perf_counter()
+        loss, out = MODELS[name](X, precision, epochs)
+        result[f"{precision}_seconds"] = time.perf_counter() - start
+        result[f"{precision}_loss"] = float(loss)
+        outputs[precision] = np.asarray(out, dtype=np.float64)
+    result["loss_drift"] = abs(result["bf16_loss"] - result["fp32_loss"]) / max(abs(result["fp32_loss"]), 1e-12)
+    scale = max(float(np.abs(outputs["fp32"]).max()), 1e-12)
+    result["output_drift"] = float(np.abs(outputs["bf16"] - outputs["fp32"]).max()) / scale
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("models", nargs="*", default=sorted(MODELS))
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--cols", type=int, default=16)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--max-loss-drift", type=float, default=0.05)
+    parser.add_argument("--max-output-drift", type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    X = np.random.default_rng(0).random((args.rows, args.cols), dtype=np.float32)
+    result = {"rows": args.rows, "cols": args.cols, "epochs": args.epochs, "models": {}, "violations": []}
+    for name in args.models:
+        entry = compare(name, X, args.epochs)
+        result["models"][name] = entry
+        if entry["loss_drift"] > args.max_loss_drift:
+            result["violations"].append(f"{name} loss drift {entry['loss_drift']:.4f} > {args.max_loss_drift}")
+        if entry["output_drift"] > args.max_output_drift:
+            result["violations"].append(f"{name} output drift {entry['output_drift']:.4f} > {args.max_output_drift}")
+    print(json.dumps(result, indent=2))
+    if result["violations"]:
+        raise SystemExit(1)
+    return result
+
+
+if __name__ == "__main__":
+    main()
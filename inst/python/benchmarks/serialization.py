@@ -0,0 +1,86 @@
+"""
+Load-time comparison of memory-mapped and copied weights for saved models.
+
+A dense autoencoder and a Conv1D forecaster are saved with ``*_save``; each
+is then loaded in a fresh interpreter (torch already imported) with
+``mmap=True`` and ``mmap=False``, reporting the load time, the first
+prediction time and the growth of the resident set.
+
+Usage (from inst/python):
+  python -m benchmarks.serialization --cols 512 --hidden 2048
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+
+_PROBE = r"""
+import json, sys, time
+sys.path.insert(0, {path!r})
+import numpy as np, torch, psutil
+import {module}
+process = psutil.Process()
+X = np.random.default_rng(0).random((256, {cols}), dtype=np.float32)
+rss = process.memory_info().rss
+start = time.perf_counter()
+model = {module}.{module}_load({target!r}, mmap={mmap})
+loaded = time.perf_counter()
+{predict}
+done = time.perf_counter()
+print(json.dumps({{"load_ms": 1000 * (loaded - start), "first_predict_ms": 1000 * (done - loaded), "rss_growth_mb": (process.memory_info().rss - rss) / 2**20}}))
+"""
+
+_MODELS = {
+    "autoenc": "autoenc.autoenc_encode(model, X, batch_size=256)",
+    "ts_conv1d": "import pandas as pd; ts_conv1d.ts_conv1d_predict(model, pd.DataFrame(X), batch_size=256)",
+}
+
+
+def _save(name: str, cols: int, hidden: int, target: str):
+    if name == "autoenc":
+        import autoenc
+
+        model = autoenc.autoenc_create(cols, max(2, cols // 8), encoder_hidden_sizes=[hidden, hidden // 2])
+        autoenc.autoenc_save(model, target)
+    else:
+        import ts_conv1d
+
+        model = ts_conv1d.ts_conv1d_create(1, cols, conv_channels=[64, 64], dense_hidden_sizes=[hidden])
+        ts_conv1d.ts_conv1d_save(model, target)
+
+
+def measure(name: str, cols: int, hidden: int, directory: str) -> dict:
+    target = os.path.join(directory, name)
+    _save(name, cols, hidden, target)
+    result = {"weights_mb": os.path.getsize(os.path.join(target, "weights.bin")) / 2**20}
+    for mmap in (True, False):
+        code = _PROBE.format(path=os.getcwd(), module=name, cols=cols, target=target, mmap=mmap, predict=_MODELS[name])
+        out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+        result["mmap" if mmap else "copy"] = json.loads(out.stdout.strip().splitlines()[-1])
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("models", nargs="*", default=sorted(_MODELS))
+    parser.add_argument("--cols", type=int, default=512)
+    parser.add_argument("--hidden", type=int, default=2048)
+    args = parser.parse_args(argv)
+
+    np.random.seed(0)
+    result = {"cols": args.cols, "hidden": args.hidden, "models": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.models:
+            result["models"][name] = measure(name, args.cols, args.hidden, directory)
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Memory and throughput of streamed (out-of-core) fits against in-memory fits.
+
+A synthetic float32 matrix is written to a ``.npy`` file and a Parquet file
+(target column ``t0`` last). The dense autoencoder and the regression MLP are
+then fitted once from the array loaded into memory (a DataFrame for the MLP)
+and once from each file path with ``stream=``. Peak allocations, loading
+included, are traced with ``tracemalloc`` (numpy buffers included; the pages
+of a memory map belong to the page cache and are not counted) and reported
+next to the training rows per second.
+
+Every fit holds out a validation split, and the training rows of each pass
+are reported too. ``--check`` fails (non-zero exit) when a streamed fit
+trains on a different number of rows than the in-memory fit, e.g. a split
+that holds out whole chunks of a file smaller than two chunks.
+
+Usage (from inst/python):
+  python -m benchmarks.streaming --rows 2000000 --cols 64 --chunk-rows 65536
+  python -m benchmarks.streaming --rows 100000 --chunk-rows 65536 --check
+"""
+
+import argparse
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def _fit(kind: str, load, cols: int, epochs: int, batch_size: int, stream) -> dict:
+    import torch
+
+    import autoenc
+    import torch_reg_mlp
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    data = load()
+    if kind == "autoenc":
+        model = autoenc.autoenc_create(cols + 1, max(2, cols // 8))
+        _, train_loss, _, telemetry = autoenc.autoenc_fit(model, data, batch_size=batch_size, num_epochs=epochs, stopping_rule="patience", stream=stream)
+    else:
+        model = torch_reg_mlp.torch_reg_mlp_create(cols, [64])
+        model = torch_reg_mlp.torch_reg_mlp_fit(model, data, target_col="t0", epochs=epochs, batch_size=batch_size, stopping_rule="patience", stream=stream)
+        train_loss, telemetry = model.train_loss_hist, model.telemetry.as_dict()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "seconds": seconds,
+        "peak_mb": peak / 2**20,
+        "rows_per_second": float(np.median(telemetry["samples_per_second"])),
+        "final_train_loss": float(train_loss[-1]),
+        "train_rows": int(telemetry["samples"][0]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("models", nargs="*", default=["autoenc", "torch_reg_mlp"])
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--cols", type=int, default=64)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--chunk-rows", type=int, default=65536)
+    parser.add_argument("--buffer-rows", type=int, default=None)
+    parser.add_argument("--check", action="store_true", help="exit non-zero when a streamed fit trains on other rows than the in-memory fit")
+    args = parser.parse_args(argv)
+
+    values = np.random.default_rng(0).random((args.rows, args.cols + 1), dtype=np.float32)
+    names = [f"x{i}" for i in range(args.cols)] + ["t0"]
+    stream = {"chunk_rows": args.chunk_rows, "columns": names}
+    if args.buffer_rows is not None:
+        stream["buffer_rows"] = args.buffer_rows
+    result = {"rows": args.rows, "cols": args.cols, "data_mb": values.nbytes / 2**20, "stream": stream, "models": {}, "violations": []}
+    with tempfile.TemporaryDirectory(prefix="stream-") as directory:
+        sources = {"npy": os.path.join(directory, "data.npy")}
+        np.save(sources["npy"], values)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            sources["parquet"] = os.path.join(directory, "data.parquet")
+            pq.write_table(pa.table({name: values[:, i] for i, name in enumerate(names)}), sources["parquet"], row_group_size=4 * args.chunk_rows)
+        except ImportError:  # pyarrow is optional
+            pass
+        del values
+        for model in args.models:
+            if model == "autoenc":
+                load = lambda: np.load(sources["npy"])
+            else:
+                import pandas as pd
+
+                load = lambda: pd.DataFrame(np.load(sources["npy"]), columns=names)
+            entry = {"in_memory": _fit(model, load, args.cols, args.epochs, args.batch_size, None)}
+            for name, path in sources.items():
+                entry[name] = _fit(model, lambda path=path: path, args.cols, args.epochs, args.batch_size, stream)
+                if entry[name]["train_rows"] != entry["in_memory"]["train_rows"]:
+                    result["violations"].append(f"{model} {name}: {entry[name]['train_rows']} training rows, {entry['in_memory']['train_rows']} in memory")
+            result["models"][model] = entry
+    print(json.dumps(result, indent=2))
+    if args.check and result["violations"]:
+        raise SystemExit(1)
+    return result
+
+
+if __name__ == "__main__":
+    main()
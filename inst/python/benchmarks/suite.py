@@ -0,0 +1,286 @@
+"""
+Benchmark suite for create/fit/encode/predict across the backend modules.
+
+Every (module, rows, cols) case runs in a fresh interpreter on synthetic
+data, so its peak RSS is its own. Results are written as JSON; when a
+baseline JSON from an earlier run is given, any timing or memory regression
+beyond the tolerance is reported and the run exits non-zero.
+
+Usage (from inst/python):
+  python -m benchmarks.suite --output bench.json
+  python -m benchmarks.suite --rows 1000,1000000 --cols 8,512 autoenc skcla_rf
+  python -m benchmarks.suite --full --output new.json --baseline bench.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak memory is then omitted
+    resource = None
+
+
+DEFAULT_ROWS = (1_000, 10_000)
+DEFAULT_COLS = (8, 64)
+FULL_ROWS = (1_000, 10_000, 100_000, 1_000_000)
+FULL_COLS = (8, 64, 512)
+SEQUENCE_LENGTH = 8
+TIME_METRICS = ("create_seconds", "fit_epoch_seconds", "encode_seconds", "encode_decode_seconds", "predict_seconds")
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def _frame(X: np.ndarray, target: str = None, y=None):
+    import pandas as pd
+
+    df = pd.DataFrame(X, columns=[f"x{i}" for i in range(X.shape[1])])
+    if target is not None:
+        df[target] = y
+    return df
+
+
+def _labels(X: np.ndarray) -> np.ndarray:
+    return np.where(X[:, 0] + X[:, 1] > 1.0, "a", "b")
+
+
+def _autoenc_case(name: str, create_kwargs: Dict = None):
+    def run(X, epochs, batch_size):
+        import importlib
+
+        module = importlib.import_module(name)
+        model, create = _timed(getattr(module, f"{name}_create"), X.shape[1], max(2, X.shape[1] // 4), **(create_kwargs or {}))
+        _, fit = _timed(getattr(module, f"{name}_fit"), model, X, batch_size=batch_size, num_epochs=epochs)
+        _, encode = _timed(getattr(module, f"{name}_encode"), model, X, batch_size=batch_size)
+        _, encode_decode = _timed(getattr(module, f"{name}_encode_decode"), model, X, batch_size=batch_size)
+        return {"create_seconds": create, "fit_epoch_seconds": fit / epochs, "encode_seconds": encode, "encode_decode_seconds": encode_decode}
+
+    return run
+
+
+def _torch_cla_mlp(X, epochs, batch_size):
+    import torch_cla_mlp as m
+
+    df = _frame(X, "y", _labels(X))
+    model, create = _timed(m.torch_cla_mlp_create, X.shape[1], [64, 32], 2)
+    _, fit = _timed(m.torch_cla_mlp_fit, model, df, "y", epochs=epochs, batch_size=batch_size)
+    _, predict = _timed(m.torch_cla_mlp_predict_scores, model, df.drop(columns=["y"]))
+    return {"create_seconds": create, "fit_epoch_seconds": fit / epochs, "predict_seconds": predict}
+
+
+def _torch_regression(name: str):
+    def run(X, epochs, batch_size):
+        import importlib
+
+        module = importlib.import_module(name)
+        df = _frame(X, "t0", X.mean(axis=1))
+        model, create = _timed(getattr(module, f"{name}_create"), X.shape[1], [64, 32])
+        _, fit = _timed(getattr(module, f"{name}_fit"), model, df, epochs=epochs, batch_size=batch_size)
+        _, predict = _timed(getattr(module, f"{name}_predict"), model, df, batch_size=batch_size)
+        return {"create_seconds": create, "fit_epoch_seconds": fit / epochs, "predict_seconds": predict}
+
+    return run
+
+
+def _ts_lstm(X, epochs, batch_size):
+    import ts_lstm as m
+
+    df = _frame(X, "t0", X.mean(axis=1))
+    model, create = _timed(m.ts_lstm_create, 32, X.shape[1], sequence_length=SEQUENCE_LENGTH)
+    _, fit = _timed(m.ts_lstm_fit, model, df, n_epochs=epochs, batch_size=batch_size)
+    _, predict = _timed(m.ts_lstm_predict, model, df, batch_size=batch_size)
+    return {"create_seconds": create, "fit_epoch_seconds": fit / epochs, "predict_seconds": predict}
+
+
+def _ts_conv1d(X, epochs, batch_size):
+    import ts_conv1d as m
+
+    df = _frame(X, "t0", X.mean(axis=1))
+    model, create = _timed(m.ts_conv1d_create, 1, X.shape[1])
+    _, fit = _timed(m.ts_conv1d_fit, model, df, n_epochs=epochs, batch_size=batch_size)
+    _, predict = _timed(m.ts_conv1d_predict, model, df, batch_size=batch_size)
+    return {"create_seconds": create, "fit_epoch_seconds": fit / epochs, "predict_seconds": predict}
+
+
+def _skcla_case(name: str, create_kwargs: Dict = None):
+    def run(X, epochs, batch_size):
+        import importlib
+
+        module = importlib.import_module(name)
+        df = _frame(X, "y", _labels(X))
+        model, create = _timed(getattr(module, f"{name}_create"), **(create_kwargs or {}))
+        model, fit = _timed(getattr(module, f"{name}_fit"), model, df, "y")
+        _, predict = _timed(getattr(module, f"{name}_predict_proba"), model, df.drop(columns=["y"]))
+        return {"create_seconds": create, "fit_epoch_seconds": fit, "predict_seconds": predict}
+
+    return run
+
+
+def _skimb_case(name: str):
+    def run(X, epochs, batch_size):
+        import importlib
+
+        module = importlib.import_module(name)
+        y = np.where(X[:, 0] > 0.8, "minority", "majority")
+        df = _frame(X, "y", y)
+        model, create = _timed(module.inbalanced_create_model)
+        _, fit = _timed(module.fit_resample, model, df, "y")
+        return {"create_seconds": create, "fit_epoch_seconds": fit}
+
+    return run
+
+
+CASES: Dict[str, Callable] = {
+    "autoenc": _autoenc_case("autoenc"),
+    "autoenc_adv": _autoenc_case("autoenc_adv"),
+    "autoenc_conv": _autoenc_case("autoenc_conv"),
+    "autoenc_denoise": _autoenc_case("autoenc_denoise"),
+    "autoenc_lstm": _autoenc_case("autoenc_lstm", {"sequence_length": SEQUENCE_LENGTH}),
+    "autoenc_stacked": _autoenc_case("autoenc_stacked", {"k": 2}),
+    "autoenc_variational": _autoenc_case("autoenc_variational"),
+    "torch_cla_mlp": _torch_cla_mlp,
+    "torch_reg_mlp": _torch_regression("torch_reg_mlp"),
+    "torch_ts_mlp": _torch_regression("torch_ts_mlp"),
+    "ts_lstm": _ts_lstm,
+    "ts_conv1d": _ts_conv1d,
+    "skcla_gb": _skcla_case("skcla_gb", {"n_estimators": 20}),
+    "skcla_knn": _skcla_case("skcla_knn"),
+    "skcla_mlp": _skcla_case("skcla_mlp", {"max_iter": 20}),
+    "skcla_nb": _skcla_case("skcla_nb"),
+    "skcla_rf": _skcla_case("skcla_rf", {"n_estimators": 20}),
+    "skcla_svc": _skcla_case("skcla_svc"),
+    "skimb_smote": _skimb_case("skimb_smote"),
+    "skimb_smote_tomek": _skimb_case("skimb_smote_tomek"),
+    "skimb_tomek_links": _skimb_case("skimb_tomek_links"),
+}
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in KiB on Linux and in bytes on macOS.
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def run_case(name: str, rows: int, cols: int, epochs: int, batch_size: int) -> Dict:
+    import random
+
+    random.seed(0)
+    np.random.seed(0)
+    if not name.startswith("sk"):
+        import torch
+
+        torch.manual_seed(0)
+    X = np.random.default_rng(0).random((rows, cols), dtype=np.float32)
+    # One-off costs (lazy torch submodules, optimizer and kernel setup) would
+    # otherwise land in whichever step runs first; pay them on a small slice.
+    _, warmup = _timed(CASES[name], X[: min(rows, 256)], 1, batch_size)
+    result = CASES[name](X, epochs, batch_size)
+    result["warmup_seconds"] = warmup
+    for metric in TIME_METRICS:
+        if metric in result:
+            result[metric.replace("_seconds", "_rows_per_second")] = rows / max(result[metric], 1e-12)
+    result["peak_rss_mb"] = _peak_rss_mb()
+    return result
+
+
+def _case_in_subprocess(name: str, rows: int, cols: int, epochs: int, batch_size: int) -> Dict:
+    cmd = [sys.executable, "-m", "benchmarks.suite", "--case", name, str(rows), str(cols), "--epochs", str(epochs), "--batch-size", str(batch_size)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit code {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare(results: Dict, baseline: Dict, time_tolerance: float, memory_tolerance: float, min_seconds: float) -> List[str]:
+    """List the metrics in ``results`` that regressed against ``baseline``."""
+    regressions = []
+    for key, current in results["cases"].items():
+        previous = baseline.get("cases", {}).get(key)
+        if previous is None or "error" in previous:
+            continue
+        if "error" in current:
+            regressions.append(f"{key}: failed ({current['error']})")
+            continue
+        for metric in TIME_METRICS:
+            new, old = current.get(metric), previous.get(metric)
+            if new is None or old is None:
+                continue
+            if new > old * (1.0 + time_tolerance) and new - old > min_seconds:
+                regressions.append(f"{key}: {metric} {old:.4f}s -> {new:.4f}s (+{100.0 * (new / old - 1.0):.0f}%)")
+        new, old = current.get("peak_rss_mb"), previous.get("peak_rss_mb")
+        if new is not None and old is not None and new > old * (1.0 + memory_tolerance):
+            regressions.append(f"{key}: peak_rss_mb {old:.1f} -> {new:.1f} (+{100.0 * (new / old - 1.0):.0f}%)")
+    return regressions
+
+
+def _int_list(text: str) -> List[int]:
+    return [int(float(v)) for v in text.split(",") if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=list(CASES))
+    parser.add_argument("--rows", type=_int_list, default=list(DEFAULT_ROWS))
+    parser.add_argument("--cols", type=_int_list, default=list(DEFAULT_COLS))
+    parser.add_argument("--full", action="store_true", help="use the full 1e3..1e6 rows x 8..512 columns grid")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--output", help="write the results JSON here")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="ignore slowdowns smaller than this")
+    parser.add_argument("--case", nargs=3, metavar=("MODULE", "ROWS", "COLS"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        name, rows, cols = args.case[0], int(args.case[1]), int(args.case[2])
+        print(json.dumps(run_case(name, rows, cols, args.epochs, args.batch_size)))
+        return None
+
+    unknown = sorted(set(args.modules) - set(CASES))
+    if unknown:
+        parser.error(f"unknown modules {unknown}; expected any of {sorted(CASES)}")
+    rows_grid = FULL_ROWS if args.full else args.rows
+    cols_grid = FULL_COLS if args.full else args.cols
+
+    results = {"epochs": args.epochs, "batch_size": args.batch_size, "cases": {}}
+    for name in args.modules:
+        for rows in rows_grid:
+            for cols in cols_grid:
+                key = f"{name}/{rows}x{cols}"
+                results["cases"][key] = _case_in_subprocess(name, rows, cols, args.epochs, args.batch_size)
+                print(key, json.dumps(results["cases"][key]), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.min_seconds)
+        if regressions:
+            print("REGRESSIONS:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            raise SystemExit(1)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Single-host CPU data parallelism for daltoolboxdp fits (``torch.distributed`` with gloo).
+
+A fit called with ``distributed=`` spawns ``world_size`` local processes that
+join a gloo process group on 127.0.0.1. The training array is placed once in
+shared memory and mapped by every rank. All ranks start from the parent's
+weights and RNG states (torch, numpy and ``random``), so they draw the same
+train/validation split and the same shuffles; each then trains on its own
+slice of every split (``indices[rank::world_size]``) through
+``DistributedDataParallel``, which all-reduces the gradients. Epoch losses are all-reduced before they are
+recorded, so every rank feeds the stop controller the same value, and rank
+0's stop decision is broadcast so no rank can leave the loop alone. Rank 0
+returns the trained weights and histories to the calling process.
+"""
+
+import os
+import random
+import socket
+import tempfile
+from contextlib import nullcontext
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+import torch
+
+
+DISTRIBUTED_OPTIONS = {"world_size", "threads_per_rank", "port", "start_method", "timeout"}
+
+
+def distributed_options(distributed) -> Optional[Dict[str, Any]]:
+    """Normalise the ``distributed`` argument of the fit entry points.
+
+    ``None`` trains in the calling process; an integer is the number of
+    ranks; a dict (an R named list) may also set ``threads_per_rank``
+    (default: the cores divided by the ranks), ``port`` (default: a free
+    port), ``start_method`` (default ``"spawn"``) and ``timeout`` in seconds.
+    """
+    if distributed is None:
+        return None
+    options = dict(distributed) if isinstance(distributed, dict) else {"world_size": distributed}
+    unknown = set(options) - DISTRIBUTED_OPTIONS
+    if unknown:
+        raise ValueError(f"distributed options must be among {sorted(DISTRIBUTED_OPTIONS)}")
+    world_size = int(options.get("world_size", 0))
+    if world_size < 1:
+        raise ValueError("distributed 'world_size' must be a positive integer")
+    threads = options.get("threads_per_rank")
+    return {
+        "world_size": world_size,
+        "threads_per_rank": max(1, int(threads) if threads is not None else (os.cpu_count() or 1) // world_size),
+        "port": None if options.get("port") is None else int(options["port"]),
+        "start_method": str(options.get("start_method", "spawn")),
+        "timeout": float(options.get("timeout", 1800)),
+    }
+
+
+def in_data_parallel_rank() -> bool:
+    """Whether this process is a rank of a running ``data_parallel_fit``."""
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+class DataParallelShard:
+    """This rank's view of a distributed fit: its rows, the DDP-wrapped module and the collectives."""
+
+    def __init__(self, module: torch.nn.Module):
+        import torch.distributed as dist
+
+        self.dist = dist
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.module = torch.nn.parallel.DistributedDataParallel(module)
+
+    def indices(self, indices, n_rows: int) -> np.ndarray:
+        """This rank's slice of ``indices`` (all ``n_rows`` rows when ``None``)."""
+        indices = np.arange(n_rows) if indices is None else np.asarray(indices)
+        return indices[self.rank :: self.world_size]
+
+    def join(self):
+        """Let ranks with one batch fewer than the others finish the epoch without a hang."""
+        return self.module.join()
+
+    def reduce(self, losses):
+        """Sum a ``LossAccumulator`` over the ranks, in place."""
+        total = torch.zeros(2, dtype=torch.float64)
+        if losses.total is not None:
+            total[0] = losses.total.detach().cpu().reshape(())
+        total[1] = losses.weight
+        self.dist.all_reduce(total)
+        losses.total = total[0].clone()
+        losses.weight = float(total[1].item())
+        return losses
+
+    def agree(self, stop: bool) -> bool:
+        """Rank 0's stop decision, on every rank."""
+        flag = torch.tensor([1 if stop else 0], dtype=torch.int32)
+        self.dist.broadcast(flag, src=0)
+        return bool(flag.item())
+
+
+def shard_indices(shard: Optional[DataParallelShard], indices, n_rows: int):
+    """``indices`` unchanged outside a distributed fit, else this rank's slice of them."""
+    return indices if shard is None else shard.indices(indices, n_rows)
+
+
+def epoch_context(shard: Optional[DataParallelShard]):
+    return nullcontext() if shard is None else shard.join()
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def _rank_main(rank: int, cls, init_args, attributes, module_name, state, data, config, options, port, rng, result_path, fields):
+    import datetime
+
+    import torch.distributed as dist
+
+    from parallel_common import configure_parallelism
+
+    configure_parallelism(num_threads=options["threads_per_rank"])
+    dist.init_process_group(
+        "gloo",
+        init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank,
+        world_size=options["world_size"],
+        timeout=datetime.timedelta(seconds=options["timeout"]),
+    )
+    try:
+        owner = cls(**init_args)
+        for name, value in attributes.items():
+            setattr(owner, name, value)
+        getattr(owner, module_name).load_state_dict(state)
+        torch.set_rng_state(rng["torch"])
+        np.random.set_state(rng["numpy"])
+        random.setstate(rng["python"])
+        owner.fit(data.numpy(), config)
+        epochs = [torch.zeros(1, dtype=torch.int64) for _ in range(options["world_size"])]
+        dist.all_gather(epochs, torch.tensor([int(owner.epochs_done)], dtype=torch.int64))
+        if rank == 0:
+            result = {
+                "state": getattr(owner, module_name).state_dict(),
+                "fields": {f: getattr(owner, f) for f in fields},
+                "rank_epochs": [int(e.item()) for e in epochs],
+            }
+            torch.save(result, result_path)
+        dist.barrier()
+    finally:
+        dist.destroy_process_group()
+
+
+def data_parallel_fit(owner, array: np.ndarray, config, module_name: str, fields: Sequence[str], attributes: Sequence[str] = ("validation_strategy", "stopping_rule")):
+    """Run ``owner.fit(array, config)`` on ``config.distributed`` local ranks and adopt rank 0's result.
+
+    ``owner`` must be ``serializable``: every rank rebuilds it from
+    ``init_args``, copies ``attributes`` and the weights of ``module_name``,
+    and fits with the same ``config``. The trained weights and the history
+    ``fields`` of rank 0 are loaded back into ``owner``; a ``RuntimeError``
+    is raised if the ranks did not all stop after the same number of epochs.
+    """
+    import torch.multiprocessing as mp
+
+    options = config.distributed
+    if config.checkpoint is not None:
+        raise ValueError("checkpoint is not supported with distributed training")
+    if not isinstance(array, np.ndarray):
+        raise ValueError("streamed training data is not supported with distributed training")
+    if config.warm_start:
+        raise ValueError("warm_start is not supported with distributed training")
+    # Shared-memory tensors travel to the spawned ranks as handles, not copies.
+    data = torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32)).share_memory_()
+    module = getattr(owner, module_name)
+    state = {k: v.detach().cpu() for k, v in module.state_dict().items()}
+    rng = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    port = options["port"] or _free_port()
+    with tempfile.TemporaryDirectory(prefix="ddp-") as directory:
+        result_path = os.path.join(directory, "result.pt")
+        args = (type(owner), owner.init_args, {a: getattr(owner, a) for a in attributes}, module_name, state, data, config, options, port, rng, result_path, tuple(fields))
+        mp.start_processes(_rank_main, args=args, nprocs=options["world_size"], join=True, start_method=options["start_method"])
+        result = torch.load(result_path, map_location="cpu", weights_only=False)
+    if len(set(result["rank_epochs"])) != 1:
+        raise RuntimeError(f"data-parallel ranks stopped after different numbers of epochs: {result['rank_epochs']}")
+    module.load_state_dict(result["state"])
+    for field, value in result["fields"].items():
+        setattr(owner, field, value)
+    return owner
@@ -0,0 +1,79 @@
+"""
+Persistent module registry for the daltoolboxdp Python backends.
+
+The R wrappers import this module once per session and ask it for backend
+modules by name. Each backend is imported with ``importlib`` on first use and
+cached, so repeated ``fit``/``predict`` calls reuse the already-initialised
+module (and its torch/sklearn imports) instead of re-executing the source file.
+"""
+
+import importlib
+import os
+import sys
+from typing import Dict
+
+
+PYTHON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BACKEND_MODULES = (
+    "autoenc",
+    "autoenc_adv",
+    "autoenc_conv",
+    "autoenc_denoise",
+    "autoenc_lstm",
+    "autoenc_stacked",
+    "autoenc_variational",
+    "export_runtime",
+    "parallel_common",
+    "skcla_gb",
+    "skcla_knn",
+    "skcla_mlp",
+    "skcla_nb",
+    "skcla_rf",
+    "skcla_svc",
+    "skimb_smote",
+    "skimb_smote_tomek",
+    "skimb_tomek_links",
+    "torch_cla_mlp",
+    "torch_reg_mlp",
+    "torch_search",
+    "torch_ts_mlp",
+    "ts_conv1d",
+    "ts_lstm",
+)
+
+_modules: Dict[str, object] = {}
+
+
+def _ensure_path():
+    # Backends import their siblings by bare name (e.g. ``autoenc_common``).
+    if PYTHON_DIR not in sys.path:
+        sys.path.insert(0, PYTHON_DIR)
+
+
+def load(name: str):
+    """Return the backend module ``name``, importing it on first use."""
+    name = str(name)
+    module = _modules.get(name)
+    if module is None:
+        if name not in BACKEND_MODULES:
+            raise ValueError(f"Unknown backend module {name!r}; expected one of {list(BACKEND_MODULES)}")
+        _ensure_path()
+        module = importlib.import_module(name)
+        _modules[name] = module
+    return module
+
+
+def entry_point(function_name: str):
+    """Resolve an entry point such as ``autoenc_conv_fit`` to its function."""
+    function_name = str(function_name)
+    candidates = [m for m in BACKEND_MODULES if function_name.startswith(m + "_")]
+    if not candidates:
+        raise ValueError(f"No backend module provides {function_name!r}")
+    module = load(max(candidates, key=len))
+    return getattr(module, function_name)
+
+
+def loaded_modules():
+    """Names of the backend modules imported so far in this session."""
+    return sorted(_modules)
@@ -0,0 +1,126 @@
+"""
+Scoring runtime for graphs written by ``torch_common.export_model``.
+
+Only numpy is imported up front: the TorchScript runtime imports torch on
+first use and the ONNX runtime imports onnxruntime, so a scoring process
+needs neither the daltoolboxdp model classes nor pandas. Inputs are the
+flat feature rows the model was trained on (any target column removed);
+reshaping and output post-processing are part of the exported graphs.
+
+Usage:
+  model = export_runtime_load("exported/", runtime="onnxruntime")
+  scores = model.predict_scores(X)
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+EXPORT_FILE = "export.json"
+RUNTIMES = {"torchscript": "torchscript", "onnxruntime": "onnx"}
+
+
+def _rows(data, input_dim: int) -> np.ndarray:
+    to_numpy = getattr(data, "to_numpy", None)
+    array = to_numpy() if to_numpy is not None else data
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    if array.ndim != 2 or array.shape[1] != input_dim:
+        raise ValueError(f"Expected rows with {input_dim} features, got shape {array.shape}.")
+    return array
+
+
+class _TorchScriptGraph:
+    def __init__(self, path: str, num_threads: Optional[int]):
+        import torch
+
+        if num_threads is not None:
+            torch.set_num_threads(int(num_threads))
+        self.torch = torch
+        self.module = torch.jit.load(path, map_location="cpu")
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        with self.torch.inference_mode():
+            return self.module(self.torch.from_numpy(batch)).numpy()
+
+
+class _OnnxGraph:
+    def __init__(self, path: str, num_threads: Optional[int]):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = int(num_threads)
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(["output"], {"input": batch})[0]
+
+
+class ExportedModel:
+    """Exported graphs of one model, run batch by batch into a preallocated output."""
+
+    def __init__(self, path: str, runtime: str = "onnxruntime", num_threads: Optional[int] = None):
+        runtime = str(runtime).lower()
+        if runtime not in RUNTIMES:
+            raise ValueError(f"runtime must be one of {sorted(RUNTIMES)}")
+        self.path = str(path)
+        self.runtime = runtime
+        self.num_threads = num_threads
+        with open(os.path.join(self.path, EXPORT_FILE)) as handle:
+            self.manifest: Dict[str, Any] = json.load(handle)
+        self.classes_: Optional[List] = self.manifest.get("classes")
+        self._graphs: Dict[str, Any] = {}
+
+    def graphs(self) -> List[str]:
+        return sorted(self.manifest["graphs"])
+
+    def _graph(self, name: str):
+        graph = self._graphs.get(name)
+        if graph is None:
+            entry = self.manifest["graphs"].get(name)
+            if entry is None:
+                raise ValueError(f"{self.path} has no {name!r} graph; available: {self.graphs()}")
+            file_name = entry["files"].get(RUNTIMES[self.runtime])
+            if file_name is None:
+                raise ValueError(f"The {name!r} graph was not exported for {self.runtime}")
+            runner = _TorchScriptGraph if self.runtime == "torchscript" else _OnnxGraph
+            graph = runner(os.path.join(self.path, file_name), self.num_threads)
+            self._graphs[name] = graph
+        return graph
+
+    def run(self, name: str, data, batch_size: int = 4096) -> np.ndarray:
+        graph = self._graph(name)
+        rows = _rows(data, int(self.manifest["graphs"][name]["input_dim"]))
+        batch_size = max(1, int(batch_size))
+        out: Optional[np.ndarray] = None
+        for start in range(0, max(rows.shape[0], 1), batch_size):
+            result = graph(rows[start : start + batch_size])
+            if out is None:
+                out = np.empty((rows.shape[0],) + result.shape[1:], dtype=result.dtype)
+            out[start : start + result.shape[0]] = result
+        return out
+
+    def predict(self, data, batch_size: int = 4096):
+        out = self.run("predict", data, batch_size)
+        if self.classes_ is None:
+            return out
+        return np.asarray(self.classes_, dtype=object)[out.argmax(axis=1)].tolist()
+
+    def predict_scores(self, data, batch_size: int = 4096) -> np.ndarray:
+        return self.run("predict", data, batch_size)
+
+    def encode(self, data, batch_size: int = 4096) -> np.ndarray:
+        return self.run("encoder", data, batch_size)
+
+    def decode(self, data, batch_size: int = 4096) -> np.ndarray:
+        return self.run("decoder", data, batch_size)
+
+    def encode_decode(self, data, batch_size: int = 4096) -> np.ndarray:
+        return self.decode(self.encode(data, batch_size), batch_size)
+
+
+def export_runtime_load(path, runtime="onnxruntime", num_threads=None):
+    return ExportedModel(path, runtime=runtime, num_threads=num_threads)
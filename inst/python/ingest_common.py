@@ -0,0 +1,232 @@
+"""
+Shared ingestion of numpy arrays, pandas frames and Arrow tables for the daltoolboxdp backends.
+
+``feature_matrix`` returns the feature block as one C-contiguous array of the
+requested dtype with at most one copy: an input that already has the right
+dtype and layout is returned as is, a homogeneous DataFrame is read through
+its block view, and mixed frames, mappings and Arrow tables are written
+column by column into a single preallocated array. A target column is
+separated by position instead of ``drop(columns=...)``, so the feature block
+is never copied to remove it, and ``column_array`` reads the target itself
+without a copy when its storage allows.
+
+The sklearn wrappers fit on these arrays, so the column names sklearn would
+take from a DataFrame are kept by hand: ``record_feature_names`` sets
+``feature_names_in_`` after the fit and ``feature_matrix(columns=...)``
+checks them, by name and order, before a prediction is converted.
+
+Only numpy is imported: frames and tables are recognised by their methods,
+so numpy inputs never pull pandas or pyarrow into the process.
+"""
+
+import warnings
+from collections.abc import Mapping
+from contextlib import contextmanager
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+ORDERS = {"C", "K"}
+
+
+def _kind(data) -> str:
+    if hasattr(data, "iloc") and hasattr(data, "columns"):
+        return "pandas"
+    if hasattr(data, "column_names") and hasattr(data, "num_rows"):
+        return "arrow"
+    if isinstance(data, Mapping):
+        return "mapping"
+    return "array"
+
+
+def column_names(data) -> Optional[List]:
+    """Column names of a frame, table or mapping; ``None`` for plain arrays."""
+    kind = _kind(data)
+    if kind == "pandas":
+        return list(data.columns)
+    if kind == "arrow":
+        return list(data.column_names)
+    if kind == "mapping":
+        return list(data.keys())
+    return None
+
+
+def _column_index(names: Optional[List], n_columns: int, column) -> Optional[int]:
+    if names is not None and column in names:
+        return names.index(column)
+    if isinstance(column, (int, np.integer)) and not isinstance(column, bool) and -n_columns <= int(column) < n_columns:
+        return int(column) % n_columns
+    return None
+
+
+def _keep(names: Optional[List], n_columns: int, exclude: Sequence) -> List[int]:
+    # Like drop(columns=..., errors="ignore"): unknown columns are skipped.
+    dropped = {_column_index(names, n_columns, c) for c in exclude}
+    return [j for j in range(n_columns) if j not in dropped]
+
+
+def feature_names(data, exclude: Sequence = ()) -> Optional[np.ndarray]:
+    """Names of the feature columns of ``data``, as sklearn records them in ``feature_names_in_``.
+
+    ``None`` for plain arrays and for columns that are not all strings;
+    like sklearn, a mix of string and other names is a ``TypeError``.
+    """
+    names = column_names(data)
+    if not names:
+        return None
+    names = [names[j] for j in _keep(names, len(names), list(exclude))]
+    strings = [isinstance(name, str) for name in names]
+    if not any(strings):
+        return None
+    if not all(strings):
+        raise TypeError("Feature names are only supported if all input features have string names.")
+    return np.asarray(names, dtype=object)
+
+
+def _check_names(data, exclude: Sequence, expected) -> None:
+    names = feature_names(data, exclude)
+    expected = np.asarray(expected, dtype=object)
+    if names is None or (len(names) == len(expected) and np.all(names == expected)):
+        return
+    unseen = sorted(set(names) - set(expected))
+    missing = sorted(set(expected) - set(names))
+    message = "The feature names should match those that were passed during fit."
+    if unseen:
+        message += f" Unseen at fit time: {unseen[:5]}."
+    if missing:
+        message += f" Seen at fit time, yet now missing: {missing[:5]}."
+    if not unseen and not missing:
+        message += " Feature names must be in the same order as they were in fit."
+    raise ValueError(message)
+
+
+def record_feature_names(estimator, data, exclude: Sequence = ()):
+    """Set ``feature_names_in_`` of an estimator fitted on ``feature_matrix(data, exclude)``."""
+    names = feature_names(data, exclude)
+    if names is not None:
+        estimator.feature_names_in_ = names
+    return estimator
+
+
+@contextmanager
+def checked_feature_names():
+    """Silence sklearn's "X does not have valid feature names" warning.
+
+    For predictions on a ``feature_matrix(..., columns=estimator.feature_names_in_)``
+    array, whose column names were already checked.
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names")
+        yield
+
+
+def _take(matrix: np.ndarray, keep: List[int]) -> np.ndarray:
+    """Columns ``keep`` of a 2-D array; a view when they form a contiguous range."""
+    if len(keep) == matrix.shape[1]:
+        return matrix
+    if keep and keep == list(range(keep[0], keep[-1] + 1)):
+        return matrix[:, keep[0] : keep[-1] + 1]
+    return matrix[:, keep]
+
+
+def _pandas_column(series, dtype=None) -> np.ndarray:
+    if not isinstance(series.dtype, np.dtype) and dtype is not None and np.issubdtype(np.dtype(dtype), np.floating):
+        # Extension dtypes (nullable integers, Arrow-backed columns) map missing values to NaN.
+        return series.to_numpy(dtype=dtype, na_value=np.nan)
+    values = series.to_numpy(copy=False)
+    return values if dtype is None else np.asarray(values, dtype=dtype)
+
+
+def _arrow_column(column, dtype=None) -> np.ndarray:
+    chunks = getattr(column, "chunks", None)
+    if chunks is not None and len(chunks) == 1:
+        column = chunks[0]
+    # Zero-copy for a primitive chunk without nulls; nulls become NaN otherwise.
+    values = column.to_numpy(zero_copy_only=False)
+    return values if dtype is None else np.asarray(values, dtype=dtype)
+
+
+def _columns(data, kind: str, keep: List[int], n_rows: int, dtype) -> np.ndarray:
+    out = np.empty((n_rows, len(keep)), dtype=dtype)
+    if kind == "pandas":
+        columns = (_pandas_column(data.iloc[:, j], dtype) for j in keep)
+    elif kind == "arrow":
+        columns = (_arrow_column(data.column(j), dtype) for j in keep)
+    else:
+        values = list(data.values())
+        columns = (np.asarray(values[j], dtype=dtype) for j in keep)
+    for i, column in enumerate(columns):
+        out[:, i] = column
+    return out
+
+
+def feature_matrix(data, exclude: Sequence = (), dtype=np.float32, fill_value=None, order: str = "C", columns=None) -> np.ndarray:
+    """``dtype`` array of ``data`` without the ``exclude`` columns.
+
+    ``exclude`` holds column names or positions (missing ones are ignored).
+    Plain arrays keep their shape when nothing is excluded, so 3-D sequence
+    batches pass through unchanged. ``order="C"`` (the torch backends)
+    returns a C-contiguous array; ``order="K"`` (the sklearn wrappers, which
+    accept any layout) keeps a view of an existing buffer in whatever layout
+    it has, e.g. the column-major block of a DataFrame. With ``fill_value``,
+    NaNs are replaced in place when the result is a private copy, and in a
+    copy otherwise, so the caller's buffers are never modified. ``columns``
+    (an estimator's ``feature_names_in_``) are the names seen at fit time: a
+    frame, table or mapping whose feature columns differ from them, by name
+    or by order, raises ``ValueError``; plain arrays are positional.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {sorted(ORDERS)}")
+    if columns is not None:
+        _check_names(data, exclude, columns)
+    convert = np.ascontiguousarray if order == "C" else np.asarray
+    kind = _kind(data)
+    exclude = list(exclude)
+    source = None
+    if kind == "array":
+        source = np.asarray(data)
+        if exclude:
+            if source.ndim != 2:
+                raise ValueError(f"Columns can only be excluded from 2-D arrays, got shape {source.shape}.")
+            source = _take(source, _keep(None, source.shape[1], exclude))
+        out = convert(source, dtype=dtype)
+    else:
+        names = column_names(data)
+        keep = _keep(names, len(names), exclude)
+        n_rows = int(data.shape[0]) if kind == "pandas" else (int(data.num_rows) if kind == "arrow" else len(next(iter(data.values()), ())))
+        dtypes = set(data.dtypes) if kind == "pandas" else set()
+        if kind == "pandas" and len(dtypes) == 1 and isinstance(next(iter(dtypes)), np.dtype) and next(iter(dtypes)).kind in "biuf":
+            # A homogeneous frame is one block: read it through its view.
+            source = _take(data.to_numpy(copy=False), keep)
+            out = convert(source, dtype=dtype)
+        else:
+            out = _columns(data, kind, keep, n_rows, dtype)
+    # The sum is NaN whenever a value is (or inf - inf): a cheap test before building a mask.
+    if fill_value is not None and np.isnan(out.sum()):
+        if (source is not None and np.may_share_memory(out, source)) or not out.flags.writeable:
+            out = out.copy(order="K")
+        np.copyto(out, fill_value, where=np.isnan(out))
+    return out
+
+
+def column_array(data, column, dtype=None) -> np.ndarray:
+    """Values of one column (by name or position), without a copy when its storage allows."""
+    kind = _kind(data)
+    if kind == "array":
+        array = np.asarray(data)
+        index = _column_index(None, array.shape[1], column) if array.ndim == 2 else None
+        if index is None:
+            raise KeyError(column)
+        values = array[:, index]
+        return values if dtype is None else np.asarray(values, dtype=dtype)
+    names = column_names(data)
+    index = _column_index(names, len(names), column)
+    if index is None:
+        raise KeyError(column)
+    if kind == "pandas":
+        return _pandas_column(data.iloc[:, index], dtype)
+    if kind == "arrow":
+        return _arrow_column(data.column(index), dtype)
+    values = np.asarray(list(data.values())[index])
+    return values if dtype is None else np.asarray(values, dtype=dtype)
@@ -0,0 +1,186 @@
+"""
+Thread and intra-op parallelism control for the daltoolboxdp Python backends.
+
+Several R workers on one machine each run torch, BLAS and sklearn thread
+pools sized to every core, which oversubscribes the box. This module limits
+those pools process-wide (``configure_parallelism``) or per model
+(``num_threads`` on the torch ``*_create`` functions, ``n_jobs`` on the
+sklearn ones), and ``calibrate_threads`` times a fit under several thread
+counts to pick the fastest.
+
+The module never imports torch itself, so sklearn-only processes keep their
+cold start; torch settings are applied once torch has been loaded.
+"""
+
+import copy
+import functools
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Sequence
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # threadpoolctl ships with scikit-learn; BLAS limits are skipped without it
+    threadpool_limits = None
+
+
+BLAS_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+_config: Dict[str, Optional[int]] = {"num_threads": None, "interop_threads": None, "blas_threads": None}
+_interop_applied = False
+
+
+def validate_num_threads(num_threads, name: str = "num_threads") -> Optional[int]:
+    if num_threads is None:
+        return None
+    num_threads = int(num_threads)
+    if num_threads < 1:
+        raise ValueError(f"{name} must be a positive integer or None")
+    return num_threads
+
+
+def _apply_interop(torch) -> None:
+    global _interop_applied
+    if _interop_applied or _config["interop_threads"] is None:
+        return
+    _interop_applied = True
+    try:
+        torch.set_num_interop_threads(_config["interop_threads"])
+    except RuntimeError:
+        # Inter-op threads can only be set before torch starts parallel work.
+        pass
+
+
+def configure_parallelism(num_threads=None, interop_threads=None, blas_threads=None) -> Dict[str, Any]:
+    """Set process-wide thread limits for torch, BLAS/OpenMP and sklearn.
+
+    ``num_threads`` is torch's intra-op pool and the default for models
+    created without their own ``num_threads``; ``blas_threads`` (defaulting
+    to ``num_threads``) caps the BLAS/OpenMP pools used by numpy and sklearn.
+    Environment variables are exported as well so libraries loaded later
+    start with the same limits.
+    """
+    global _interop_applied
+    _config["num_threads"] = validate_num_threads(num_threads)
+    _config["interop_threads"] = validate_num_threads(interop_threads, "interop_threads")
+    blas = validate_num_threads(blas_threads, "blas_threads")
+    _config["blas_threads"] = blas if blas is not None else _config["num_threads"]
+    _interop_applied = False
+
+    if _config["blas_threads"] is not None:
+        for var in BLAS_ENV_VARS:
+            os.environ[var] = str(_config["blas_threads"])
+        if threadpool_limits is not None:
+            threadpool_limits(limits=_config["blas_threads"])
+
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        if _config["num_threads"] is not None:
+            torch.set_num_threads(_config["num_threads"])
+        _apply_interop(torch)
+    return parallelism_report()
+
+
+def parallelism_report() -> Dict[str, Any]:
+    """Configured limits plus the thread counts currently in effect."""
+    report: Dict[str, Any] = dict(_config)
+    report["cpu_count"] = os.cpu_count()
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        report["torch_threads"] = torch.get_num_threads()
+        report["torch_interop_threads"] = torch.get_num_interop_threads()
+    return report
+
+
+@contextmanager
+def thread_limits(num_threads=None):
+    """Run a block with torch and BLAS pools capped at ``num_threads``.
+
+    ``None`` falls back to the process-wide ``configure_parallelism`` value,
+    and to no change at all when that is unset as well.
+    """
+    n = validate_num_threads(num_threads)
+    if n is None:
+        n = _config["num_threads"]
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        _apply_interop(torch)
+    if n is None:
+        yield
+        return
+    previous = torch.get_num_threads() if torch is not None else None
+    if torch is not None and previous != n:
+        torch.set_num_threads(n)
+    try:
+        if threadpool_limits is not None:
+            with threadpool_limits(limits=n):
+                yield
+        else:
+            yield
+    finally:
+        if torch is not None and previous != n:
+            torch.set_num_threads(previous)
+
+
+def uses_model_threads(fn):
+    """Decorator for ``*_fit``/``*_encode``/``*_predict`` entry points taking the model first."""
+
+    @functools.wraps(fn)
+    def wrapper(model, *args, **kwargs):
+        with thread_limits(getattr(model, "num_threads", None)):
+            return fn(model, *args, **kwargs)
+
+    return wrapper
+
+
+def default_thread_candidates() -> Sequence[int]:
+    cpus = os.cpu_count() or 1
+    candidates = {1, cpus}
+    n = 2
+    while n < cpus:
+        candidates.add(n)
+        n *= 2
+    return sorted(candidates)
+
+
+def calibrate_threads(fit, model, data, candidates=None, repeats: int = 1, apply: bool = True, **fit_kwargs) -> Dict[str, Any]:
+    """Time ``fit(model, data, **fit_kwargs)`` for each thread count and pick the fastest.
+
+    Torch models are timed through their ``num_threads`` attribute and sklearn
+    estimators through ``n_jobs`` when they expose it. Every probe fits a deep
+    copy of ``model``, so its weights and history are left as they were; with
+    ``apply=True`` only the winning setting is set on it. Keep ``fit_kwargs``
+    small (e.g. one epoch on a representative sample): every candidate runs a
+    full fit.
+    """
+    candidates = [validate_num_threads(c) for c in (candidates or default_thread_candidates())]
+    params = model.get_params() if hasattr(model, "get_params") else {}
+    use_n_jobs = "n_jobs" in params
+
+    def _set(target, n):
+        if use_n_jobs:
+            target.set_params(n_jobs=n)
+        else:
+            target.num_threads = n
+
+    seconds: Dict[int, float] = {}
+    for n in candidates:
+        best = float("inf")
+        for _ in range(max(1, int(repeats))):
+            probe = copy.deepcopy(model)
+            _set(probe, n)
+            start = time.perf_counter()
+            if use_n_jobs:
+                fit(probe, data, **fit_kwargs)
+            else:
+                with thread_limits(n):
+                    fit(probe, data, **fit_kwargs)
+            best = min(best, time.perf_counter() - start)
+            del probe
+        seconds[n] = best
+    best_threads = min(seconds, key=seconds.get)
+    if apply:
+        _set(model, best_threads)
+    return {"best_threads": best_threads, "seconds": seconds, "setting": "n_jobs" if use_n_jobs else "num_threads"}
@@ -9,7 +9,8 @@ R entry points (see R/skcla_gb.R):
 """
 
 from sklearn.ensemble import GradientBoostingClassifier
-import pandas as pd
+import numpy as np
+from ingest_common import checked_feature_names, column_array, feature_matrix, record_feature_names
 
 def skcla_gb_create(n_estimators=100, learning_rate=0.1, max_depth=3, subsample=1.0,
                   min_samples_split=2, min_samples_leaf=1, loss='log_loss'):
@@ -28,22 +29,23 @@ def skcla_gb_create(n_estimators=100, learning_rate=0.1, max_depth=3, subsample=
 
 def skcla_gb_train(model, df_train, target_column):
     """Fit GradientBoostingClassifier. df_train must include the target_column."""
-    df_train = pd.DataFrame(df_train)
     #print("Column types:", df_train.dtypes)
     #print("Data shape:", df_train.shape)
 
-    X_train = df_train.drop(columns=[target_column])
-    y_train = df_train[target_column].values
+    X_train = feature_matrix(df_train, exclude=[target_column], dtype=np.float32, order="K")
+    y_train = column_array(df_train, target_column)
 
     model.fit(X_train, y_train)
+    record_feature_names(model, df_train, exclude=[target_column])
     return model
 
 def skcla_gb_predict(model, df_test):
     """Predict labels as a Python list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)
+        X_test = feature_matrix(df_test, dtype=np.float32, order="K", columns=getattr(model, "feature_names_in_", None))
         #print(df_test)
-        predictions = model.predict(df_test)
+        with checked_feature_names():
+            predictions = model.predict(X_test)
         return predictions.tolist()
     except TypeError as e:
         print(f"Error occurred: {e}")
@@ -54,8 +56,9 @@ def skcla_gb_predict(model, df_test):
 def skcla_gb_predict_proba(model, df_test):
     """Predict class probabilities as a nested list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)
-        probabilities = model.predict_proba(df_test)
+        X_test = feature_matrix(df_test, dtype=np.float32, order="K", columns=getattr(model, "feature_names_in_", None))
+        with checked_feature_names():
+            probabilities = model.predict_proba(X_test)
         return probabilities.tolist()
     except TypeError as e:
         print(f"Error occurred: {e}")
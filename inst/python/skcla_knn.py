@@ -11,32 +11,31 @@ R entry points (see R/skcla_knn.R):
 from sklearn.neighbors import KNeighborsClassifier
 import numpy as np
 import pandas as pd
+from ingest_common import checked_feature_names, column_array, feature_matrix, record_feature_names
 
-def skcla_knn_create(n_neighbors=5, weights='uniform', metric='euclidean'):
+def skcla_knn_create(n_neighbors=5, weights='uniform', metric='euclidean', n_jobs=None):
     model = KNeighborsClassifier(
         n_neighbors=n_neighbors,
         weights=weights,
-        metric=metric
+        metric=metric,
+        n_jobs=None if n_jobs is None else int(n_jobs)
     )
     return model
 
 def skcla_knn_fit(model, df_train, target_column):
     """Fit KNN. df_train must include the target_column."""
     try:
-        df_train = pd.DataFrame(df_train)
-
-        X_train = df_train.drop(columns=[target_column])
-        y_train = df_train[target_column].values
+        X_train = feature_matrix(df_train, exclude=[target_column], dtype=np.float64, fill_value=0.0, order="K")
+        y_train = column_array(df_train, target_column)
 
         #print(f"X_train shape: {X_train.shape}")
         #print(f"y_train shape: {y_train.shape}")
 
-        if X_train.isnull().values.any() or pd.isnull(y_train).any():
-            #print("Warning: NaN values detected in training data")
-            X_train = X_train.fillna(0)
+        if pd.isnull(y_train).any():
             y_train = np.nan_to_num(y_train)
 
         model.fit(X_train, y_train)
+        record_feature_names(model, df_train, exclude=[target_column])
         return model
     except Exception as e:
         print(f"Error in skcla_knn_fit: {str(e)}")
@@ -45,14 +44,11 @@ def skcla_knn_fit(model, df_train, target_column):
 def skcla_knn_predict(model, df_test):
     """Predict labels as a Python list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)
+        X_test = feature_matrix(df_test, dtype=np.float64, fill_value=0.0, order="K", columns=getattr(model, "feature_names_in_", None))
         #print(f"X_test shape: {df_test.shape}")
 
-        if df_test.isnull().values.any():
-            #print("Warning: NaN values detected in test data")
-            df_test = df_test.fillna(0)
-
-        predictions = model.predict(df_test)
+        with checked_feature_names():
+            predictions = model.predict(X_test)
         return predictions.tolist()
     except TypeError as e:
         print(f"TypeError in skcla_knn_predict: {e}")
@@ -64,12 +60,10 @@ def skcla_knn_predict(model, df_test):
 def skcla_knn_predict_proba(model, df_test):
     """Predict class probabilities as a nested list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)
-
-        if df_test.isnull().values.any():
-            df_test = df_test.fillna(0)
+        X_test = feature_matrix(df_test, dtype=np.float64, fill_value=0.0, order="K", columns=getattr(model, "feature_names_in_", None))
 
-        probabilities = model.predict_proba(df_test)
+        with checked_feature_names():
+            probabilities = model.predict_proba(X_test)
         return probabilities.tolist()
     except TypeError as e:
         print(f"TypeError in skcla_knn_predict_proba: {e}")
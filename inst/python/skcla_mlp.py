@@ -9,7 +9,8 @@ R entry points (see R/skcla_mlp.R):
 """
 
 from sklearn.neural_network import MLPClassifier
-import pandas as pd
+import numpy as np
+from ingest_common import checked_feature_names, column_array, feature_matrix, record_feature_names
 
 def skcla_mlp_create(hidden_layer_sizes=(100,), activation='relu', solver='adam', alpha=0.0001, batch_size='auto',
                learning_rate_init=0.001, max_iter=200, early_stopping=False):
@@ -34,18 +35,19 @@ def skcla_mlp_create(hidden_layer_sizes=(100,), activation='relu', solver='adam'
 
 def skcla_mlp_fit(model, df_train, target_column):
     """Fit MLP. df_train must include the target_column."""
-    df_train = pd.DataFrame(df_train)
-    X_train = df_train.drop(columns=[target_column])
-    y_train = df_train[target_column].values
+    X_train = feature_matrix(df_train, exclude=[target_column], dtype=np.float64, order="K")
+    y_train = column_array(df_train, target_column)
 
     model.fit(X_train, y_train)
+    record_feature_names(model, df_train, exclude=[target_column])
     return model
 
 def skcla_mlp_predict(model, df_test):
     """Predict labels as a Python list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)
-        predictions = model.predict(df_test)
+        X_test = feature_matrix(df_test, dtype=np.float64, order="K", columns=getattr(model, "feature_names_in_", None))
+        with checked_feature_names():
+            predictions = model.predict(X_test)
         return predictions.tolist()
     except TypeError as e:
         print(f"Error occurred: {e}")
@@ -55,8 +57,9 @@ def skcla_mlp_predict(model, df_test):
 def skcla_mlp_predict_proba(model, df_test):
     """Predict class probabilities as a nested list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)
-        probabilities = model.predict_proba(df_test)
+        X_test = feature_matrix(df_test, dtype=np.float64, order="K", columns=getattr(model, "feature_names_in_", None))
+        with checked_feature_names():
+            probabilities = model.predict_proba(X_test)
         return probabilities.tolist()
     except TypeError as e:
         print(f"Error occurred: {e}")
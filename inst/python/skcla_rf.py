@@ -7,14 +7,15 @@ R entry points (see R/skcla_rf.R):
   - skcla_rf_predict(model, df_test) -> list of labels (for R compatibility)
   - skcla_rf_predict_proba(model, df_test) -> list of per-class probabilities
 
-Data expectations: pandas.DataFrame; target_column is present in df_train and excluded for prediction.
+Data expectations: pandas.DataFrame (numpy arrays and Arrow tables also work); target_column is present in df_train and excluded for prediction.
 """
 
 from sklearn.ensemble import RandomForestClassifier
-import pandas as pd
+import numpy as np
+from ingest_common import checked_feature_names, column_array, feature_matrix, record_feature_names
 
 def skcla_rf_create(n_estimators=100, max_depth=None, min_samples_split=2,
-                  min_samples_leaf=1, max_features='sqrt', class_weight=None):
+                  min_samples_leaf=1, max_features='sqrt', class_weight=None, n_jobs=None):
     model = RandomForestClassifier(
         n_estimators=int(n_estimators),
         max_depth=max_depth,
@@ -22,27 +23,29 @@ def skcla_rf_create(n_estimators=100, max_depth=None, min_samples_split=2,
         min_samples_leaf=int(min_samples_leaf),
         max_features=max_features,
         class_weight=class_weight,
+        n_jobs=None if n_jobs is None else int(n_jobs),
     )
     return model
 
 def skcla_rf_train(model, df_train, target_column):
     """Fit RandomForestClassifier. df_train must include the target_column."""
-    df_train = pd.DataFrame(df_train)  # garante consistência com R
     #print("Column types:", df_train.dtypes)
     #print("Shape of data:", df_train.shape)
 
-    X_train = df_train.drop(columns=[target_column])  # preserva nomes das colunas
-    y_train = df_train[target_column].values
+    X_train = feature_matrix(df_train, exclude=[target_column], dtype=np.float32, order="K")
+    y_train = column_array(df_train, target_column)
 
     model.fit(X_train, y_train)
+    record_feature_names(model, df_train, exclude=[target_column])
     return model
 
 def skcla_rf_predict(model, df_test):
     """Predict labels as a Python list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)  # garante estrutura consistente
+        X_test = feature_matrix(df_test, dtype=np.float32, order="K", columns=getattr(model, "feature_names_in_", None))
         #print(df_test)
-        predictions = model.predict(df_test)  # mantém colunas nomeadas
+        with checked_feature_names():
+            predictions = model.predict(X_test)
         return predictions.tolist()  # para compatibilidade com R
     except TypeError as e:
         print(f"Error occurred: {e}")
@@ -52,8 +55,9 @@ def skcla_rf_predict(model, df_test):
 def skcla_rf_predict_proba(model, df_test):
     """Predict class probabilities as a nested list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)
-        probabilities = model.predict_proba(df_test)
+        X_test = feature_matrix(df_test, dtype=np.float32, order="K", columns=getattr(model, "feature_names_in_", None))
+        with checked_feature_names():
+            probabilities = model.predict_proba(X_test)
         return probabilities.tolist()
     except TypeError as e:
         print(f"Error occurred: {e}")
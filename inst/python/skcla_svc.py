@@ -9,7 +9,8 @@ R entry points (see R/skcla_svc.R):
 """
 
 from sklearn.svm import SVC
-import pandas as pd
+import numpy as np
+from ingest_common import checked_feature_names, column_array, feature_matrix, record_feature_names
 
 def skcla_svc_create(C=1.0, kernel='rbf', gamma='scale', degree=3, coef0=0.0, probability=False, class_weight=None):
     
@@ -27,25 +28,26 @@ def skcla_svc_create(C=1.0, kernel='rbf', gamma='scale', degree=3, coef0=0.0, pr
 
 def skcla_svc_train(model, df_train, target_column):
     """Fit SVC. df_train must include the target_column."""
-    df_train = pd.DataFrame(df_train)
 
     #print("Column types:")
     #print(df_train.dtypes)
     #print("Data shape:", df_train.shape)
 
-    X_train = df_train.drop(columns=[target_column])
-    y_train = df_train[target_column].values
+    X_train = feature_matrix(df_train, exclude=[target_column], dtype=np.float64, order="K")
+    y_train = column_array(df_train, target_column)
 
     model.fit(X_train, y_train)
+    record_feature_names(model, df_train, exclude=[target_column])
     return model
 
 def skcla_svc_predict(model, df_test):
     """Predict labels as a Python list to simplify R interop."""
     try:
-        df_test = pd.DataFrame(df_test)
+        X_test = feature_matrix(df_test, dtype=np.float64, order="K", columns=getattr(model, "feature_names_in_", None))
         #print("Prediction input shape:", df_test.shape)
 
-        predictions = model.predict(df_test)
+        with checked_feature_names():
+            predictions = model.predict(X_test)
         return predictions.tolist()
     except TypeError as e:
         print(f"Error occurred: {e}")
@@ -57,10 +59,11 @@ def skcla_svc_predict(model, df_test):
 def skcla_svc_predict_proba(model, df_test):
     """Predict class probabilities when available; otherwise return an empty list."""
     try:
-        df_test = pd.DataFrame(df_test)
+        X_test = feature_matrix(df_test, dtype=np.float64, order="K", columns=getattr(model, "feature_names_in_", None))
         if not hasattr(model, "predict_proba"):
             return []
-        probabilities = model.predict_proba(df_test)
+        with checked_feature_names():
+            probabilities = model.predict_proba(X_test)
         return probabilities.tolist()
     except TypeError as e:
         print(f"Error occurred: {e}")
@@ -0,0 +1,291 @@
+"""
+Out-of-core training inputs for the daltoolboxdp torch fits.
+
+A fit that receives a path to a ``.npy`` or Parquet file, or a memory-mapped
+array (``np.memmap``, e.g. ``np.load(path, mmap_mode="r")``), trains from a
+``ChunkStream`` instead of an in-memory array. The rows are divided into
+chunks of at most ``chunk_rows`` rows (row ranges of the memory map, slices
+of the Parquet row groups). ``len(stream)`` is the number of rows, and
+``split_rows`` holds out the same number of validation rows as the in-memory
+split, spread over every chunk (``ChunkStream.split``), so the held-out
+share does not depend on the chunk size.
+
+Each training pass visits its chunks in a random order, collects them in a
+shuffle buffer of ``buffer_rows`` rows, permutes the buffer and yields
+mini-batches from it, keeping half of it to mix with the following chunks;
+validation passes read their chunks in order without a buffer. A pass over
+one side of a split reads every chunk holding rows of that side and keeps
+only those rows. Only the buffer, one chunk and (for Parquet) the row group
+being read are resident, so the file can be larger than the available
+memory. Shuffles draw from ``torch`` like ``TensorBatches`` and splits from
+``numpy`` like the in-memory splits, so seeding both fixes a streamed fit
+too.
+"""
+
+import copy
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from torch_common import input_tensor
+
+
+SplitFunction = Callable[[int, float], Tuple[np.ndarray, np.ndarray]]
+
+
+STREAM_OPTIONS = {"chunk_rows", "buffer_rows", "columns"}
+PARQUET_SUFFIXES = (".parquet", ".pq")
+
+
+def stream_options(stream) -> Optional[Dict[str, Any]]:
+    """Normalise the ``stream`` argument of the fit entry points.
+
+    It only applies when the training data is a file path or a memory map.
+    ``None`` keeps the defaults; a dict (an R named list) may set
+    ``chunk_rows`` (default 65536), ``buffer_rows`` (default four chunks) and
+    ``columns``, the column names of a ``.npy`` file or memory map so targets
+    can be named as in a data frame (positions work without them).
+    """
+    if stream is None:
+        return None
+    options = dict(stream)
+    unknown = set(options) - STREAM_OPTIONS
+    if unknown:
+        raise ValueError(f"stream options must be among {sorted(STREAM_OPTIONS)}")
+    chunk_rows = int(options.get("chunk_rows", 65536))
+    buffer_rows = int(options.get("buffer_rows", 4 * chunk_rows))
+    if chunk_rows < 1 or buffer_rows < 1:
+        raise ValueError("stream 'chunk_rows' and 'buffer_rows' must be positive integers")
+    columns = options.get("columns")
+    return {"chunk_rows": chunk_rows, "buffer_rows": buffer_rows, "columns": None if columns is None else [str(c) for c in columns]}
+
+
+def is_stream_input(data) -> bool:
+    """Whether ``data`` is a file path or a memory-mapped array."""
+    return isinstance(data, (str, os.PathLike, np.memmap))
+
+
+def _open_parquet(path: str):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as exc:  # pyarrow is optional
+        raise ImportError("Streaming Parquet files requires pyarrow.") from exc
+    return pq.ParquetFile(path)
+
+
+class ChunkStream:
+    """Chunks of a ``.npy`` file, Parquet file or memory map, read on demand.
+
+    ``prepare`` turns the raw rows of one chunk (a memory-map slice, a mapping
+    of named columns or an Arrow table) into the tuple of arrays a fit trains
+    on, e.g. the features and the target of an MLP.
+    """
+
+    def __init__(self, data, prepare: Callable[[Any], Sequence[np.ndarray]], chunk_rows: int = 65536, buffer_rows: int = 262144, columns: Optional[List[str]] = None):
+        self.prepare = prepare
+        self.buffer_rows = int(buffer_rows)
+        self.columns = columns
+        self._array: Optional[np.ndarray] = None
+        self._parquet = None
+        if isinstance(data, np.memmap):
+            self._array = data
+        else:
+            path = os.fspath(data)
+            if path.lower().endswith(".npy"):
+                self._array = np.load(path, mmap_mode="r")
+            elif path.lower().endswith(PARQUET_SUFFIXES):
+                self._parquet = _open_parquet(path)
+            else:
+                raise ValueError(f"Streamed training data must be a .npy or Parquet file, got {path!r}")
+        if self._array is not None:
+            if self._array.ndim != 2:
+                raise ValueError(f"Streamed arrays must be 2-D, got shape {self._array.shape}")
+            sizes = [int(self._array.shape[0])]
+        else:
+            metadata = self._parquet.metadata
+            sizes = [int(metadata.row_group(g).num_rows) for g in range(metadata.num_row_groups)]
+        self.n_rows = sum(sizes)
+        chunk_rows = max(1, int(chunk_rows))
+        self.chunks: List[Tuple[int, int, int]] = [(group, start, min(start + chunk_rows, size)) for group, size in enumerate(sizes) for start in range(0, size, chunk_rows)]
+        self._group: Optional[int] = None
+        self._table = None
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def split(self, val_ratio: float, shuffle: bool = True) -> Tuple["RowSplit", "RowSplit"]:
+        """Training and validation rows, split within every chunk.
+
+        ``max(1, int(n_rows * val_ratio))`` rows are held out, as in the
+        in-memory splits, spread over the chunks in proportion to their size:
+        random rows of each chunk, or with ``shuffle=False`` the last rows of
+        the stream (the static split of the time-series fits). Only a seed and
+        a count per chunk are stored; the rows are drawn when a chunk is read.
+        """
+        sizes = np.array([stop - start for _, start, stop in self.chunks], dtype=np.int64)
+        n_val = min(self.n_rows, max(1, int(self.n_rows * float(val_ratio))))
+        if shuffle:
+            held = np.diff(n_val * np.cumsum(sizes) // max(1, self.n_rows), prepend=0)
+            seed = int(np.random.randint(0, 2**31 - 1))
+        else:
+            after = np.cumsum(sizes[::-1])[::-1] - sizes
+            held = np.clip(n_val - after, 0, sizes)
+            seed = None
+        return RowSplit(sizes, held, seed, validation=False), RowSplit(sizes, held, seed, validation=True)
+
+    def with_prepare(self, prepare: Callable[[Any], Sequence[np.ndarray]]) -> "ChunkStream":
+        """A stream over the same chunks with another ``prepare``."""
+        other = copy.copy(self)
+        other.prepare = prepare
+        other.release()
+        return other
+
+    def map(self, fn: Callable[[Tuple[np.ndarray, ...]], Sequence[np.ndarray]]) -> "ChunkStream":
+        """A stream over the same chunks whose arrays are passed through ``fn``."""
+        return self.with_prepare(lambda raw, prepare=self.prepare: fn(tuple(prepare(raw))))
+
+    def _raw(self, group: int, start: int, stop: int):
+        if self._array is not None:
+            rows = self._array[start:stop]
+            return rows if self.columns is None else dict(zip(self.columns, rows.T))
+        if self._group != group:
+            # Parquet is read a row group at a time; keep the current one for its other chunks.
+            self._table = None
+            self._table = self._parquet.read_row_group(group)
+            self._group = group
+        return self._table.slice(start, stop - start)
+
+    def read(self, chunk: int) -> Tuple[np.ndarray, ...]:
+        return tuple(self.prepare(self._raw(*self.chunks[int(chunk)])))
+
+    def release(self):
+        self._group, self._table = None, None
+
+    def order(self, indices, shuffle: bool) -> np.ndarray:
+        """Chunk ids of a pass; shuffled passes keep the chunks of a row group together."""
+        chunks = np.arange(len(self.chunks)) if indices is None else np.asarray(indices, dtype=np.int64)
+        if not shuffle or len(chunks) == 0:
+            return chunks
+        chunks = chunks[torch.randperm(len(chunks)).numpy()]
+        groups = np.array([self.chunks[c][0] for c in chunks])
+        rank = torch.randperm(int(groups.max()) + 1).numpy()
+        return chunks[np.argsort(rank[groups], kind="stable")]
+
+    def batches(self, batch_size: int, shuffle: bool, indices=None, device: Optional[torch.device] = None) -> "StreamBatches":
+        return StreamBatches(self, batch_size, shuffle, indices, device)
+
+
+class RowSplit:
+    """One side of a ``ChunkStream.split``: the training or the validation rows of every chunk."""
+
+    def __init__(self, sizes: np.ndarray, held: np.ndarray, seed: Optional[int], validation: bool):
+        self.sizes = sizes
+        self.held = held
+        self.seed = seed
+        self.validation = bool(validation)
+
+    def __len__(self) -> int:
+        return int(self.held.sum() if self.validation else (self.sizes - self.held).sum())
+
+    def chunk_ids(self) -> np.ndarray:
+        """The chunks with at least one row on this side."""
+        counts = self.held if self.validation else self.sizes - self.held
+        return np.flatnonzero(counts)
+
+    def rows(self, chunk: int):
+        """Rows of ``chunk`` on this side, relative to its first row."""
+        size, held = int(self.sizes[chunk]), int(self.held[chunk])
+        if self.seed is None:
+            return slice(size - held, size) if self.validation else slice(0, size - held)
+        perm = np.random.default_rng((self.seed, int(chunk))).permutation(size)
+        # Sorted, so a memory map or Arrow slice is read front to back.
+        return np.sort(perm[:held] if self.validation else perm[held:])
+
+
+class StreamBatches:
+    """Mini-batch iterator over a ``ChunkStream``, or over the rows ``indices`` (a ``RowSplit``) of it.
+
+    Like ``TensorBatches``, each iteration is a new pass (reshuffled when
+    ``shuffle``) and the last batch may be smaller than ``batch_size``.
+    """
+
+    def __init__(self, stream: ChunkStream, batch_size: int, shuffle: bool = False, indices=None, device: Optional[torch.device] = None):
+        self.stream = stream
+        self.batch_size = max(1, int(batch_size))
+        self.shuffle = bool(shuffle)
+        self.indices = indices
+        self.device = device
+
+    def _emit(self, arrays: Tuple[np.ndarray, ...], n_rows: int):
+        for start in range(0, n_rows, self.batch_size):
+            stop = min(start + self.batch_size, n_rows)
+            batch = tuple(input_tensor(a[start:stop]) for a in arrays)
+            yield batch if self.device is None else tuple(t.to(self.device, non_blocking=True) for t in batch)
+
+    def __iter__(self):
+        threshold = self.stream.buffer_rows if self.shuffle else self.batch_size
+        parts: List[Tuple[np.ndarray, ...]] = []
+        n_rows = 0
+        chunks = None if self.indices is None else self.indices.chunk_ids()
+        try:
+            for chunk in self.stream.order(chunks, self.shuffle):
+                arrays = self.stream.read(chunk)
+                if self.indices is not None:
+                    rows = self.indices.rows(chunk)
+                    arrays = tuple(a[rows] for a in arrays)
+                parts.append(arrays)
+                n_rows += int(arrays[0].shape[0])
+                if n_rows < threshold:
+                    continue
+                pending = parts[0] if len(parts) == 1 else tuple(np.concatenate(columns) for columns in zip(*parts))
+                keep = 0
+                if self.shuffle:
+                    pending = self._permute(pending, n_rows)
+                    keep = self.stream.buffer_rows // 2
+                n_out = (n_rows - keep) // self.batch_size * self.batch_size
+                yield from self._emit(pending, n_out)
+                parts = [tuple(a[n_out:] for a in pending)]
+                n_rows -= n_out
+            if n_rows:
+                pending = parts[0] if len(parts) == 1 else tuple(np.concatenate(columns) for columns in zip(*parts))
+                if self.shuffle:
+                    pending = self._permute(pending, n_rows)
+                yield from self._emit(pending, n_rows)
+        finally:
+            self.stream.release()
+
+    @staticmethod
+    def _permute(arrays: Tuple[np.ndarray, ...], n_rows: int) -> Tuple[np.ndarray, ...]:
+        perm = torch.randperm(n_rows).numpy()
+        return tuple(a[perm] for a in arrays)
+
+
+def split_rows(source, n_rows: int, val_ratio: float, split: SplitFunction, shuffle: bool = True):
+    """Training and validation indices for the fits' ``indices=`` arguments.
+
+    ``split(n_rows, val_ratio)`` for in-memory data; a ``ChunkStream`` source
+    is split within its chunks instead (``ChunkStream.split``), holding out
+    the same number of rows. ``shuffle=False`` matches a split that holds out
+    the last rows.
+    """
+    if isinstance(source, ChunkStream):
+        return source.split(val_ratio, shuffle)
+    return split(n_rows, val_ratio)
+
+
+def open_stream(data, stream: Optional[Dict[str, Any]], prepare: Callable[[Any], Sequence[np.ndarray]]) -> Optional[ChunkStream]:
+    """A ``ChunkStream`` over ``data`` when it is a file path or memory map, else ``None``.
+
+    ``stream`` is the output of ``stream_options`` (``None`` for the defaults).
+    """
+    if not is_stream_input(data):
+        return None
+    return ChunkStream(data, prepare, **(stream if stream is not None else stream_options({})))
+
+
+def stream_or_array(data, stream: Optional[Dict[str, Any]], to_array: Callable[[Any], np.ndarray]):
+    """``to_array(data)``, or a single-array ``ChunkStream`` applying it chunk by chunk."""
+    source = open_stream(data, stream, lambda raw: (to_array(raw),))
+    return to_array(data) if source is None else source
@@ -2,16 +2,23 @@
 Unified PyTorch MLP classifier used by daltoolboxdp via reticulate.
 """
 
+from __future__ import annotations
+
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from scipy.stats import ttest_ind
-from torch.utils.data import DataLoader, TensorDataset
+
+from ingest_common import column_array, feature_matrix
+from parallel_common import uses_model_threads, validate_num_threads
+from stream_common import ChunkStream, open_stream, split_rows, stream_options
+from torch_common import ExportGraph, FitTelemetry, ForwardCompiler, LossAccumulator, RollingStopStats, StateSnapshot, TrainingCheckpoint, batch_iterator, batched_inference, checkpoint_options, export_model, input_tensor, load_model, partial_fit_args, profiling, quantization_report, quantize_dynamic_int8, save_model, serializable, validate_batch_engine, validate_loss_weighting
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 VALIDATION_STRATEGIES = {"static", "dynamic"}
@@ -31,6 +38,13 @@ class _TrainingConfig:
     test_window: int = 30
     p_value: float = 0.05
     weight_decay: float = 0.0
+    batch_engine: str = "tensor"
+    loss_weighting: str = "batch"
+    lazy_best: bool = False
+    checkpoint: Optional[dict] = None
+    stream: Optional[dict] = None
+    warm_start: bool = False
+    keep_training_state: bool = True
 
 
 def _activation_module(name: str) -> nn.Module:
@@ -112,7 +126,7 @@ class TorchMLPClassifierNet(nn.Module):
 
 
 class _StopController:
-    def __init__(self, rule: str, min_delta: float, patience: int, sma_window: int, ema_alpha: float, test_window: int, p_value: float):
+    def __init__(self, rule: str, min_delta: float, patience: int, sma_window: int, ema_alpha: float, test_window: int, p_value: float, lazy_best: bool = False):
         self.rule = rule
         self.min_delta = float(min_delta)
         self.patience = int(patience)
@@ -125,24 +139,29 @@ class _StopController:
         self.patience_ctr = 0
         self.ema_value = None
         self.val_history: List[float] = []
+        self.lazy_best = bool(lazy_best)
+        self.snapshot = StateSnapshot()
+        self.stats = RollingStopStats(self.sma_window, self.test_window)
 
     def _clone_state(self, model: nn.Module):
-        return {k: v.detach().clone() for k, v in model.state_dict().items()}
+        return self.snapshot.capture(model.state_dict())
 
     def _h_improved(self) -> bool:
-        if len(self.val_history) < 2 * self.test_window:
-            if len(self.val_history) == 1:
-                return True
-            return self.val_history[-1] < min(self.val_history[:-1])
-        prev_window = self.val_history[-2 * self.test_window : -self.test_window]
-        recent_window = self.val_history[-self.test_window :]
-        _, p_value = ttest_ind(prev_window, recent_window, equal_var=False, alternative="greater")
+        p_value = self.stats.welch_p_value()
+        if p_value is None:
+            # Until both windows are full, improvement means a new minimum.
+            return self.stats.is_new_min
         return bool(p_value < self.p_value)
 
     def step(self, model: nn.Module, current: float) -> bool:
         self.val_history.append(float(current))
+        self.stats.push(current)
         if self.rule == "none":
-            self.best_state = self._clone_state(model)
+            if not self.lazy_best:
+                self.best_state = self._clone_state(model)
+            elif (self.best_value - float(current)) > self.min_delta:
+                self.best_value = float(current)
+                self.best_state = self._clone_state(model)
             return False
         if self.rule == "h":
             improved = self._h_improved()
@@ -156,7 +175,7 @@ class _StopController:
         if self.rule == "patience":
             monitor_value = float(current)
         elif self.rule == "sma":
-            monitor_value = float(np.mean(self.val_history[-self.sma_window :]))
+            monitor_value = self.stats.sma()
         elif self.rule == "ema":
             if self.ema_value is None:
                 self.ema_value = current
@@ -175,6 +194,7 @@ class _StopController:
         return self.patience_ctr >= self.patience
 
 
+@serializable
 class TorchMLPClassifier:
     def __init__(
         self,
@@ -187,6 +207,9 @@ class TorchMLPClassifier:
         init_method: str = "default",
         validation_strategy: str = "static",
         stopping_rule: str = "none",
+        compile: bool = False,
+        precision: str = "fp32",
+        num_threads: Optional[int] = None,
     ):
         validation_strategy = str(validation_strategy).lower()
         stopping_rule = str(stopping_rule).lower()
@@ -196,6 +219,8 @@ class TorchMLPClassifier:
             raise ValueError(f"stopping_rule must be one of {sorted(STOPPING_RULES)}")
         self.validation_strategy = validation_strategy
         self.stopping_rule = stopping_rule
+        self.compiler = ForwardCompiler(compile, precision)
+        self.num_threads = validate_num_threads(num_threads)
         self.network = TorchMLPClassifierNet(
             input_dim,
             hidden_sizes,
@@ -209,20 +234,50 @@ class TorchMLPClassifier:
         self.train_loss_hist: List[float] = []
         self.val_loss_hist: List[float] = []
         self.epochs_done: int = 0
+        self.telemetry = FitTelemetry()
+        self.quantization_report = None
+        self._quantized: Optional[nn.Module] = None
 
     @staticmethod
     def _device():
         return torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+    def _inference_network(self):
+        # The int8 copy built by quantize() only runs on the CPU.
+        if self._quantized is not None:
+            return self._quantized, torch.device("cpu")
+        self.network.eval()
+        return self.compiler(self.network), self._device()
+
     @staticmethod
     def _prepare_xy(df: pd.DataFrame, target_column: str, classes_: Optional[List]) -> Tuple[torch.Tensor, torch.Tensor, List]:
-        X = df.drop(columns=[target_column]).to_numpy().astype(np.float32)
-        y_raw = df[target_column].to_numpy()
+        X = feature_matrix(df, exclude=[target_column])
+        y_raw = column_array(df, target_column)
         if classes_ is None:
+            import pandas as pd
+
             classes_ = sorted(pd.Series(y_raw).astype("category").cat.categories.tolist())
         class_to_idx = {c: i for i, c in enumerate(classes_)}
         y = np.array([class_to_idx[c] for c in y_raw], dtype=np.int64)
-        return torch.from_numpy(X), torch.from_numpy(y), classes_
+        return input_tensor(X), input_tensor(y), classes_
+
+    @staticmethod
+    def _chunk_arrays(raw, target_column: str, classes_: List) -> Tuple[np.ndarray, np.ndarray]:
+        class_to_idx = {c: i for i, c in enumerate(classes_)}
+        y = np.array([class_to_idx[c] for c in column_array(raw, target_column)], dtype=np.int64)
+        return feature_matrix(raw, exclude=[target_column]), y
+
+    @staticmethod
+    def _stream_classes(stream: ChunkStream, target_column: str) -> List:
+        # One pass over the target column only, when the classes are not given.
+        import pandas as pd
+
+        labels = stream.with_prepare(lambda raw: (column_array(raw, target_column),))
+        classes = set()
+        for chunk in range(len(labels.chunks)):
+            classes.update(pd.Series(labels.read(chunk)[0]).astype("category").cat.categories.tolist())
+        labels.release()
+        return sorted(classes)
 
     @staticmethod
     def _split_indices(n_samples: int, val_ratio: float) -> Tuple[np.ndarray, np.ndarray]:
@@ -231,84 +286,140 @@ class TorchMLPClassifier:
         n_val = max(1, int(n_samples * float(val_ratio)))
         return idx[n_val:], idx[:n_val]
 
-    def _epoch(self, loader: DataLoader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module) -> float:
-        losses: List[float] = []
+    def _loader(self, source, batch_size: int, shuffle: bool, batch_engine: str, indices=None):
+        if isinstance(source, ChunkStream):
+            return source.batches(batch_size, shuffle, indices, self._device())
+        return batch_iterator(source, batch_size, shuffle, batch_engine, indices=indices)
+
+    def _epoch(self, loader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module, loss_weighting: str = "batch") -> float:
+        losses = LossAccumulator(loss_weighting)
         if optimizer is None:
             self.network.eval()
             with torch.no_grad():
                 for xb, yb in loader:
-                    xb = xb.float().to(self._device())
-                    yb = yb.long().to(self._device())
-                    losses.append(float(criterion(self.network(xb), yb).item()))
+                    losses.add(criterion(self.compiler(self.network)(xb), yb), xb.size(0))
         else:
             self.network.train()
             for xb, yb in loader:
-                xb = xb.float().to(self._device())
-                yb = yb.long().to(self._device())
                 optimizer.zero_grad()
-                loss = criterion(self.network(xb), yb)
+                loss = criterion(self.compiler(self.network)(xb), yb)
                 loss.backward()
                 optimizer.step()
-                losses.append(float(loss.item()))
-        return float(np.mean(losses)) if losses else 0.0
+                losses.add(loss, xb.size(0))
+        return losses.value()
 
     def fit(self, df_train: pd.DataFrame, target_column: str, config: _TrainingConfig, classes_: Optional[List] = None):
 
-        X_all, y_all, self.classes_ = self._prepare_xy(df_train, target_column, classes_)
+        if config.warm_start and classes_ is None:
+            # A partial fit keeps the label encoding of the fit it continues.
+            classes_ = self.classes_ or None
+        stream = open_stream(df_train, config.stream, lambda raw: self._chunk_arrays(raw, target_column, self.classes_))
+        if stream is None:
+            X_all, y_all, self.classes_ = self._prepare_xy(df_train, target_column, classes_)
+            source = (X_all.to(self._device()), y_all.to(self._device()))
+            n_units = X_all.shape[0]
+        else:
+            self.classes_ = classes_ if classes_ is not None else self._stream_classes(stream, target_column)
+            source, n_units = stream, len(stream)
         criterion = nn.CrossEntropyLoss()
         optimizer = torch.optim.Adam(self.network.parameters(), lr=float(config.lr), weight_decay=float(config.weight_decay))
-        stopper = _StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value)
-
-        self.train_loss_hist = []
-        self.val_loss_hist = []
-        self.epochs_done = 0
+        stopper = _StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value, lazy_best=config.lazy_best)
+
+        if not config.warm_start:
+            self.train_loss_hist = []
+            self.val_loss_hist = []
+            self.epochs_done = 0
+        self.telemetry = FitTelemetry(compiler=self.compiler)
+        self.quantization_report = None
+        self._quantized = None
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, ("train_loss_hist", "val_loss_hist", "epochs_done"), {"network": self.network}, warm_start=config.warm_start, keep_state=config.keep_training_state)
+        checkpoint.begin()
 
         if self.validation_strategy == "static" and self.stopping_rule != "none":
-            train_idx, val_idx = self._split_indices(X_all.shape[0], config.val_ratio)
-            train_loader = DataLoader(TensorDataset(X_all[train_idx], y_all[train_idx]), batch_size=int(config.batch_size), shuffle=True, drop_last=False)
-            val_loader = DataLoader(TensorDataset(X_all[val_idx], y_all[val_idx]), batch_size=int(config.batch_size), shuffle=False, drop_last=False)
+            train_idx, val_idx = split_rows(stream, n_units, config.val_ratio, self._split_indices)
+            train_loader = self._loader(source, config.batch_size, True, config.batch_engine, indices=train_idx)
+            val_loader = self._loader(source, config.batch_size, False, config.batch_engine, indices=val_idx)
         elif self.validation_strategy == "static":
-            train_loader = DataLoader(TensorDataset(X_all, y_all), batch_size=int(config.batch_size), shuffle=True, drop_last=False)
+            train_loader = self._loader(source, config.batch_size, True, config.batch_engine)
             val_loader = None
         else:
             train_loader = None
             val_loader = None
 
-        for epoch in range(int(config.epochs)):
+        for epoch in checkpoint.epochs(int(config.epochs), {"optimizer": optimizer}, stopper):
+            self.telemetry.start_epoch()
             self.epochs_done += 1
             if self.validation_strategy == "dynamic":
-                train_idx, val_idx = self._split_indices(X_all.shape[0], config.val_ratio)
-                train_loader = DataLoader(TensorDataset(X_all[train_idx], y_all[train_idx]), batch_size=int(config.batch_size), shuffle=True, drop_last=False)
-                val_loader = DataLoader(TensorDataset(X_all[val_idx], y_all[val_idx]), batch_size=int(config.batch_size), shuffle=False, drop_last=False)
+                train_idx, val_idx = split_rows(stream, n_units, config.val_ratio, self._split_indices)
+                train_loader = self._loader(source, config.batch_size, True, config.batch_engine, indices=train_idx)
+                val_loader = self._loader(source, config.batch_size, False, config.batch_engine, indices=val_idx)
 
-            self.train_loss_hist.append(self._epoch(train_loader, optimizer, criterion))
+            self.train_loss_hist.append(self._epoch(self.telemetry.batches(train_loader), optimizer, criterion, config.loss_weighting))
             if val_loader is not None:
-                val_loss = self._epoch(val_loader, None, criterion)
+                with self.telemetry.phase("validation"):
+                    val_loss = self._epoch(val_loader, None, criterion, config.loss_weighting)
                 self.val_loss_hist.append(val_loss)
-                if stopper.step(self.network, val_loss):
+                with self.telemetry.phase("snapshot"):
+                    stop = stopper.step(self.network, val_loss)
+                if stop:
                     break
 
+        self.telemetry.stop()
+        checkpoint.close()
         if stopper.best_state is not None:
             self.network.load_state_dict(stopper.best_state)
         return self
 
-    def predict(self, df_test: pd.DataFrame):
-        X = torch.from_numpy(df_test.to_numpy().astype(np.float32))
-        self.network.eval()
-        with torch.no_grad():
-            logits = self.network(X.to(self._device()))
-            pred_idx = torch.argmax(logits, dim=-1).cpu().numpy().tolist()
-        idx_to_class = {i: c for i, c in enumerate(self.classes_)}
-        return [idx_to_class[i] for i in pred_idx]
-
-    def predict_scores(self, df_test: pd.DataFrame):
-        X = torch.from_numpy(df_test.to_numpy().astype(np.float32))
-        self.network.eval()
-        with torch.no_grad():
-            logits = self.network(X.to(self._device()))
-            scores = F.softmax(logits, dim=-1).cpu().numpy()
+    def _infer(self, df_test: pd.DataFrame, batch_size: int, labels: bool, scores: bool):
+        # One forward per chunk of rows; labels and scores share its logits.
+        X = feature_matrix(df_test)
+        network, device = self._inference_network()
+
+        def forward(xb):
+            logits = network(xb)
+            outs = ()
+            if labels:
+                outs += (torch.argmax(logits, dim=-1),)
+            if scores:
+                outs += (F.softmax(logits, dim=-1),)
+            return outs
+
+        return batched_inference(forward, X, batch_size, device)
+
+    def _labels(self, pred_idx: np.ndarray) -> List:
+        return np.asarray(self.classes_, dtype=object)[pred_idx].tolist()
+
+    def predict(self, df_test: pd.DataFrame, batch_size: int = 4096):
+        (pred_idx,) = self._infer(df_test, batch_size, labels=True, scores=False)
+        return self._labels(pred_idx)
+
+    def predict_scores(self, df_test: pd.DataFrame, batch_size: int = 4096):
+        (scores,) = self._infer(df_test, batch_size, labels=False, scores=True)
         return scores.tolist()
 
+    def predict_with_scores(self, df_test: pd.DataFrame, batch_size: int = 4096):
+        """Labels and class probabilities from a single forward pass."""
+        pred_idx, scores = self._infer(df_test, batch_size, labels=True, scores=True)
+        return self._labels(pred_idx), scores.tolist()
+
+    def quantize(self, df_validation=None, batch_size: int = 4096):
+        """Switch prediction to a dynamic int8 copy of the network and report its accuracy.
+
+        ``nn.Linear``/``nn.LSTM`` weights are quantized to int8 (see
+        ``quantize_dynamic_int8``); the fp32 network is kept for training,
+        export and saving. With ``df_validation`` the report compares int8
+        and fp32 predictions on it, including how often the predicted class agrees.
+        """
+        self.network.eval()
+        quantized = quantize_dynamic_int8(self.network)
+        inputs = None if df_validation is None else feature_matrix(df_validation)
+        self.quantization_report = quantization_report(self.network, quantized, lambda net, xb: F.softmax(net(xb), dim=-1), inputs, batch_size, labels=True)
+        self._quantized = quantized
+        return self.quantization_report
+
+    def _export_graphs(self):
+        return {"predict": ExportGraph(self.network, (self.init_args["input_dim"],), output="softmax")}
+
 
 def torch_cla_mlp_create(
     input_dim: int,
@@ -320,7 +431,19 @@ def torch_cla_mlp_create(
     init_method: str = "default",
     validation_strategy: str = "static",
     stopping_rule: str = "none",
+    compile: bool = False,
+    precision: str = "fp32",
+    num_threads: Optional[int] = None,
 ):
+    """Create an MLP classifier.
+
+    ``compile=True`` runs the forwards through ``torch.compile`` and
+    ``precision="bf16"`` under bfloat16 autocast. The telemetry of every fit
+    then holds ``compile``: graphs built and the seconds spent compiling, in
+    compiled steps and in eager fallback, to judge whether compiling pays off;
+    ``model.compiler.report()`` has the same counters over the model's
+    lifetime, predictions included.
+    """
     return TorchMLPClassifier(
         input_dim,
         hidden_sizes,
@@ -331,9 +454,13 @@ def torch_cla_mlp_create(
         init_method=init_method,
         validation_strategy=validation_strategy,
         stopping_rule=stopping_rule,
+        compile=compile,
+        precision=precision,
+        num_threads=num_threads,
     )
 
 
+@uses_model_threads
 def torch_cla_mlp_fit(
     model,
     df_train: pd.DataFrame,
@@ -352,6 +479,14 @@ def torch_cla_mlp_fit(
     p_value: float = 0.05,
     weight_decay: float = 0.0,
     classes_: Optional[List] = None,
+    batch_engine: str = "tensor",
+    loss_weighting: str = "batch",
+    lazy_best: bool = False,
+    profile: Optional[Union[str, dict]] = None,
+    checkpoint: Optional[Union[str, dict]] = None,
+    stream: Optional[dict] = None,
+    warm_start: bool = False,
+    keep_training_state: bool = True,
 ):
     model.validation_strategy = str(validation_strategy).lower()
     model.stopping_rule = str(stopping_rule).lower()
@@ -367,17 +502,61 @@ def torch_cla_mlp_fit(
         test_window=int(test_window),
         p_value=float(p_value),
         weight_decay=float(weight_decay),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+        checkpoint=checkpoint_options(checkpoint),
+        stream=stream_options(stream),
+        warm_start=bool(warm_start),
+        keep_training_state=bool(keep_training_state),
     )
-    return model.fit(df_train, target_column=target_column, config=config, classes_=classes_)
+    with profiling(profile, "torch_cla_mlp_fit", steps=True):
+        return model.fit(df_train, target_column=target_column, config=config, classes_=classes_)
+
+
+def torch_cla_mlp_partial_fit(model, df_train, target_column, epochs=1, **kwargs):
+    return torch_cla_mlp_fit(model, df_train, target_column, epochs=epochs, **partial_fit_args(model, kwargs))
+
+
+@uses_model_threads
+def torch_cla_mlp_predict(model, df_test: pd.DataFrame, classes_: Optional[List] = None, profile: Optional[Union[str, dict]] = None, batch_size: int = 4096):
+    if classes_ is not None and not model.classes_:
+        model.classes_ = list(classes_)
+    with profiling(profile, "torch_cla_mlp_predict"):
+        return model.predict(df_test, batch_size=batch_size)
 
 
-def torch_cla_mlp_predict(model, df_test: pd.DataFrame, classes_: Optional[List] = None):
+@uses_model_threads
+def torch_cla_mlp_predict_scores(model, df_test: pd.DataFrame, classes_: Optional[List] = None, profile: Optional[Union[str, dict]] = None, batch_size: int = 4096):
     if classes_ is not None and not model.classes_:
         model.classes_ = list(classes_)
-    return model.predict(df_test)
+    with profiling(profile, "torch_cla_mlp_predict_scores"):
+        return model.predict_scores(df_test, batch_size=batch_size)
 
 
-def torch_cla_mlp_predict_scores(model, df_test: pd.DataFrame, classes_: Optional[List] = None):
+@uses_model_threads
+def torch_cla_mlp_predict_with_scores(model, df_test: pd.DataFrame, classes_: Optional[List] = None, profile: Optional[Union[str, dict]] = None, batch_size: int = 4096):
     if classes_ is not None and not model.classes_:
         model.classes_ = list(classes_)
-    return model.predict_scores(df_test)
+    with profiling(profile, "torch_cla_mlp_predict_with_scores"):
+        return model.predict_with_scores(df_test, batch_size=batch_size)
+
+
+def torch_cla_mlp_save(model, path, include_training_state=False):
+    return save_model(model, path, include_training_state=include_training_state)
+
+
+def torch_cla_mlp_load(path, mmap=True, quantize=False):
+    model = load_model(path, TorchMLPClassifier, mmap=mmap)
+    if quantize:
+        model.quantize()
+    return model
+
+
+def torch_cla_mlp_export(model, path, formats=("torchscript", "onnx"), opset=17):
+    return export_model(model, path, formats=formats, opset=opset)
+
+
+@uses_model_threads
+def torch_cla_mlp_quantize(model, df_validation=None, batch_size=4096):
+    return model.quantize(df_validation, batch_size=batch_size)
@@ -0,0 +1,1413 @@
+"""
+Shared tensor utilities for daltoolboxdp torch backends.
+"""
+
+import copy
+import functools
+import inspect
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch.overrides import TorchFunctionMode
+from torch.utils.data import DataLoader, Subset, TensorDataset
+
+from ingest_common import feature_matrix
+
+
+BATCH_ENGINES = {"tensor", "dataloader"}
+LOSS_WEIGHTINGS = {"batch", "sample"}
+PRECISIONS = {"fp32", "bf16"}
+CHECKPOINT_OPTIONS = {"path", "every", "resume"}
+MODEL_FILE = "model.json"
+WEIGHTS_FILE = "weights.bin"
+TRAINING_STATE_FILE = "training.pt"
+EXPORT_FILE = "export.json"
+EXPORT_FORMATS = {"torchscript", "onnx"}
+EXPORT_OUTPUTS = {"rows", "vector", "softmax"}
+PROFILE_OPTIONS = {"dir", "wait", "warmup", "active", "repeat", "record_shapes", "profile_memory", "with_stack", "sort_by", "row_limit"}
+
+
+def validate_batch_engine(batch_engine: str) -> str:
+    batch_engine = str(batch_engine).lower()
+    if batch_engine not in BATCH_ENGINES:
+        raise ValueError(f"batch_engine must be one of {sorted(BATCH_ENGINES)}")
+    return batch_engine
+
+
+def validate_loss_weighting(loss_weighting: str) -> str:
+    loss_weighting = str(loss_weighting).lower()
+    if loss_weighting not in LOSS_WEIGHTINGS:
+        raise ValueError(f"loss_weighting must be one of {sorted(LOSS_WEIGHTINGS)}")
+    return loss_weighting
+
+
+def validate_precision(precision: str) -> str:
+    precision = str(precision).lower()
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {sorted(PRECISIONS)}")
+    return precision
+
+
+def as_float32_array(data) -> np.ndarray:
+    """Convert an array, DataFrame or Arrow table to a C-contiguous float32 array.
+
+    See ``ingest_common.feature_matrix``: float32 C-contiguous inputs are used
+    as is and anything else is converted with a single copy.
+    """
+    return feature_matrix(data)
+
+
+
+def input_tensor(array: np.ndarray) -> torch.Tensor:
+    """``torch.from_numpy`` for input buffers that fits and inference only read.
+
+    Zero-copy ingestion can hand over read-only arrays (Arrow buffers,
+    copy-on-write pandas views, shared memory); the tensor shares them
+    without the non-writable warning.
+    """
+    if array.flags.writeable:
+        return torch.from_numpy(array)
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+        return torch.from_numpy(array)
+
+
+def _callable_key(fn):
+    # Bound methods are re-created on every attribute access; key them by owner.
+    owner = getattr(fn, "__self__", None)
+    if owner is not None:
+        return id(owner), getattr(fn, "__func__", fn)
+    return id(fn)
+
+
+def _to_float32(out):
+    if isinstance(out, torch.Tensor):
+        return out.float() if out.is_floating_point() else out
+    if isinstance(out, tuple):
+        return tuple(_to_float32(o) for o in out)
+    return out
+
+
+def _dynamo_graphs() -> int:
+    """Graphs compiled by ``torch._dynamo`` so far in this process."""
+    from torch._dynamo.utils import counters
+
+    return int(counters["stats"]["unique_graphs"])
+
+
+class _CompiledCall:
+    def __init__(self, compiler: "ForwardCompiler", key, fn, compiled):
+        self.compiler = compiler
+        self.key = key
+        self.fn = fn
+        self.compiled = compiled
+        owner = getattr(fn, "__self__", fn)
+        self.module = owner if isinstance(owner, torch.nn.Module) else None
+
+    def __call__(self, *args):
+        if self.compiler.precision == "bf16":
+            device_type = next((a.device.type for a in args if isinstance(a, torch.Tensor)), "cpu")
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                out = self._run(*args)
+            # Losses, snapshots and numpy conversion all see float32 outputs.
+            return _to_float32(out)
+        return self._run(*args)
+
+    def _run(self, *args):
+        compiler = self.compiler
+        if not compiler.active:
+            return self.fn(*args)
+        signature = (
+            self.key,
+            tuple(tuple(a.shape) if isinstance(a, torch.Tensor) else None for a in args),
+            None if self.module is None else self.module.training,
+            torch.is_grad_enabled(),
+        )
+        before = _dynamo_graphs()
+        start = time.perf_counter()
+        try:
+            out = self.compiled(*args)
+        except Exception as exc:  # any compiler/backend failure: run eagerly from now on
+            compiler.fallback = f"{type(exc).__name__}: {exc}"
+            compiler.active = False
+            return self.fn(*args)
+        elapsed = time.perf_counter() - start
+        graphs = _dynamo_graphs() - before
+        if graphs:
+            # A compile (or a recompile after a guard failure) happened in this call.
+            compiler.signatures[signature] = True
+            compiler.graphs += graphs
+            compiler.compiles += 1
+            compiler.compile_seconds += elapsed
+        elif compiler.signatures.setdefault(signature, False):
+            compiler.step_seconds += elapsed
+            compiler.steps += 1
+        else:
+            # A new signature that produced no graph was skipped by dynamo (e.g. past
+            # its recompile limit) and runs eagerly, now and on every later call.
+            compiler.eager_seconds += elapsed
+            compiler.eager_steps += 1
+            if compiler.fallback is None:
+                compiler.fallback = "torch._dynamo compiled no graph for some input signatures (recompile limit reached?); they run eagerly"
+        return out
+
+
+class ForwardCompiler:
+    """Opt-in ``torch.compile`` and reduced-precision execution for a model's forwards.
+
+    ``compiler(module)`` returns the module unchanged when compilation is off
+    and precision is ``"fp32"``, otherwise a cached wrapper. Graphs are static
+    per input shape (``dynamic=False``), so a ragged last batch gets its own
+    graph. Compile events are read from the ``torch._dynamo`` graph counter:
+    calls that compiled (including recompiles) are accounted as compile time,
+    later calls of a compiled (shape, train/eval, grad) signature as step time
+    and calls of a signature dynamo left uncompiled (past
+    ``torch._dynamo.config.recompile_limit``, shared by every compiled module
+    of the process) as eager time. Any compiler failure switches the model
+    back to eager execution; both cases are recorded in ``fallback``.
+
+    With ``precision="bf16"`` each forward runs under ``torch.autocast`` with
+    bfloat16 (backward replays the same casts) and its outputs are returned as
+    float32; parameters and optimizer state stay float32 master copies.
+
+    ``report()`` gives the counters over the model's lifetime, predictions
+    included; every fit's ``FitTelemetry`` reports those of the fit under
+    ``"compile"``.
+    """
+
+    COUNTERS = ("graphs", "compiles", "compile_seconds", "step_seconds", "steps", "eager_seconds", "eager_steps")
+
+    def __init__(self, enabled: bool = False, precision: str = "fp32"):
+        self.enabled = bool(enabled)
+        self.precision = validate_precision(precision)
+        self.active = self.enabled and hasattr(torch, "compile")
+        self.fallback: Optional[str] = None if self.active or not self.enabled else "torch.compile is unavailable"
+        self.calls: Dict[Any, _CompiledCall] = {}
+        self.signatures: Dict[Any, bool] = {}
+        self.graphs = 0
+        self.compiles = 0
+        self.compile_seconds = 0.0
+        self.step_seconds = 0.0
+        self.steps = 0
+        self.eager_seconds = 0.0
+        self.eager_steps = 0
+
+    def __call__(self, fn):
+        if not self.active and self.precision == "fp32":
+            return fn
+        key = _callable_key(fn)
+        call = self.calls.get(key)
+        if call is None:
+            compiled = torch.compile(fn, dynamic=False) if self.active else None
+            call = _CompiledCall(self, key, fn, compiled)
+            self.calls[key] = call
+        return call
+
+    def report(self, since: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Settings and counters, the latter net of an earlier ``report`` when ``since`` is given."""
+        report = {
+            "enabled": self.enabled,
+            "active": self.active,
+            "precision": self.precision,
+            "graphs": self.graphs,
+            "compiles": self.compiles,
+            "compile_seconds": self.compile_seconds,
+            "step_seconds": self.step_seconds,
+            "steps": self.steps,
+            "eager_signatures": sum(not compiled for compiled in self.signatures.values()),
+            "eager_seconds": self.eager_seconds,
+            "eager_steps": self.eager_steps,
+            "fallback": self.fallback,
+        }
+        if since is not None:
+            for name in self.COUNTERS:
+                report[name] -= since[name]
+        return report
+
+
+class TensorBatches:
+    """Mini-batch iterator over tensors that stay resident for the whole fit.
+
+    Each pass draws a single ``torch.randperm`` when shuffling and yields
+    ``index_select`` batches; without shuffling it yields zero-copy slices.
+    ``indices`` restricts the pass to a subset of rows (e.g. a train or
+    validation split) without copying the underlying tensors.
+    """
+
+    def __init__(self, tensors: Sequence[torch.Tensor], batch_size: int, shuffle: bool = False, indices=None):
+        self.tensors: Tuple[torch.Tensor, ...] = tuple(t.contiguous() for t in tensors)
+        if not self.tensors:
+            raise ValueError("At least one tensor is required.")
+        n_rows = int(self.tensors[0].shape[0])
+        if any(int(t.shape[0]) != n_rows for t in self.tensors):
+            raise ValueError("All tensors must share the first dimension.")
+        self.indices: Optional[torch.Tensor] = None
+        if indices is not None:
+            self.indices = torch.as_tensor(indices, dtype=torch.long).to(self.tensors[0].device)
+        self.n_samples = n_rows if self.indices is None else int(self.indices.shape[0])
+        self.batch_size = max(1, int(batch_size))
+        self.shuffle = bool(shuffle)
+
+    def __len__(self) -> int:
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = self.indices
+        if self.shuffle:
+            perm = torch.randperm(self.n_samples, device=self.tensors[0].device)
+            order = perm if order is None else order.index_select(0, perm)
+        for start in range(0, self.n_samples, self.batch_size):
+            stop = min(start + self.batch_size, self.n_samples)
+            if order is None:
+                yield tuple(t[start:stop] for t in self.tensors)
+            else:
+                idx = order[start:stop]
+                yield tuple(t.index_select(0, idx) for t in self.tensors)
+
+
+def batch_iterator(tensors: Sequence[torch.Tensor], batch_size: int, shuffle: bool, batch_engine: str = "tensor", indices=None):
+    if validate_batch_engine(batch_engine) == "dataloader":
+        dataset = TensorDataset(*tensors)
+        if indices is not None:
+            dataset = Subset(dataset, indices)
+        return DataLoader(dataset, batch_size=int(batch_size), shuffle=shuffle, drop_last=False)
+    return TensorBatches(tensors, batch_size, shuffle=shuffle, indices=indices)
+
+
+def batched_inference(forward, inputs, batch_size: int, device: Optional[torch.device] = None) -> np.ndarray:
+    """Run ``forward`` over row slices of ``inputs`` into one preallocated output.
+
+    Batches are zero-copy slices of ``inputs`` (moved to ``device`` when given)
+    evaluated under ``torch.inference_mode``. The output array is allocated
+    once, from the shape of the first batch's result, and every batch is
+    copied straight into its rows, so peak memory stays close to the input
+    plus the output. An empty input still runs ``forward`` once on an empty
+    slice to obtain the output shape. When ``forward`` returns a tuple of
+    tensors, one array is preallocated per element and a tuple is returned.
+    """
+    if isinstance(inputs, np.ndarray):
+        inputs = input_tensor(np.ascontiguousarray(inputs, dtype=np.float32))
+    n_rows = int(inputs.shape[0])
+    batch_size = max(1, int(batch_size))
+    outs: Optional[Tuple[torch.Tensor, ...]] = None
+    multiple = False
+    with torch.inference_mode():
+        for start in range(0, max(n_rows, 1), batch_size):
+            stop = min(start + batch_size, n_rows)
+            xb = inputs[start:stop]
+            if device is not None:
+                xb = xb.to(device, non_blocking=True)
+            yb = forward(xb.float())
+            multiple = isinstance(yb, tuple)
+            results = yb if multiple else (yb,)
+            if outs is None:
+                outs = tuple(torch.empty((n_rows,) + tuple(r.shape[1:]), dtype=r.dtype) for r in results)
+            for out, result in zip(outs, results):
+                out[start:stop].copy_(result)
+    arrays = tuple(out.numpy() for out in outs)
+    return arrays if multiple else arrays[0]
+
+
+class LossAccumulator:
+    """Sum detached batch losses on the loss device and read them back once.
+
+    ``loss_weighting="batch"`` averages batch losses (the historical epoch
+    loss); ``"sample"`` weights each batch by its size so a ragged final
+    batch counts proportionally.
+    """
+
+    def __init__(self, loss_weighting: str = "batch"):
+        self.by_sample = validate_loss_weighting(loss_weighting) == "sample"
+        self.total: Optional[torch.Tensor] = None
+        self.weight = 0
+
+    def add(self, loss: torch.Tensor, batch_size: int):
+        weight = int(batch_size) if self.by_sample else 1
+        value = loss.detach().to(torch.float64)
+        if self.total is None:
+            self.total = torch.zeros_like(value)
+        self.total.add_(value, alpha=weight)
+        self.weight += weight
+
+    def value(self) -> float:
+        if self.total is None or self.weight == 0:
+            return 0.0
+        return float(self.total.item()) / self.weight
+
+    def values(self) -> np.ndarray:
+        """Epoch losses of a vector of per-model batch losses (one entry per model)."""
+        if self.total is None or self.weight == 0:
+            return np.zeros(0)
+        return self.total.cpu().numpy() / self.weight
+
+
+def _clone_state(state):
+    if isinstance(state, dict):
+        return {k: _clone_state(v) for k, v in state.items()}
+    return state.detach().clone()
+
+
+def _copy_state(buffer, state):
+    if isinstance(state, dict):
+        for k, v in state.items():
+            _copy_state(buffer[k], v)
+    else:
+        buffer.copy_(state.detach())
+
+
+class StateSnapshot:
+    """Best-weights buffer allocated on the first capture and refreshed in place.
+
+    Nested state dicts (for example ``{"Q": ..., "P": ..., "D": ...}``) share a
+    single buffer, so multi-network models are covered by one snapshot.
+    """
+
+    def __init__(self):
+        self.buffer: Optional[Dict[str, Any]] = None
+
+    def capture(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        with torch.no_grad():
+            if self.buffer is None:
+                self.buffer = _clone_state(state)
+            else:
+                _copy_state(self.buffer, state)
+        return self.buffer
+
+
+def serializable(cls):
+    """Class decorator recording the constructor arguments in ``init_args`` for ``save_model``."""
+    init = cls.__init__
+    signature = inspect.signature(init)
+
+    @functools.wraps(init)
+    def __init__(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        self.init_args = {k: v for k, v in bound.arguments.items() if k != "self"}
+        init(self, *args, **kwargs)
+
+    cls.__init__ = __init__
+    return cls
+
+
+_NOT_JSON = object()
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (int, float, np.integer, np.floating, np.bool_)):
+        return value.item() if isinstance(value, np.generic) else value
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        items = [_jsonable(v) for v in value]
+        return _NOT_JSON if any(v is _NOT_JSON for v in items) else items
+    return _NOT_JSON
+
+
+def _model_modules(model) -> Dict[str, torch.nn.Module]:
+    modules = {}
+    for name, value in vars(model).items():
+        if name.startswith("_"):
+            # Derived modules (e.g. the int8 copy from quantize) are rebuilt, not stored.
+            continue
+        if isinstance(value, torch.nn.Module):
+            modules[name] = value
+        elif isinstance(value, (list, tuple)) and value and all(isinstance(v, torch.nn.Module) for v in value):
+            for i, unit in enumerate(value):
+                modules[f"{name}.{i}"] = unit
+    return modules
+
+
+def _warm_stage_state(optimizers: Dict[str, torch.optim.Optimizer], stopper) -> Dict[str, Any]:
+    # Tensors and primitives only, so training.pt loads with weights_only=True.
+    # The best weights are left out: a warm start resets them (new rows).
+    state = _stop_controller_state(stopper, best_state=False)
+    state["ema_value"] = None if state["ema_value"] is None else float(state["ema_value"])
+    return {"optimizers": {name: optimizer.state_dict() for name, optimizer in optimizers.items()}, "stopper": state}
+
+
+def _training_state(model) -> Optional[Dict[int, Dict[str, Any]]]:
+    """The warm-start state kept on ``model``, reading ``training.pt`` the first time it is needed."""
+    path = getattr(model, "_training_state_path", None)
+    if path is not None:
+        del model._training_state_path
+        model._warm_state = torch.load(path, map_location="cpu", weights_only=True)
+    return getattr(model, "_warm_state", None) or None
+
+
+def has_training_state(model) -> bool:
+    """Whether ``model`` keeps (or can load) optimizer and stop controller state for ``partial_fit``."""
+    return getattr(model, "_training_state_path", None) is not None or bool(getattr(model, "_warm_state", None))
+
+
+def save_model(model, path: str, include_training_state: bool = False) -> str:
+    """Write ``model`` to the directory ``path`` as hyperparameters plus one flat weight file.
+
+    ``model.json`` holds the constructor arguments, the plain attributes
+    (histories, classes, strategies) and an index of every tensor;
+    ``weights.bin`` holds the raw tensors back to back, each 64-byte aligned,
+    so ``load_model`` can map them without copying. With
+    ``include_training_state=True`` the optimizer and stop controller state a
+    fit kept (``keep_training_state``, on by default) is also written to
+    ``training.pt``, for a ``partial_fit`` of the loaded model to continue
+    from.
+    """
+    path = str(path)
+    init_args = {}
+    for name, value in getattr(model, "init_args", {}).items():
+        converted = _jsonable(value)
+        if converted is _NOT_JSON:
+            raise TypeError(f"Constructor argument {name!r} of {type(model).__name__} cannot be saved")
+        init_args[name] = converted
+    attributes = {}
+    for name, value in vars(model).items():
+        if name not in ("init_args", "_training_state_path"):
+            converted = _jsonable(value)
+            if converted is not _NOT_JSON:
+                attributes[name] = converted
+
+    os.makedirs(path, exist_ok=True)
+    index: Dict[str, Dict[str, Any]] = {}
+    offset = 0
+    with open(os.path.join(path, WEIGHTS_FILE), "wb") as handle:
+        for module_name, module in _model_modules(model).items():
+            entries = index.setdefault(module_name, {})
+            for key, tensor in module.state_dict().items():
+                array = tensor.detach().cpu().contiguous().numpy()
+                padding = -offset % 64
+                handle.write(b"\0" * padding)
+                offset += padding
+                handle.write(array.tobytes())
+                entries[key] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+                offset += array.nbytes
+    meta = {
+        "format": 1,
+        "module": type(model).__module__,
+        "class": type(model).__name__,
+        "torch_version": torch.__version__,
+        "init_args": init_args,
+        "attributes": attributes,
+        "weights": index,
+    }
+    with open(os.path.join(path, MODEL_FILE), "w") as handle:
+        json.dump(meta, handle)
+    training_path = os.path.join(path, TRAINING_STATE_FILE)
+    warm_state = _training_state(model) if include_training_state else None
+    if warm_state:
+        torch.save(warm_state, training_path)
+    elif os.path.exists(training_path):
+        # A stale file would hand an older optimizer state to partial_fit.
+        os.remove(training_path)
+    return path
+
+
+class _MetaMoves(TorchFunctionMode):
+    # Constructors move their modules to the training device; on the meta
+    # device that move has nothing to copy, so it is recorded instead.
+    def __init__(self):
+        super().__init__()
+        self.device = torch.device("cpu")
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func is torch.Tensor.to and args and args[0].is_meta:
+            dtype = kwargs.get("dtype")
+            for value in (*args[1:], kwargs.get("device")):
+                if isinstance(value, (torch.device, str)):
+                    self.device = torch.device(value)
+                elif isinstance(value, torch.dtype):
+                    dtype = value
+                elif isinstance(value, torch.Tensor):
+                    self.device, dtype = value.device, value.dtype
+            return args[0] if dtype is None else func(args[0], dtype=dtype)
+        return func(*args, **kwargs)
+
+
+@contextmanager
+def _meta_construction():
+    """Build modules on the meta device (no memory, no initialisation) for ``load_state_dict(assign=True)``.
+
+    Both modes are thread-local, so modules built by other threads meanwhile
+    are initialised as usual. Yields the recorder of the device the
+    constructor moved its modules to.
+    """
+    moves = _MetaMoves()
+    with torch.device("meta"), moves:
+        yield moves
+
+
+def load_model(path: str, cls, mmap: bool = True):
+    """Rebuild a model of class ``cls`` written by ``save_model``.
+
+    With ``mmap=True`` the weight file is mapped copy-on-write and every
+    parameter is a view into the mapping: nothing is read until it is used,
+    processes loading the same file share its pages, and a later ``fit``
+    writes to private copies rather than to the file. A ``training.pt`` next
+    to the weights is only read by the first ``partial_fit``.
+    """
+    path = str(path)
+    with open(os.path.join(path, MODEL_FILE)) as handle:
+        meta = json.load(handle)
+    if meta["class"] != cls.__name__:
+        raise ValueError(f"{path} holds a {meta['class']}, not a {cls.__name__}")
+    with _meta_construction() as moves:
+        model = cls(**meta["init_args"])
+    for name, value in meta["attributes"].items():
+        setattr(model, name, value)
+
+    training_path = os.path.join(path, TRAINING_STATE_FILE)
+    if os.path.exists(training_path):
+        model._training_state_path = training_path
+
+    weights_path = os.path.join(path, WEIGHTS_FILE)
+    weights = np.memmap(weights_path, dtype=np.uint8, mode="c") if mmap and os.path.getsize(weights_path) else np.fromfile(weights_path, dtype=np.uint8)
+    modules = _model_modules(model)
+    replaced: Dict[int, torch.nn.Parameter] = {}
+    for module_name, entries in meta["weights"].items():
+        module = modules[module_name]
+        previous = dict(module.named_parameters())
+        state = {}
+        for key, entry in entries.items():
+            dtype = np.dtype(entry["dtype"])
+            nbytes = int(np.prod(entry["shape"], dtype=np.int64)) * dtype.itemsize
+            start = int(entry["offset"])
+            state[key] = torch.from_numpy(weights[start : start + nbytes].view(dtype).reshape(entry["shape"]))
+        module.load_state_dict(state, assign=True)
+        replaced.update({id(previous[name]): param for name, param in module.named_parameters() if name in previous})
+    # Optimizers built by the constructor still hold the meta parameters.
+    for value in vars(model).values():
+        if isinstance(value, torch.optim.Optimizer):
+            for group in value.param_groups:
+                group["params"] = [replaced.get(id(param), param) for param in group["params"]]
+    for module_name, module in modules.items():
+        unloaded = [name for name, tensor in (*module.named_parameters(), *module.named_buffers()) if tensor.is_meta]
+        if unloaded:
+            raise ValueError(f"{path} has no saved values for {module_name}: {', '.join(unloaded)}")
+        if moves.device.type != "cpu":
+            module.to(moves.device)
+    return model
+
+
+class ExportGraph(torch.nn.Module):
+    """Deployment forward of one model half: flat float32 rows in, rows out.
+
+    The input ``(n, prod(input_shape))`` is reshaped to ``(n, *input_shape)``
+    inside the graph, ``module.<method>`` is applied, tuple outputs are
+    concatenated along the feature axis and the result is flattened to
+    ``(n, k)``. ``output="vector"`` further drops the single output column
+    of a regressor and ``output="softmax"`` turns classifier logits into
+    probabilities.
+    """
+
+    def __init__(self, module: torch.nn.Module, input_shape: Sequence[int], method: str = "forward", output: str = "rows"):
+        super().__init__()
+        if output not in EXPORT_OUTPUTS:
+            raise ValueError(f"output must be one of {sorted(EXPORT_OUTPUTS)}")
+        self.module = module
+        self.input_shape = tuple(int(d) for d in input_shape)
+        self.input_dim = int(np.prod(self.input_shape))
+        self.method = str(method)
+        self.output = output
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = getattr(self.module, self.method)(x.reshape((-1,) + self.input_shape))
+        if isinstance(out, tuple):
+            out = torch.cat([o.flatten(1) for o in out], dim=1)
+        out = out.flatten(1)
+        if self.output == "softmax":
+            return torch.softmax(out, dim=-1)
+        if self.output == "vector":
+            return out.squeeze(-1)
+        return out
+
+
+def _export_onnx(graph: torch.nn.Module, example: torch.Tensor, target: str, opset: int):
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # The TorchScript-based exporter needs neither onnxscript nor a trace of dynamic shapes.
+        kwargs["dynamo"] = False
+    torch.onnx.export(
+        graph,
+        (example,),
+        target,
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+        opset_version=int(opset),
+        **kwargs,
+    )
+
+
+def export_model(model, path: str, formats=("torchscript", "onnx"), opset: int = 17) -> Dict[str, Any]:
+    """Export the inference graphs of ``model`` for scoring without the model classes.
+
+    ``model._export_graphs()`` names the ``ExportGraph`` of every entry point
+    (``predict`` for the supervised models, ``encoder``/``decoder`` for the
+    autoencoders). Each is copied to the CPU in eval mode and written as a
+    frozen TorchScript trace (``<name>.pt``) and/or an ONNX graph
+    (``<name>.onnx``) with a dynamic batch axis. ``export.json`` records the
+    input width, output kind and files of every graph plus the class labels
+    of classifiers; ``export_runtime`` reads it back with numpy only.
+    """
+    formats = [str(f).lower() for f in ([formats] if isinstance(formats, str) else formats)]
+    unknown = sorted(set(formats) - EXPORT_FORMATS)
+    if unknown or not formats:
+        raise ValueError(f"formats must be among {sorted(EXPORT_FORMATS)}")
+    path = str(path)
+    os.makedirs(path, exist_ok=True)
+    graphs = {}
+    for name, graph in model._export_graphs().items():
+        graph = copy.deepcopy(graph).cpu().eval()
+        example = torch.zeros(2, graph.input_dim)
+        files = {}
+        with torch.no_grad():
+            if "torchscript" in formats:
+                files["torchscript"] = f"{name}.pt"
+                traced = torch.jit.freeze(torch.jit.trace(graph, example))
+                torch.jit.save(traced, os.path.join(path, files["torchscript"]))
+            if "onnx" in formats:
+                files["onnx"] = f"{name}.onnx"
+                _export_onnx(graph, example, os.path.join(path, files["onnx"]), opset)
+        graphs[name] = {"input_dim": graph.input_dim, "output": graph.output, "files": files}
+    manifest = {
+        "format": 1,
+        "module": type(model).__module__,
+        "class": type(model).__name__,
+        "torch_version": torch.__version__,
+        "graphs": graphs,
+        "classes": _jsonable(list(getattr(model, "classes_", None) or [])) or None,
+    }
+    with open(os.path.join(path, EXPORT_FILE), "w") as handle:
+        json.dump(manifest, handle, indent=2)
+    return manifest
+
+
+def quantize_dynamic_int8(network: torch.nn.Module) -> torch.nn.Module:
+    """Return a CPU copy of ``network`` with ``nn.Linear``/``nn.LSTM`` dynamically quantized to int8.
+
+    Weights are stored as int8 and activations are quantized per batch at run
+    time, so no calibration data is needed. ``network`` itself is untouched.
+    """
+    network = copy.deepcopy(network).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(network, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+
+
+def _state_mb(module: torch.nn.Module) -> float:
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def quantization_report(network: torch.nn.Module, quantized: torch.nn.Module, forward, inputs=None, batch_size: int = 4096, labels: bool = False) -> Dict[str, Any]:
+    """Compare an int8 copy from ``quantize_dynamic_int8`` with its fp32 ``network``.
+
+    Always reports the serialized size of both. Given validation ``inputs``,
+    both run through ``forward(net, xb)`` on the CPU and the report adds the
+    absolute prediction differences, the wall time of each pass and, with
+    ``labels=True`` (probability outputs), the fraction of rows whose argmax
+    class agrees.
+    """
+    report: Dict[str, Any] = {
+        "quantized_modules": sum(1 for m in quantized.modules() if type(m).__module__.startswith("torch.ao.nn.quantized.dynamic")),
+        "fp32_mb": _state_mb(network),
+        "int8_mb": _state_mb(quantized),
+        "rows": 0,
+    }
+    if inputs is None:
+        return report
+    reference_network = network if next(network.parameters()).device.type == "cpu" else copy.deepcopy(network).cpu()
+    start = time.perf_counter()
+    reference = batched_inference(lambda xb: forward(reference_network, xb), inputs, batch_size)
+    fp32_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    candidate = batched_inference(lambda xb: forward(quantized, xb), inputs, batch_size)
+    int8_seconds = time.perf_counter() - start
+    error = np.abs(candidate.astype(np.float64) - reference)
+    report.update(
+        {
+            "rows": int(reference.shape[0]),
+            "max_abs_error": float(error.max()) if error.size else 0.0,
+            "mean_abs_error": float(error.mean()) if error.size else 0.0,
+            "fp32_seconds": fp32_seconds,
+            "int8_seconds": int8_seconds,
+            "speedup": fp32_seconds / int8_seconds if int8_seconds > 0 else math.nan,
+        }
+    )
+    if labels:
+        report["label_agreement"] = float(np.mean(candidate.argmax(axis=-1) == reference.argmax(axis=-1))) if reference.shape[0] else 1.0
+    return report
+
+
+def checkpoint_options(checkpoint) -> Optional[Dict[str, Any]]:
+    """Normalise the ``checkpoint`` argument of the fit entry points.
+
+    ``None`` disables checkpointing; a string is the checkpoint file; a dict
+    (an R named list) may also set ``every`` (epochs between writes, default
+    1) and ``resume`` (continue from an existing file, default ``True``).
+    """
+    if checkpoint is None:
+        return None
+    options = {"path": checkpoint} if isinstance(checkpoint, str) else dict(checkpoint)
+    unknown = set(options) - CHECKPOINT_OPTIONS
+    if unknown:
+        raise ValueError(f"checkpoint options must be among {sorted(CHECKPOINT_OPTIONS)}")
+    if not options.get("path"):
+        raise ValueError("checkpoint requires a file path ('path')")
+    every = int(options.get("every", 1))
+    if every < 1:
+        raise ValueError("checkpoint 'every' must be a positive integer")
+    return {"path": str(options["path"]), "every": every, "resume": bool(options.get("resume", True))}
+
+
+def partial_fit_args(model, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Fit keyword arguments of a ``*_partial_fit`` entry point.
+
+    A partial fit is a fit with ``warm_start=True``: it extends the histories
+    and continues from the optimizer and stop controller state of the
+    previous fit (see ``TrainingCheckpoint``). The validation strategy and
+    stopping rule default to the model's rather than to the fit defaults. A
+    model without that state (fitted with ``keep_training_state=False``,
+    loaded without ``training.pt`` or never fitted) warns that the optimizer
+    and stop controller start fresh.
+    """
+    if not has_training_state(model):
+        warnings.warn(
+            f"{type(model).__name__} has no optimizer or stop controller state to continue from "
+            "(fitted with keep_training_state=False or saved without include_training_state=True); "
+            "partial_fit starts them fresh",
+            RuntimeWarning,
+            stacklevel=3,
+        )
+    args = dict(kwargs)
+    args.setdefault("validation_strategy", model.validation_strategy)
+    args.setdefault("stopping_rule", model.stopping_rule)
+    args["warm_start"] = True
+    return args
+
+
+def _rng_state() -> Dict[str, Any]:
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state: Dict[str, Any]):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _stop_controller_state(stopper, best_state: bool = True) -> Dict[str, Any]:
+    state = {k: v for k, v in vars(stopper).items() if k not in ("snapshot", "stats", "best_state")}
+    state["val_history"] = list(stopper.val_history)
+    state["best_state"] = None if not best_state or stopper.best_state is None else _clone_state(stopper.best_state)
+    stats = dict(vars(stopper.stats))
+    stats["values"] = list(stats["values"])
+    state["stats"] = stats
+    return state
+
+
+def _load_stop_controller_state(stopper, state: Dict[str, Any], new_data: bool = False):
+    """Load the runtime state of a saved stop controller into ``stopper``.
+
+    Only the counters, the loss history and the rolling statistics are
+    restored; the rule, thresholds, windows and ``lazy_best`` stay the ones
+    ``stopper`` was built with. Statistics kept for other window sizes are
+    rebuilt from the tail of the history. With ``new_data`` the best value,
+    the best weights and the running minimum are dropped, since losses on
+    another validation split cannot be compared with them.
+    """
+    stopper.patience_ctr = int(state["patience_ctr"])
+    stopper.ema_value = state["ema_value"]
+    stopper.val_history = list(state["val_history"])
+    saved = dict(state["stats"])
+    values = saved.pop("values")
+    if (saved["sma_window"], saved["test_window"]) == (stopper.stats.sma_window, stopper.stats.test_window):
+        for key, value in saved.items():
+            setattr(stopper.stats, key, value)
+        stopper.stats.values.clear()
+        stopper.stats.values.extend(values)
+    else:
+        stopper.stats = RollingStopStats(stopper.sma_window, stopper.test_window)
+        for value in stopper.val_history[-stopper.stats.values.maxlen :]:
+            stopper.stats.push(value)
+        stopper.stats.min_value = min(stopper.stats.min_value, float(saved["min_value"]))
+    if new_data:
+        stopper.best_value = float("inf")
+        stopper.best_state = None
+        stopper.stats.min_value = float("inf")
+        return
+    stopper.best_value = float(state["best_value"])
+    stopper.best_state = None if state["best_state"] is None else stopper.snapshot.capture(state["best_state"])
+
+
+class TrainingCheckpoint:
+    """Periodic on-disk checkpoints of a fit, written in the background, and resume.
+
+    A checkpoint holds the weights of ``modules``, the optimizer and stop
+    controller state, the history ``fields`` of ``owner`` and the RNG states,
+    both at the start of the fit (so the validation split is redrawn the same)
+    and at the last epoch boundary, so a resumed fit continues with identical
+    histories. States are copied on the training thread and serialised by a
+    single writer thread to a temporary file that atomically replaces the
+    previous checkpoint; at most one write is in flight. ``stage`` tracks
+    multi-stage fits (the layers of a stacked autoencoder). A finished fit
+    that ran its whole epoch budget continues when resumed with a larger one;
+    a fit the stop controller ended stays finished. Checkpoints are pickles:
+    only resume from files you wrote.
+
+    Independently of the files and unless ``keep_state=False``
+    (``keep_training_state``), ``close`` leaves the optimizer and stop
+    controller state of each stage on ``owner`` (``_warm_state``: the state
+    dicts and counters, not the best weights); a later fit with
+    ``warm_start=True`` (``partial_fit``) loads it into its fresh ones, so
+    Adam's moment estimates, the patience counter and the loss statistics carry
+    over while the new call's hyperparameters (e.g. the learning rate) and
+    stopping settings apply. The best loss and weights start over, as the
+    warm fit validates on its own rows.
+
+    Usage inside ``fit``::
+
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, fields, modules)
+        checkpoint.begin()                      # before the validation split
+        for epoch in checkpoint.epochs(n_epochs, optimizers, stopper):
+            ...
+        checkpoint.close()                      # after the loop, also after a break
+    """
+
+    VERSION = 1
+
+    def __init__(self, options: Optional[Dict[str, Any]], owner, fields: Sequence[str], modules: Dict[str, torch.nn.Module], warm_start: bool = False, keep_state: bool = True):
+        self.options = options
+        self.warm_start = bool(warm_start)
+        self.keep_state = bool(keep_state)
+        self.owner = owner
+        self.fields = tuple(fields)
+        self.modules = modules
+        self.optimizers: Dict[str, torch.optim.Optimizer] = {}
+        self.stopper = None
+        self.payload: Optional[Dict[str, Any]] = None
+        self.stage = 0
+        self.current_stage = 0
+        self.epoch = 0
+        self.stopped = False
+        self.initial_rng: Optional[Dict[str, Any]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = None
+        if options is not None and options["resume"] and os.path.exists(options["path"]):
+            self.payload = torch.load(options["path"], map_location="cpu", weights_only=False)
+            self.stage = int(self.payload["stage"])
+            for name, module in modules.items():
+                module.load_state_dict(self.payload["modules"][name])
+
+    @property
+    def enabled(self) -> bool:
+        return self.options is not None
+
+    def _resuming(self) -> bool:
+        return self.payload is not None and int(self.payload["stage"]) == self.current_stage
+
+    def begin(self, stage: int = 0):
+        """Start a stage; when resuming it, replay the RNG state the original fit started with."""
+        self.current_stage = int(stage)
+        if not self.enabled:
+            return
+        if self._resuming():
+            _set_rng_state(self.payload["initial_rng"])
+        self.initial_rng = _rng_state()
+
+    def epochs(self, n_epochs: int, optimizers: Dict[str, torch.optim.Optimizer], stopper):
+        """Yield the epoch indices still to run, checkpointing between epochs."""
+        self.optimizers = optimizers
+        self.stopper = stopper
+        start, stop = 0, int(n_epochs)
+        halted = False
+        if self.enabled and self._resuming():
+            start = self._restore()
+            # Files written before the stopped flag existed are treated as stopped.
+            halted = bool(self.payload["finished"] and self.payload.get("stopped", True))
+            if halted:
+                stop = start
+            self.payload = None
+        elif self.warm_start:
+            self._warm_restore()
+        self.epoch = start
+        # Left True when the caller breaks out of the loop (the stop controller fired).
+        self.stopped = True
+        for epoch in range(start, stop):
+            if self.enabled and epoch > start and epoch % self.options["every"] == 0:
+                self._save(finished=False)
+            self.epoch = epoch + 1
+            yield epoch
+        self.stopped = halted
+
+    def _restore(self) -> int:
+        payload = self.payload
+        for name, optimizer in self.optimizers.items():
+            optimizer.load_state_dict(payload["optimizers"][name])
+        _load_stop_controller_state(self.stopper, payload["stopper"])
+        for field, value in payload["fields"].items():
+            setattr(self.owner, field, value)
+        _set_rng_state(payload["rng"])
+        return int(payload["epoch"])
+
+    def _warm_restore(self):
+        state = (_training_state(self.owner) or {}).get(self.current_stage)
+        if state is None:
+            return
+        for name, optimizer in self.optimizers.items():
+            saved = state["optimizers"].get(name)
+            if saved is None:
+                continue
+            hyperparameters = [{k: v for k, v in group.items() if k != "params"} for group in optimizer.param_groups]
+            optimizer.load_state_dict(saved)
+            for group, values in zip(optimizer.param_groups, hyperparameters):
+                group.update(values)
+        # A warm start draws its validation split from the new rows.
+        _load_stop_controller_state(self.stopper, state["stopper"], new_data=True)
+
+    def _save(self, finished: bool):
+        payload = {
+            "version": self.VERSION,
+            "stage": self.current_stage,
+            "epoch": self.epoch,
+            "finished": bool(finished),
+            "stopped": bool(self.stopped),
+            "modules": {name: _clone_state(module.state_dict()) for name, module in self.modules.items()},
+            "optimizers": {name: copy.deepcopy(optimizer.state_dict()) for name, optimizer in self.optimizers.items()},
+            "stopper": _stop_controller_state(self.stopper),
+            "fields": {field: copy.copy(getattr(self.owner, field)) for field in self.fields},
+            "initial_rng": self.initial_rng,
+            "rng": _rng_state(),
+        }
+        self._wait()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = self._executor.submit(self._write, payload, self.options["path"])
+
+    @staticmethod
+    def _write(payload: Dict[str, Any], path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp = f"{path}.tmp"
+        torch.save(payload, tmp)
+        os.replace(tmp, path)
+
+    def _wait(self):
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        """Keep (or drop) the stage's training state for a warm start, write it and wait for the writer."""
+        # A training.pt not read by now belongs to an earlier fit.
+        self.owner.__dict__.pop("_training_state_path", None)
+        if self.keep_state:
+            warm_state = getattr(self.owner, "_warm_state", None)
+            if warm_state is None:
+                warm_state = self.owner._warm_state = {}
+            warm_state[self.current_stage] = _warm_stage_state(self.optimizers, self.stopper)
+        else:
+            getattr(self.owner, "_warm_state", {}).pop(self.current_stage, None)
+        if not self.enabled:
+            return
+        try:
+            self._save(finished=True)
+            self._wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB (``nan`` when unavailable)."""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in KiB on Linux and in bytes on macOS.
+        return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+    try:
+        import psutil
+    except ImportError:
+        return float("nan")
+    info = psutil.Process().memory_info()
+    return getattr(info, "peak_wset", info.rss) / (1024.0 * 1024.0)
+
+
+_active_profiler = None
+
+
+def profile_options(profile) -> Dict[str, Any]:
+    """Normalise the ``profile`` argument of the fit/predict entry points.
+
+    A string is the output directory; a dict (an R named list) may also set
+    the step window ``wait``/``warmup``/``active``/``repeat`` and the
+    ``record_shapes``, ``profile_memory``, ``with_stack``, ``sort_by`` and
+    ``row_limit`` profiler options.
+    """
+    options = {"dir": profile} if isinstance(profile, str) else dict(profile)
+    unknown = set(options) - PROFILE_OPTIONS
+    if unknown:
+        raise ValueError(f"profile options must be among {sorted(PROFILE_OPTIONS)}")
+    if not options.get("dir"):
+        raise ValueError("profile requires an output directory ('dir')")
+    result = {
+        "dir": str(options["dir"]),
+        "wait": 1,
+        "warmup": 1,
+        "active": 3,
+        "repeat": 1,
+        "record_shapes": True,
+        "profile_memory": True,
+        "with_stack": False,
+        "sort_by": "self_cpu_time_total",
+        "row_limit": 30,
+    }
+    result.update(options)
+    for key in ("wait", "warmup", "active", "repeat", "row_limit"):
+        result[key] = int(result[key])
+    for key in ("record_shapes", "profile_memory", "with_stack"):
+        result[key] = bool(result[key])
+    return result
+
+
+@contextmanager
+def profiling(profile, label: str, steps: bool = False):
+    """Run a block under ``torch.profiler`` when ``profile`` is given.
+
+    With ``steps=True`` (fits) the profiler follows the wait/warmup/active
+    window over training batches; otherwise (predict/encode) the whole call
+    is recorded. Each recorded window is written to ``dir`` as a
+    Chrome/Perfetto trace (``<label>_<pid>_<n>.pt.trace.json``) and an
+    operator summary table (``<label>_<pid>_<n>_ops.txt``). ``profile=None``
+    does nothing.
+    """
+    global _active_profiler
+    if profile is None:
+        yield
+        return
+    from torch.profiler import ProfilerActivity, profile as torch_profile, schedule
+
+    options = profile_options(profile)
+    os.makedirs(options["dir"], exist_ok=True)
+    prefix = os.path.join(options["dir"], f"{label}_{os.getpid()}")
+    written = []
+
+    def export(prof):
+        path = f"{prefix}_{len(written)}"
+        prof.export_chrome_trace(f"{path}.pt.trace.json")
+        with open(f"{path}_ops.txt", "w") as handle:
+            handle.write(prof.key_averages().table(sort_by=options["sort_by"], row_limit=options["row_limit"]))
+        written.append(path)
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    window = schedule(wait=options["wait"], warmup=options["warmup"], active=options["active"], repeat=options["repeat"]) if steps else None
+    previous = _active_profiler
+    with torch_profile(
+        activities=activities,
+        schedule=window,
+        on_trace_ready=export,
+        record_shapes=options["record_shapes"],
+        profile_memory=options["profile_memory"],
+        with_stack=options["with_stack"],
+    ) as prof:
+        _active_profiler = prof if steps else previous
+        try:
+            yield
+        finally:
+            _active_profiler = previous
+
+
+class FitTelemetry:
+    """Per-epoch timings, throughput and peak memory of a fit, stored column-wise.
+
+    Columns are preallocated numpy arrays grown by doubling, and ``as_dict``
+    returns them trimmed to the epochs run, so R reads each metric as a plain
+    numeric vector. Per epoch:
+
+    - ``epoch_seconds``: wall time from the start of one epoch to the next;
+    - ``batch_seconds``: time the training pass spent waiting for batches;
+    - ``compute_seconds``: the rest of the training pass (forward, backward, step);
+    - ``validation_seconds``: the validation pass, batching included;
+    - ``snapshot_seconds``: the stop-controller step, including best-weights snapshots;
+    - ``samples`` and ``samples_per_second`` of the training pass;
+    - ``peak_rss_mb``: process peak RSS at the end of the epoch;
+    - ``stage``: training stage (the layer index for stacked autoencoders, else 0).
+
+    Given the model's ``ForwardCompiler``, ``as_dict`` also holds ``compile``:
+    its ``report`` for this fit (graphs built, compile against compiled-step
+    and eager seconds, fallback), taken at ``stop``.
+    """
+
+    FIELDS = ("epoch_seconds", "batch_seconds", "compute_seconds", "validation_seconds", "snapshot_seconds", "samples", "samples_per_second", "peak_rss_mb")
+
+    def __init__(self, capacity: int = 64, compiler: Optional[ForwardCompiler] = None):
+        capacity = max(1, int(capacity))
+        self.columns: Dict[str, np.ndarray] = {name: np.zeros(capacity, dtype=np.float64) for name in self.FIELDS}
+        self.stage = np.zeros(capacity, dtype=np.int32)
+        self.n_epochs = 0
+        self._start: Optional[float] = None
+        self._train_seconds = 0.0
+        self._compiler = compiler
+        self._compile_start = None if compiler is None else compiler.report()
+        self.compile: Optional[Dict[str, Any]] = None
+
+    def __getstate__(self):
+        # Compiled graphs do not pickle; the report taken at stop() does.
+        state = dict(self.__dict__)
+        state["_compiler"] = None
+        return state
+
+    def _grow(self):
+        capacity = 2 * self.stage.shape[0]
+        for name, column in self.columns.items():
+            self.columns[name] = np.resize(column, capacity)
+        self.stage = np.resize(self.stage, capacity)
+
+    def start_epoch(self, stage: int = 0):
+        """Close the running epoch, if any, and open the next one."""
+        now = time.perf_counter()
+        if self._start is not None:
+            self._close(now)
+        if self.n_epochs == self.stage.shape[0]:
+            self._grow()
+        for column in self.columns.values():
+            column[self.n_epochs] = 0.0
+        self.stage[self.n_epochs] = int(stage)
+        self._start = now
+        self._train_seconds = 0.0
+
+    def stop(self):
+        """Close the running epoch; call once after the epoch loop."""
+        if self._start is not None:
+            self._close(time.perf_counter())
+            self._start = None
+        if self._compiler is not None:
+            self.compile = self._compiler.report(since=self._compile_start)
+
+    def _close(self, now: float):
+        row = self.n_epochs
+        columns = self.columns
+        columns["epoch_seconds"][row] = now - self._start
+        columns["compute_seconds"][row] = max(0.0, self._train_seconds - columns["batch_seconds"][row])
+        if self._train_seconds > 0.0:
+            columns["samples_per_second"][row] = columns["samples"][row] / self._train_seconds
+        columns["peak_rss_mb"][row] = peak_rss_mb()
+        self.n_epochs += 1
+
+    def batches(self, loader):
+        """Yield ``loader``'s batches, timing the waits and counting the rows.
+
+        Each consumed batch is one step of an active ``profiling`` window.
+        """
+        row = self.n_epochs
+        batch_seconds = 0.0
+        samples = 0
+        start = time.perf_counter()
+        iterator = iter(loader)
+        try:
+            while True:
+                fetch = time.perf_counter()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    batch_seconds += time.perf_counter() - fetch
+                    return
+                batch_seconds += time.perf_counter() - fetch
+                samples += int(batch[0].shape[0])
+                yield batch
+                if _active_profiler is not None:
+                    _active_profiler.step()
+        finally:
+            self.columns["batch_seconds"][row] += batch_seconds
+            self.columns["samples"][row] += samples
+            self._train_seconds += time.perf_counter() - start
+
+    @contextmanager
+    def phase(self, name: str):
+        """Add the wall time of the block to ``<name>_seconds`` of the running epoch."""
+        column = self.columns[f"{name}_seconds"]
+        row = self.n_epochs
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            column[row] += time.perf_counter() - start
+
+    def as_dict(self) -> Dict[str, np.ndarray]:
+        n = self.n_epochs
+        result = {name: column[:n].copy() for name, column in self.columns.items()}
+        result["stage"] = self.stage[:n].copy()
+        if self.compile is not None:
+            result["compile"] = dict(self.compile)
+        return result
+
+    def totals(self) -> Dict[str, float]:
+        n = self.n_epochs
+        result = {name: float(self.columns[name][:n].sum()) for name in self.FIELDS if name.endswith("_seconds") or name == "samples"}
+        result["peak_rss_mb"] = float(self.columns["peak_rss_mb"][:n].max()) if n else float("nan")
+        result["epochs"] = n
+        return result
+
+
+def _beta_continued_fraction(a: float, b: float, x: float) -> float:
+    # Modified Lentz evaluation of the incomplete beta continued fraction.
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    result = d
+    for m in range(1, 300):
+        m2 = 2 * m
+        for numerator in (m * (b - m) * x / ((a + m2 - 1.0) * (a + m2)), -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1.0))):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            delta = c * d
+            result *= delta
+        if abs(delta - 1.0) < 1e-15:
+            break
+    return result
+
+
+def _regularized_beta(a: float, b: float, x: float) -> float:
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    log_front = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x)
+    if x < (a + 1.0) / (a + b + 2.0):
+        return math.exp(log_front) * _beta_continued_fraction(a, b, x) / a
+    return 1.0 - math.exp(log_front) * _beta_continued_fraction(b, a, 1.0 - x) / b
+
+
+def welch_greater_p_value(n1: int, mean1: float, var1: float, n2: int, mean2: float, var2: float) -> float:
+    """One-sided Welch t-test p-value for ``mean1 > mean2`` from summary statistics.
+
+    Matches ``scipy.stats.ttest_ind(a, b, equal_var=False, alternative="greater")``
+    using the Student t survival function written in terms of the regularized
+    incomplete beta function.
+    """
+    se1 = var1 / n1
+    se2 = var2 / n2
+    se = se1 + se2
+    diff = mean1 - mean2
+    if se <= 0.0:
+        if diff == 0.0:
+            return float("nan")
+        return 0.0 if diff > 0.0 else 1.0
+    t = diff / math.sqrt(se)
+    dof = se * se / (se1 * se1 / (n1 - 1) + se2 * se2 / (n2 - 1))
+    tail = 0.5 * _regularized_beta(0.5 * dof, 0.5, dof / (dof + t * t))
+    return tail if t > 0.0 else 1.0 - tail
+
+
+class RollingStopStats:
+    """O(1) per-epoch statistics for the ``sma`` and ``h`` stopping rules.
+
+    Running sums (and sums of squares for the two Welch windows) are updated
+    as each validation loss enters and leaves a window, so neither rule
+    re-slices or re-reduces the loss history. Values are stored shifted by
+    the first loss to keep the variance computation well conditioned, and the
+    sums are rebuilt from the retained values once per buffer length so the
+    add/subtract updates cannot drift over long runs.
+    """
+
+    def __init__(self, sma_window: int, test_window: int):
+        self.sma_window = max(1, int(sma_window))
+        self.test_window = max(2, int(test_window))
+        self.values = deque(maxlen=max(self.sma_window, 2 * self.test_window) + 1)
+        self.count = 0
+        self.shift = 0.0
+        self.sma_sum = 0.0
+        self.recent_sum = 0.0
+        self.recent_sq = 0.0
+        self.previous_sum = 0.0
+        self.previous_sq = 0.0
+        self.min_value = float("inf")
+        self.is_new_min = False
+
+    def push(self, value: float):
+        value = float(value)
+        if self.count == 0:
+            self.shift = value
+        self.is_new_min = self.count == 0 or value < self.min_value
+        self.min_value = min(self.min_value, value)
+        y = value - self.shift
+        self.values.append(y)
+        self.count += 1
+
+        self.sma_sum += y
+        if self.count > self.sma_window:
+            self.sma_sum -= self.values[-self.sma_window - 1]
+
+        self.recent_sum += y
+        self.recent_sq += y * y
+        if self.count > self.test_window:
+            moved = self.values[-self.test_window - 1]
+            self.recent_sum -= moved
+            self.recent_sq -= moved * moved
+            self.previous_sum += moved
+            self.previous_sq += moved * moved
+        if self.count > 2 * self.test_window:
+            dropped = self.values[-2 * self.test_window - 1]
+            self.previous_sum -= dropped
+            self.previous_sq -= dropped * dropped
+        if self.count % self.values.maxlen == 0:
+            self._resync()
+
+    def _resync(self):
+        values = list(self.values)
+        n = self.test_window
+        self.sma_sum = math.fsum(values[-self.sma_window :])
+        recent = values[-n:]
+        previous = values[-2 * n : -n] if len(values) > n else []
+        self.recent_sum = math.fsum(recent)
+        self.recent_sq = math.fsum(v * v for v in recent)
+        self.previous_sum = math.fsum(previous)
+        self.previous_sq = math.fsum(v * v for v in previous)
+
+    def sma(self) -> float:
+        return self.shift + self.sma_sum / min(self.count, self.sma_window)
+
+    def welch_p_value(self) -> Optional[float]:
+        """p-value that the previous window's mean exceeds the recent one's, once both are full."""
+        n = self.test_window
+        if self.count < 2 * n:
+            return None
+        previous_mean = self.previous_sum / n
+        recent_mean = self.recent_sum / n
+        previous_var = (self.previous_sq - n * previous_mean * previous_mean) / (n - 1)
+        recent_var = (self.recent_sq - n * recent_mean * recent_mean) / (n - 1)
+        # Rounding residue from the running updates must not read as signal:
+        # identical windows have exactly zero variance and mean difference.
+        scale = max(abs(self.shift), abs(previous_mean), abs(recent_mean), 1e-300)
+        var_tol = (1e-7 * scale) ** 2
+        previous_var = previous_var if previous_var > var_tol else 0.0
+        recent_var = recent_var if recent_var > var_tol else 0.0
+        if abs(previous_mean - recent_mean) <= 1e-12 * scale:
+            recent_mean = previous_mean
+        return welch_greater_p_value(n, previous_mean, previous_var, n, recent_mean, recent_var)
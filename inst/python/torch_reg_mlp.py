@@ -2,15 +2,22 @@
 Unified PyTorch MLP regressor used by daltoolboxdp via reticulate.
 """
 
+from __future__ import annotations
+
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
-from scipy.stats import ttest_ind
-from torch.utils.data import DataLoader, TensorDataset
+
+from ingest_common import column_array, feature_matrix
+from parallel_common import uses_model_threads, validate_num_threads
+from stream_common import ChunkStream, open_stream, split_rows, stream_options
+from torch_common import ExportGraph, FitTelemetry, ForwardCompiler, LossAccumulator, RollingStopStats, StateSnapshot, TrainingCheckpoint, batch_iterator, batched_inference, checkpoint_options, export_model, input_tensor, load_model, partial_fit_args, profiling, quantization_report, quantize_dynamic_int8, save_model, serializable, validate_batch_engine, validate_loss_weighting
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 VALIDATION_STRATEGIES = {"static", "dynamic"}
@@ -29,6 +36,13 @@ class _TrainingConfig:
     ema_alpha: float = 0.2
     test_window: int = 30
     p_value: float = 0.05
+    batch_engine: str = "tensor"
+    loss_weighting: str = "batch"
+    lazy_best: bool = False
+    checkpoint: Optional[dict] = None
+    stream: Optional[dict] = None
+    warm_start: bool = False
+    keep_training_state: bool = True
 
 
 def _activation_module(name: str) -> nn.Module:
@@ -128,7 +142,7 @@ class TorchMLPRegressorNet(nn.Module):
 
 
 class _StopController:
-    def __init__(self, rule: str, min_delta: float, patience: int, sma_window: int, ema_alpha: float, test_window: int, p_value: float):
+    def __init__(self, rule: str, min_delta: float, patience: int, sma_window: int, ema_alpha: float, test_window: int, p_value: float, lazy_best: bool = False):
         self.rule = rule
         self.min_delta = float(min_delta)
         self.patience = int(patience)
@@ -141,25 +155,30 @@ class _StopController:
         self.patience_ctr = 0
         self.ema_value = None
         self.val_history: List[float] = []
+        self.lazy_best = bool(lazy_best)
+        self.snapshot = StateSnapshot()
+        self.stats = RollingStopStats(self.sma_window, self.test_window)
 
     def _clone_state(self, model: nn.Module):
-        return {k: v.detach().clone() for k, v in model.state_dict().items()}
+        return self.snapshot.capture(model.state_dict())
 
     def _h_improved(self) -> bool:
-        if len(self.val_history) < 2 * self.test_window:
-            if len(self.val_history) == 1:
-                return True
-            return self.val_history[-1] < min(self.val_history[:-1])
-        prev_window = self.val_history[-2 * self.test_window : -self.test_window]
-        recent_window = self.val_history[-self.test_window :]
-        _, p_value = ttest_ind(prev_window, recent_window, equal_var=False, alternative="greater")
+        p_value = self.stats.welch_p_value()
+        if p_value is None:
+            # Until both windows are full, improvement means a new minimum.
+            return self.stats.is_new_min
         return bool(p_value < self.p_value)
 
     def step(self, model: nn.Module, current: float) -> bool:
         self.val_history.append(float(current))
+        self.stats.push(current)
 
         if self.rule == "none":
-            self.best_state = self._clone_state(model)
+            if not self.lazy_best:
+                self.best_state = self._clone_state(model)
+            elif (self.best_value - float(current)) > self.min_delta:
+                self.best_value = float(current)
+                self.best_state = self._clone_state(model)
             return False
 
         if self.rule == "h":
@@ -174,7 +193,7 @@ class _StopController:
         if self.rule == "patience":
             monitor_value = float(current)
         elif self.rule == "sma":
-            monitor_value = float(np.mean(self.val_history[-self.sma_window :]))
+            monitor_value = self.stats.sma()
         elif self.rule == "ema":
             if self.ema_value is None:
                 self.ema_value = current
@@ -193,6 +212,7 @@ class _StopController:
         return self.patience_ctr >= self.patience
 
 
+@serializable
 class TorchMLPRegressor:
     def __init__(
         self,
@@ -205,6 +225,9 @@ class TorchMLPRegressor:
         init_method: str = "default",
         validation_strategy: str = "static",
         stopping_rule: str = "none",
+        compile: bool = False,
+        precision: str = "fp32",
+        num_threads: Optional[int] = None,
     ):
         validation_strategy = str(validation_strategy).lower()
         stopping_rule = str(stopping_rule).lower()
@@ -214,6 +237,8 @@ class TorchMLPRegressor:
             raise ValueError(f"stopping_rule must be one of {sorted(STOPPING_RULES)}")
         self.validation_strategy = validation_strategy
         self.stopping_rule = stopping_rule
+        self.compiler = ForwardCompiler(compile, precision)
+        self.num_threads = validate_num_threads(num_threads)
         self.network = TorchMLPRegressorNet(
             input_dim,
             hidden_sizes,
@@ -226,16 +251,30 @@ class TorchMLPRegressor:
         self.train_loss_hist: List[float] = []
         self.val_loss_hist: List[float] = []
         self.epochs_done: int = 0
+        self.telemetry = FitTelemetry()
+        self.quantization_report = None
+        self._quantized: Optional[nn.Module] = None
 
     @staticmethod
     def _device():
         return torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+    def _inference_network(self):
+        # The int8 copy built by quantize() only runs on the CPU.
+        if self._quantized is not None:
+            return self._quantized, torch.device("cpu")
+        self.network.eval()
+        return self.compiler(self.network), self._device()
+
     @staticmethod
     def _prep_xy(df: pd.DataFrame, target_col: str) -> Tuple[torch.Tensor, torch.Tensor]:
-        X = df.drop(columns=[target_col]).to_numpy().astype(np.float32)
-        y = df[target_col].to_numpy().astype(np.float32)
-        return torch.from_numpy(X), torch.from_numpy(y).unsqueeze(-1)
+        X = feature_matrix(df, exclude=[target_col])
+        y = column_array(df, target_col, np.float32)
+        return input_tensor(X), input_tensor(y).unsqueeze(-1)
+
+    @staticmethod
+    def _chunk_arrays(raw, target_col: str) -> Tuple[np.ndarray, np.ndarray]:
+        return feature_matrix(raw, exclude=[target_col]), column_array(raw, target_col, np.float32)[:, np.newaxis]
 
     @staticmethod
     def _split_indices(n_samples: int, val_ratio: float) -> Tuple[np.ndarray, np.ndarray]:
@@ -244,76 +283,108 @@ class TorchMLPRegressor:
         n_val = max(1, int(n_samples * float(val_ratio)))
         return idx[n_val:], idx[:n_val]
 
-    def _epoch(self, loader: DataLoader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module) -> float:
-        losses: List[float] = []
+    def _loader(self, source, batch_size: int, shuffle: bool, batch_engine: str, indices=None):
+        if isinstance(source, ChunkStream):
+            return source.batches(batch_size, shuffle, indices, self._device())
+        return batch_iterator(source, batch_size, shuffle, batch_engine, indices=indices)
+
+    def _epoch(self, loader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module, loss_weighting: str = "batch") -> float:
+        losses = LossAccumulator(loss_weighting)
         if optimizer is None:
             self.network.eval()
             with torch.no_grad():
                 for xb, yb in loader:
-                    xb = xb.float().to(self._device())
-                    yb = yb.float().to(self._device())
-                    losses.append(float(criterion(self.network(xb), yb).item()))
+                    losses.add(criterion(self.compiler(self.network)(xb), yb), xb.size(0))
         else:
             self.network.train()
             for xb, yb in loader:
-                xb = xb.float().to(self._device())
-                yb = yb.float().to(self._device())
                 optimizer.zero_grad()
-                loss = criterion(self.network(xb), yb)
+                loss = criterion(self.compiler(self.network)(xb), yb)
                 loss.backward()
                 optimizer.step()
-                losses.append(float(loss.item()))
-        return float(np.mean(losses)) if losses else 0.0
+                losses.add(loss, xb.size(0))
+        return losses.value()
 
     def fit(self, df_train: pd.DataFrame, target_col: str, config: _TrainingConfig):
 
-        X_all, y_all = self._prep_xy(df_train, target_col)
+        stream = open_stream(df_train, config.stream, lambda raw: self._chunk_arrays(raw, target_col))
+        if stream is None:
+            X_all, y_all = self._prep_xy(df_train, target_col)
+            source = (X_all.to(self._device()), y_all.to(self._device()))
+            n_units = X_all.shape[0]
+        else:
+            source, n_units = stream, len(stream)
         criterion = nn.MSELoss()
         optimizer = torch.optim.Adam(self.network.parameters(), lr=float(config.lr))
-        stopper = _StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value)
-
-        self.train_loss_hist = []
-        self.val_loss_hist = []
-        self.epochs_done = 0
+        stopper = _StopController(self.stopping_rule, config.min_delta, config.patience, config.sma_window, config.ema_alpha, config.test_window, config.p_value, lazy_best=config.lazy_best)
+
+        if not config.warm_start:
+            self.train_loss_hist = []
+            self.val_loss_hist = []
+            self.epochs_done = 0
+        self.telemetry = FitTelemetry(compiler=self.compiler)
+        self.quantization_report = None
+        self._quantized = None
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, ("train_loss_hist", "val_loss_hist", "epochs_done"), {"network": self.network}, warm_start=config.warm_start, keep_state=config.keep_training_state)
+        checkpoint.begin()
 
         if self.validation_strategy == "static" and self.stopping_rule != "none":
-            train_idx, val_idx = self._split_indices(X_all.shape[0], config.val_ratio)
-            train_loader = DataLoader(TensorDataset(X_all[train_idx], y_all[train_idx]), batch_size=int(config.batch_size), shuffle=True, drop_last=False)
-            val_loader = DataLoader(TensorDataset(X_all[val_idx], y_all[val_idx]), batch_size=int(config.batch_size), shuffle=False, drop_last=False)
+            train_idx, val_idx = split_rows(stream, n_units, config.val_ratio, self._split_indices)
+            train_loader = self._loader(source, config.batch_size, True, config.batch_engine, indices=train_idx)
+            val_loader = self._loader(source, config.batch_size, False, config.batch_engine, indices=val_idx)
         elif self.validation_strategy == "static":
-            train_loader = DataLoader(TensorDataset(X_all, y_all), batch_size=int(config.batch_size), shuffle=True, drop_last=False)
+            train_loader = self._loader(source, config.batch_size, True, config.batch_engine)
             val_loader = None
         else:
             train_loader = None
             val_loader = None
 
-        for epoch in range(int(config.epochs)):
+        for epoch in checkpoint.epochs(int(config.epochs), {"optimizer": optimizer}, stopper):
+            self.telemetry.start_epoch()
             self.epochs_done += 1
             if self.validation_strategy == "dynamic":
-                train_idx, val_idx = self._split_indices(X_all.shape[0], config.val_ratio)
-                train_loader = DataLoader(TensorDataset(X_all[train_idx], y_all[train_idx]), batch_size=int(config.batch_size), shuffle=True, drop_last=False)
-                val_loader = DataLoader(TensorDataset(X_all[val_idx], y_all[val_idx]), batch_size=int(config.batch_size), shuffle=False, drop_last=False)
+                train_idx, val_idx = split_rows(stream, n_units, config.val_ratio, self._split_indices)
+                train_loader = self._loader(source, config.batch_size, True, config.batch_engine, indices=train_idx)
+                val_loader = self._loader(source, config.batch_size, False, config.batch_engine, indices=val_idx)
 
-            self.train_loss_hist.append(self._epoch(train_loader, optimizer, criterion))
+            self.train_loss_hist.append(self._epoch(self.telemetry.batches(train_loader), optimizer, criterion, config.loss_weighting))
             if val_loader is not None:
-                val_loss = self._epoch(val_loader, None, criterion)
+                with self.telemetry.phase("validation"):
+                    val_loss = self._epoch(val_loader, None, criterion, config.loss_weighting)
                 self.val_loss_hist.append(val_loss)
-                if stopper.step(self.network, val_loss):
+                with self.telemetry.phase("snapshot"):
+                    stop = stopper.step(self.network, val_loss)
+                if stop:
                     break
 
+        self.telemetry.stop()
+        checkpoint.close()
         if stopper.best_state is not None:
             self.network.load_state_dict(stopper.best_state)
         return self
 
     def predict(self, df_test: pd.DataFrame, target_col: str, batch_size: int = 128):
-        X = df_test.drop(columns=[target_col], errors="ignore").to_numpy().astype(np.float32)
-        loader = DataLoader(TensorDataset(torch.from_numpy(X), torch.zeros(X.shape[0], 1)), batch_size=int(batch_size), shuffle=False, drop_last=False)
-        preds: List[torch.Tensor] = []
+        X = feature_matrix(df_test, exclude=[target_col])
+        network, device = self._inference_network()
+        return batched_inference(lambda xb: network(xb).squeeze(-1), X, batch_size, device)
+
+    def quantize(self, df_validation=None, target_col: str = "t0", batch_size: int = 4096):
+        """Switch prediction to a dynamic int8 copy of the network and report its accuracy.
+
+        ``nn.Linear``/``nn.LSTM`` weights are quantized to int8 (see
+        ``quantize_dynamic_int8``); the fp32 network is kept for training,
+        export and saving. With ``df_validation`` the report compares int8
+        and fp32 predictions on it.
+        """
         self.network.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                preds.append(self.network(xb.float().to(self._device())).detach().cpu())
-        return torch.vstack(preds).squeeze(-1).numpy()
+        quantized = quantize_dynamic_int8(self.network)
+        inputs = None if df_validation is None else feature_matrix(df_validation, exclude=[target_col])
+        self.quantization_report = quantization_report(self.network, quantized, lambda net, xb: net(xb).squeeze(-1), inputs, batch_size)
+        self._quantized = quantized
+        return self.quantization_report
+
+    def _export_graphs(self):
+        return {"predict": ExportGraph(self.network, (self.init_args["input_dim"],), output="vector")}
 
 
 def torch_reg_mlp_create(
@@ -326,7 +397,19 @@ def torch_reg_mlp_create(
     init_method: str = "default",
     validation_strategy: str = "static",
     stopping_rule: str = "none",
+    compile: bool = False,
+    precision: str = "fp32",
+    num_threads: Optional[int] = None,
 ):
+    """Create an MLP regressor.
+
+    ``compile=True`` runs the forwards through ``torch.compile`` and
+    ``precision="bf16"`` under bfloat16 autocast. The telemetry of every fit
+    then holds ``compile``: graphs built and the seconds spent compiling, in
+    compiled steps and in eager fallback, to judge whether compiling pays off;
+    ``model.compiler.report()`` has the same counters over the model's
+    lifetime, predictions included.
+    """
     return TorchMLPRegressor(
         input_dim,
         hidden_sizes,
@@ -337,9 +420,13 @@ def torch_reg_mlp_create(
         init_method=init_method,
         validation_strategy=validation_strategy,
         stopping_rule=stopping_rule,
+        compile=compile,
+        precision=precision,
+        num_threads=num_threads,
     )
 
 
+@uses_model_threads
 def torch_reg_mlp_fit(
     model,
     df_train: pd.DataFrame,
@@ -356,6 +443,14 @@ def torch_reg_mlp_fit(
     ema_alpha: float = 0.2,
     test_window: int = 30,
     p_value: float = 0.05,
+    batch_engine: str = "tensor",
+    loss_weighting: str = "batch",
+    lazy_best: bool = False,
+    profile: Optional[Union[str, dict]] = None,
+    checkpoint: Optional[Union[str, dict]] = None,
+    stream: Optional[dict] = None,
+    warm_start: bool = False,
+    keep_training_state: bool = True,
 ):
     model.validation_strategy = str(validation_strategy).lower()
     model.stopping_rule = str(stopping_rule).lower()
@@ -370,9 +465,43 @@ def torch_reg_mlp_fit(
         ema_alpha=float(ema_alpha),
         test_window=int(test_window),
         p_value=float(p_value),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+        checkpoint=checkpoint_options(checkpoint),
+        stream=stream_options(stream),
+        warm_start=bool(warm_start),
+        keep_training_state=bool(keep_training_state),
     )
-    return model.fit(df_train, target_col=target_col, config=config)
+    with profiling(profile, "torch_reg_mlp_fit", steps=True):
+        return model.fit(df_train, target_col=target_col, config=config)
+
+
+def torch_reg_mlp_partial_fit(model, df_train, epochs=1, **kwargs):
+    return torch_reg_mlp_fit(model, df_train, epochs=epochs, **partial_fit_args(model, kwargs))
+
+
+@uses_model_threads
+def torch_reg_mlp_predict(model, df_test: pd.DataFrame, target_col: str = "t0", batch_size: int = 128, profile: Optional[Union[str, dict]] = None):
+    with profiling(profile, "torch_reg_mlp_predict"):
+        return model.predict(df_test, target_col=target_col, batch_size=batch_size)
+
+
+def torch_reg_mlp_save(model, path, include_training_state=False):
+    return save_model(model, path, include_training_state=include_training_state)
+
+
+def torch_reg_mlp_load(path, mmap=True, quantize=False):
+    model = load_model(path, TorchMLPRegressor, mmap=mmap)
+    if quantize:
+        model.quantize()
+    return model
+
+
+def torch_reg_mlp_export(model, path, formats=("torchscript", "onnx"), opset=17):
+    return export_model(model, path, formats=formats, opset=opset)
 
 
-def torch_reg_mlp_predict(model, df_test: pd.DataFrame, target_col: str = "t0", batch_size: int = 128):
-    return model.predict(df_test, target_col=target_col, batch_size=batch_size)
+@uses_model_threads
+def torch_reg_mlp_quantize(model, df_validation=None, target_col="t0", batch_size=4096):
+    return model.quantize(df_validation, target_col=target_col, batch_size=batch_size)
@@ -0,0 +1,379 @@
+"""
+Process-pool hyperparameter search for the torch backends.
+
+``torch_search_stream`` trains one configuration per task in a local
+``ProcessPoolExecutor`` and yields each result as soon as it finishes. The
+numeric columns of the training (and optional validation) frame are copied
+once into shared memory, one block per dtype; every worker maps them and
+rebuilds its DataFrame, with the caller's dtypes, from that mapping instead
+of receiving a pickled copy per task. Workers cap
+their torch/BLAS pools with ``configure_parallelism`` so that
+``workers * threads_per_worker`` matches the cores of the box.
+
+``torch_search_asha_stream`` runs asynchronous successive halving (ASHA) over
+the same pool: every configuration first trains for ``min_epochs``, and a
+configuration is promoted to the next rung (``eta`` times the epochs) once it
+ranks in the top ``1/eta`` of the results finished at its rung. Promoted
+configurations resume from a per-configuration training checkpoint, so their
+weights, optimizer, stop controller and loss histories carry over instead of
+being retrained from scratch.
+
+Usage:
+  space = {"hidden_sizes": [[32], [64, 32]], "dropout": [0.0, 0.2], "lr": [1e-3, 3e-3]}
+  for result in torch_search_stream("torch_reg_mlp", space, df_train, base={"input_dim": 8, "epochs": 50}):
+      print(result["score"], result["params"])
+  best = torch_search_asha_run("ts_lstm", space, df_train, base={"input_dim": 8, "hidden_size": 32}, min_epochs=3, eta=3, max_epochs=81)[0]
+"""
+
+import contextlib
+import importlib
+import inspect
+import itertools
+import math
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from multiprocessing import get_context, shared_memory
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+
+SEARCH_MODULES = {"torch_cla_mlp", "torch_reg_mlp", "torch_ts_mlp", "ts_conv1d", "ts_lstm"}
+TARGET_ARGS = ("target_column", "target_col")
+EPOCH_ARGS = {"torch_cla_mlp": "epochs", "torch_reg_mlp": "epochs", "torch_ts_mlp": "epochs", "ts_conv1d": "n_epochs", "ts_lstm": "n_epochs"}
+
+_worker: Dict[str, Any] = {}
+
+
+def parameter_grid(space: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """Every combination of the candidate values in ``space``, in a stable order."""
+    names = sorted(space)
+    values = [space[name] if isinstance(space[name], (list, tuple)) else [space[name]] for name in names]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def parameter_sample(space: Dict[str, Any], n_iter: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """``n_iter`` random configurations drawn from ``space``.
+
+    A list gives the choices of a parameter; a dict with ``low``/``high``
+    (plus optional ``log`` and ``integer`` flags) gives a numeric range.
+    """
+    rng = np.random.default_rng(int(seed))
+    configs = []
+    for _ in range(int(n_iter)):
+        config = {}
+        for name in sorted(space):
+            spec = space[name]
+            if isinstance(spec, dict):
+                low, high = float(spec["low"]), float(spec["high"])
+                if spec.get("log", False):
+                    value = math.exp(rng.uniform(math.log(low), math.log(high)))
+                else:
+                    value = rng.uniform(low, high)
+                config[name] = int(round(value)) if spec.get("integer", False) else float(value)
+            elif isinstance(spec, (list, tuple)):
+                config[name] = spec[int(rng.integers(len(spec)))]
+            else:
+                config[name] = spec
+        configs.append(config)
+    return configs
+
+
+def _block_view(shm, block: Dict[str, Any], n_rows: int) -> np.ndarray:
+    return np.ndarray((n_rows, len(block["columns"])), dtype=np.dtype(block["dtype"]), buffer=shm.buf, offset=block["offset"])
+
+
+def _share_frame(df) -> Optional[Dict[str, Any]]:
+    if df is None:
+        return None
+    from pandas.api.types import is_numeric_dtype
+
+    # One block per numpy dtype, so workers rebuild the caller's dtypes (integer
+    # targets and labels stay integers) without a float32 round trip.
+    groups: Dict[str, List[Any]] = {}
+    for column in df.columns:
+        dtype = df[column].dtype
+        if isinstance(dtype, np.dtype) and is_numeric_dtype(dtype):
+            groups.setdefault(dtype.str, []).append(column)
+    blocks, size = [], 0
+    for dtype, columns in groups.items():
+        size = -(-size // 64) * 64
+        blocks.append({"dtype": dtype, "columns": columns, "offset": size})
+        size += len(df) * len(columns) * np.dtype(dtype).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+    for block in blocks:
+        _block_view(shm, block, len(df))[:] = df[block["columns"]].to_numpy(dtype=np.dtype(block["dtype"]))
+    shared = {column for block in blocks for column in block["columns"]}
+    others = {c: df[c].array for c in df.columns if c not in shared}
+    return {"shm": shm, "name": shm.name, "rows": len(df), "blocks": blocks, "others": others, "index": df.index, "columns": list(df.columns)}
+
+
+def _attach_frame(spec: Optional[Dict[str, Any]]):
+    if spec is None:
+        return None
+    import pandas as pd
+
+    # Workers share the parent's resource tracker; the parent alone unlinks the block.
+    shm = shared_memory.SharedMemory(name=spec["name"])
+    _worker.setdefault("shm", []).append(shm)
+    frames = []
+    for block in spec["blocks"]:
+        array = _block_view(shm, block, spec["rows"])
+        array.flags.writeable = False
+        frames.append(pd.DataFrame(array, columns=block["columns"], copy=False))
+    df = pd.concat(frames, axis=1) if len(frames) > 1 else frames[0] if frames else pd.DataFrame(index=range(spec["rows"]))
+    for column, values in spec["others"].items():
+        df[column] = values
+    df.index = spec["index"]
+    return df if list(df.columns) == spec["columns"] else df[spec["columns"]]
+
+
+def _init_worker(python_dir: str, threads: int, train_spec, valid_spec):
+    if python_dir not in sys.path:
+        sys.path.insert(0, python_dir)
+    from parallel_common import configure_parallelism
+
+    configure_parallelism(num_threads=threads)
+    _worker["train"] = _attach_frame(train_spec)
+    _worker["valid"] = _attach_frame(valid_spec)
+
+
+def _split_params(module, params: Dict[str, Any]):
+    create = inspect.signature(getattr(module, f"{module.__name__}_create")).parameters
+    fit = inspect.signature(getattr(module, f"{module.__name__}_fit")).parameters
+    unknown = sorted(set(params) - set(create) - set(fit))
+    if unknown:
+        raise ValueError(f"{module.__name__} takes no parameters {unknown}")
+    return {k: v for k, v in params.items() if k in create}, {k: v for k, v in params.items() if k in fit}
+
+
+def _score(module, model, frame, target: str) -> float:
+    name = module.__name__
+    if name == "torch_cla_mlp":
+        labels = module.torch_cla_mlp_predict(model, frame.drop(columns=[target]))
+        return float(np.mean(np.asarray(labels, dtype=object) != frame[target].to_numpy(dtype=object)))
+    if name == "torch_reg_mlp":
+        prediction = module.torch_reg_mlp_predict(model, frame, target_col=target)
+    else:
+        prediction = getattr(module, f"{name}_predict")(model, frame)
+    return float(np.mean((np.asarray(prediction, dtype=np.float64) - frame[target].to_numpy(dtype=np.float64)) ** 2))
+
+
+def _run_config(module_name: str, index: int, params: Dict[str, Any], base: Dict[str, Any], target: str, overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    start = time.perf_counter()
+    result: Dict[str, Any] = {"index": index, "params": params, "error": None, "pid": os.getpid()}
+    try:
+        module = importlib.import_module(module_name)
+        create_kwargs, fit_kwargs = _split_params(module, {**base, **params})
+        fit_kwargs.update(overrides or {})
+        fit_params = inspect.signature(getattr(module, f"{module_name}_fit")).parameters
+        for arg in TARGET_ARGS:
+            if arg in fit_params:
+                fit_kwargs.setdefault(arg, target)
+        model = getattr(module, f"{module_name}_create")(**create_kwargs)
+        getattr(module, f"{module_name}_fit")(model, _worker["train"], **fit_kwargs)
+        train_hist = list(getattr(model, "train_loss_hist", []))
+        val_hist = list(getattr(model, "val_loss_hist", []))
+        result.update(
+            {
+                "epochs_done": int(getattr(model, "epochs_done", len(train_hist))),
+                "train_loss": train_hist[-1] if train_hist else math.nan,
+                "val_loss": min(val_hist) if val_hist else math.nan,
+            }
+        )
+        if _worker["valid"] is not None:
+            result["score"] = _score(module, model, _worker["valid"], target)
+        else:
+            result["score"] = result["val_loss"] if val_hist else result["train_loss"]
+    except Exception as exc:  # one failing configuration must not stop the search
+        result["error"] = f"{type(exc).__name__}: {exc}"
+        result["score"] = math.nan
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _rank(result: Dict[str, Any]):
+    return (math.isnan(result["score"]), result["score"])
+
+
+@contextlib.contextmanager
+def _search_pool(n_tasks: int, df_train, df_valid, workers: Optional[int], threads_per_worker: Optional[int], start_method: str):
+    cpus = os.cpu_count() or 1
+    workers = max(1, min(int(workers or cpus), n_tasks or 1))
+    threads = max(1, int(threads_per_worker or cpus // workers))
+    python_dir = os.path.dirname(os.path.abspath(__file__))
+
+    train_spec = _share_frame(df_train)
+    valid_spec = _share_frame(df_valid)
+    specs = [s for s in (train_spec, valid_spec) if s is not None]
+    try:
+        initargs = tuple(None if s is None else {k: v for k, v in s.items() if k != "shm"} for s in (train_spec, valid_spec))
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context(start_method), initializer=_init_worker, initargs=(python_dir, threads) + initargs)
+        try:
+            yield pool, workers
+        finally:
+            # A consumer that stops early cancels the configurations not started yet.
+            pool.shutdown(wait=True, cancel_futures=True)
+    finally:
+        for spec in specs:
+            spec["shm"].close()
+            spec["shm"].unlink()
+
+
+def _check_module(module) -> str:
+    module = str(module)
+    if module not in SEARCH_MODULES:
+        raise ValueError(f"module must be one of {sorted(SEARCH_MODULES)}")
+    return module
+
+
+def _configs(configs) -> List[Dict[str, Any]]:
+    if isinstance(configs, dict):
+        configs = parameter_grid(configs)
+    return [dict(c) for c in configs]
+
+
+def torch_search_stream(
+    module: str,
+    configs,
+    df_train,
+    df_valid=None,
+    base: Optional[Dict[str, Any]] = None,
+    target: str = "t0",
+    workers: Optional[int] = None,
+    threads_per_worker: Optional[int] = None,
+    start_method: str = "spawn",
+) -> Iterator[Dict[str, Any]]:
+    """Train every configuration of ``module`` in a process pool, yielding results as they complete.
+
+    ``configs`` is a list of parameter dicts (see ``parameter_grid`` and
+    ``parameter_sample``) or a grid ``space`` dict. Each configuration is
+    merged over ``base`` and split between ``<module>_create`` and
+    ``<module>_fit`` by their signatures. A result holds the configuration,
+    its ``score`` (validation error on ``df_valid`` when given, else the best
+    validation loss, else the last training loss; lower is better), loss
+    summaries, wall time and any error message.
+    """
+    module = _check_module(module)
+    configs = _configs(configs)
+    with _search_pool(len(configs), df_train, df_valid, workers, threads_per_worker, start_method) as (pool, _):
+        futures = [pool.submit(_run_config, module, i, params, dict(base or {}), target) for i, params in enumerate(configs)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def torch_search_run(module, configs, df_train, df_valid=None, base=None, target="t0", workers=None, threads_per_worker=None, start_method="spawn"):
+    """Run ``torch_search_stream`` to completion and return the results sorted by score."""
+    results = list(torch_search_stream(module, configs, df_train, df_valid, base, target, workers, threads_per_worker, start_method))
+    return sorted(results, key=_rank)
+
+
+def asha_budgets(min_epochs: int, eta: int, max_epochs: int) -> List[int]:
+    """Epoch budget of each rung: ``min_epochs * eta**k`` below ``max_epochs``, then ``max_epochs``."""
+    min_epochs, eta, max_epochs = int(min_epochs), int(eta), int(max_epochs)
+    if min_epochs < 1 or max_epochs < min_epochs:
+        raise ValueError("ASHA requires 1 <= min_epochs <= max_epochs")
+    if eta < 2:
+        raise ValueError("ASHA requires eta >= 2")
+    budgets = []
+    budget = min_epochs
+    while budget < max_epochs:
+        budgets.append(budget)
+        budget *= eta
+    budgets.append(max_epochs)
+    return budgets
+
+
+def _promotion(rungs: List[Dict[int, Dict[str, Any]]], promoted: List[set], eta: int):
+    """The highest-rung configuration that ranks in the top ``1/eta`` of its rung and was not promoted yet."""
+    for rung in reversed(range(len(rungs) - 1)):
+        finished = sorted(rungs[rung].values(), key=_rank)
+        for result in finished[: len(finished) // eta]:
+            if result["index"] not in promoted[rung] and result["error"] is None and not result["stopped"]:
+                return result["index"], rung + 1
+    return None
+
+
+def torch_search_asha_stream(
+    module: str,
+    configs,
+    df_train,
+    df_valid=None,
+    base: Optional[Dict[str, Any]] = None,
+    target: str = "t0",
+    min_epochs: int = 1,
+    eta: int = 3,
+    max_epochs: Optional[int] = None,
+    workers: Optional[int] = None,
+    threads_per_worker: Optional[int] = None,
+    start_method: str = "spawn",
+) -> Iterator[Dict[str, Any]]:
+    """Asynchronous successive halving over the configurations of ``module``, yielding each rung result.
+
+    Rungs train to the epoch budgets of ``asha_budgets(min_epochs, eta,
+    max_epochs)``; ``max_epochs`` defaults to the epoch argument in ``base``.
+    Whenever a worker is free it continues the best unpromoted configuration
+    of the highest rung it qualifies for, or else starts a new configuration
+    at the first rung. Results are ranked by ``score`` as in
+    ``torch_search_stream`` (the best ``val_loss_hist`` entry unless
+    ``df_valid`` is given). A configuration its stop controller ended early is
+    ``stopped`` and is not promoted. Each result also carries its ``rung`` and
+    epoch ``budget``.
+    """
+    module = _check_module(module)
+    configs = _configs(configs)
+    base = dict(base or {})
+    epoch_arg = EPOCH_ARGS[module]
+    if "checkpoint" in base or any(epoch_arg in c or "checkpoint" in c for c in configs):
+        raise ValueError(f"ASHA sets '{epoch_arg}' and 'checkpoint' itself; use min_epochs/max_epochs instead")
+    if max_epochs is None:
+        if epoch_arg not in base:
+            raise ValueError(f"ASHA needs max_epochs or base['{epoch_arg}']")
+        max_epochs = base[epoch_arg]
+    base.pop(epoch_arg, None)
+    budgets = asha_budgets(min_epochs, eta, max_epochs)
+    eta = int(eta)
+
+    rungs: List[Dict[int, Dict[str, Any]]] = [{} for _ in budgets]
+    promoted: List[set] = [set() for _ in budgets]
+    started = 0
+    with tempfile.TemporaryDirectory(prefix="asha-") as directory, _search_pool(len(configs), df_train, df_valid, workers, threads_per_worker, start_method) as (pool, n_workers):
+        running = {}
+        while True:
+            while len(running) < n_workers:
+                job = _promotion(rungs, promoted, eta)
+                if job is not None:
+                    index, rung = job
+                    promoted[rung - 1].add(index)
+                elif started < len(configs):
+                    index, rung = started, 0
+                    started += 1
+                else:
+                    break
+                overrides = {epoch_arg: budgets[rung], "checkpoint": {"path": os.path.join(directory, f"config_{index}.pt"), "every": budgets[-1], "resume": True}}
+                future = pool.submit(_run_config, module, index, configs[index], base, target, overrides)
+                running[future] = (index, rung)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, rung = running.pop(future)
+                result = future.result()
+                result.update({"rung": rung, "budget": budgets[rung], "stopped": result.get("epochs_done", budgets[rung]) < budgets[rung]})
+                rungs[rung][index] = result
+                yield result
+
+
+def torch_search_asha_run(module, configs, df_train, df_valid=None, base=None, target="t0", min_epochs=1, eta=3, max_epochs=None, workers=None, threads_per_worker=None, start_method="spawn"):
+    """Run ``torch_search_asha_stream`` to completion; return each configuration's last result, best first.
+
+    Configurations that reached a higher rung rank ahead of those that did
+    not; within a rung, by score.
+    """
+    final: Dict[int, Dict[str, Any]] = {}
+    for result in torch_search_asha_stream(module, configs, df_train, df_valid, base, target, min_epochs, eta, max_epochs, workers, threads_per_worker, start_method):
+        final[result["index"]] = result
+    return sorted(final.values(), key=lambda r: (-r["rung"], _rank(r)))
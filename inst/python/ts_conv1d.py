@@ -7,15 +7,21 @@ specialized training behaviors selected through:
   - stopping_rule: "none" | "patience" | "sma" | "ema" | "h"
 """
 
+from __future__ import annotations
+
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
-from scipy.stats import ttest_ind
-from torch.utils.data import DataLoader, TensorDataset
+
+from ingest_common import column_array, feature_matrix
+from parallel_common import uses_model_threads, validate_num_threads
+from torch_common import ExportGraph, FitTelemetry, ForwardCompiler, LossAccumulator, RollingStopStats, StateSnapshot, TrainingCheckpoint, batch_iterator, batched_inference, checkpoint_options, export_model, input_tensor, load_model, partial_fit_args, profiling, save_model, serializable, validate_batch_engine, validate_loss_weighting
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 VALIDATION_STRATEGIES = {"static", "dynamic"}
@@ -34,6 +40,12 @@ class _TrainingConfig:
     ema_alpha: float = 0.2
     test_window: int = 30
     p_value: float = 0.05
+    batch_engine: str = "tensor"
+    loss_weighting: str = "batch"
+    lazy_best: bool = False
+    checkpoint: Optional[dict] = None
+    warm_start: bool = False
+    keep_training_state: bool = True
 
 
 def _as_int_list(values, default):
@@ -82,21 +94,25 @@ class TsConv1DNet(nn.Module):
 
         layers = []
         prev_channels = int(in_channels)
+        # Output length of each layer (no padding, unit dilation, pool stride = kernel).
+        length = int(sequence_length)
         for out_channels, kernel_size, stride in zip(conv_channels, kernel_sizes, strides):
             layers.append(nn.Conv1d(prev_channels, int(out_channels), kernel_size=int(kernel_size), stride=int(stride)))
             layers.append(_activation(activation))
+            length = (length - int(kernel_size)) // int(stride) + 1
             if str(pooling).lower() == "max":
                 layers.append(nn.MaxPool1d(kernel_size=int(pool_kernel_size)))
             elif str(pooling).lower() == "avg":
                 layers.append(nn.AvgPool1d(kernel_size=int(pool_kernel_size)))
             elif str(pooling).lower() != "none":
                 raise ValueError("pooling must be one of {'none', 'max', 'avg'}")
+            if str(pooling).lower() != "none":
+                length = (length - int(pool_kernel_size)) // int(pool_kernel_size) + 1
+            if length < 1:
+                raise ValueError("sequence_length is too short for the convolution and pooling layers.")
             prev_channels = int(out_channels)
         self.feature_extractor = nn.Sequential(*layers)
-        with torch.no_grad():
-            dummy = torch.rand(1, int(in_channels), int(sequence_length))
-            features = self.feature_extractor(dummy)
-            n_features = int(np.prod(features.shape[1:]))
+        n_features = prev_channels * length
         head = [nn.Flatten(1, -1)]
         prev_features = n_features
         for hidden_size in dense_hidden_sizes:
@@ -111,7 +127,7 @@ class TsConv1DNet(nn.Module):
 
 
 class _StopController:
-    def __init__(self, rule: str, min_delta: float, patience: int, sma_window: int, ema_alpha: float, test_window: int, p_value: float):
+    def __init__(self, rule: str, min_delta: float, patience: int, sma_window: int, ema_alpha: float, test_window: int, p_value: float, lazy_best: bool = False):
         self.rule = rule
         self.min_delta = float(min_delta)
         self.patience = int(patience)
@@ -124,12 +140,15 @@ class _StopController:
         self.patience_ctr = 0
         self.ema_value = None
         self.val_history: List[float] = []
+        self.lazy_best = bool(lazy_best)
+        self.snapshot = StateSnapshot()
+        self.stats = RollingStopStats(self.sma_window, self.test_window)
 
     def _clone_state(self, model: nn.Module):
-        return {k: v.detach().clone() for k, v in model.state_dict().items()}
+        return self.snapshot.capture(model.state_dict())
 
     def _sma(self) -> float:
-        return float(np.mean(self.val_history[-self.sma_window :]))
+        return self.stats.sma()
 
     def _ema(self, current: float) -> float:
         if self.ema_value is None:
@@ -139,20 +158,22 @@ class _StopController:
         return float(self.ema_value)
 
     def _h_improved(self) -> bool:
-        if len(self.val_history) < 2 * self.test_window:
-            if len(self.val_history) == 1:
-                return True
-            return self.val_history[-1] < min(self.val_history[:-1])
-        prev_window = self.val_history[-2 * self.test_window : -self.test_window]
-        recent_window = self.val_history[-self.test_window :]
-        _, p_value = ttest_ind(prev_window, recent_window, equal_var=False, alternative="greater")
+        p_value = self.stats.welch_p_value()
+        if p_value is None:
+            # Until both windows are full, improvement means a new minimum.
+            return self.stats.is_new_min
         return bool(p_value < self.p_value)
 
     def step(self, model: nn.Module, current: float) -> bool:
         self.val_history.append(float(current))
+        self.stats.push(current)
 
         if self.rule == "none":
-            self.best_state = self._clone_state(model)
+            if not self.lazy_best:
+                self.best_state = self._clone_state(model)
+            elif (self.best_value - float(current)) > self.min_delta:
+                self.best_value = float(current)
+                self.best_state = self._clone_state(model)
             return False
 
         if self.rule == "h":
@@ -182,6 +203,7 @@ class _StopController:
         return self.patience_ctr >= self.patience
 
 
+@serializable
 class TsConv1DModel:
     def __init__(
         self,
@@ -197,6 +219,9 @@ class TsConv1DModel:
         activation: str = "relu",
         validation_strategy: str = "static",
         stopping_rule: str = "none",
+        compile: bool = False,
+        precision: str = "fp32",
+        num_threads: Optional[int] = None,
     ):
         validation_strategy = str(validation_strategy).lower()
         stopping_rule = str(stopping_rule).lower()
@@ -207,6 +232,8 @@ class TsConv1DModel:
 
         self.validation_strategy = validation_strategy
         self.stopping_rule = stopping_rule
+        self.compiler = ForwardCompiler(compile, precision)
+        self.num_threads = validate_num_threads(num_threads)
         self.in_channels = int(in_channels)
         self.input_dim = int(input_dim)
         self.sequence_length = self._resolve_sequence_length(self.input_dim, self.in_channels, sequence_length)
@@ -224,6 +251,7 @@ class TsConv1DModel:
         self.train_loss_hist: List[float] = []
         self.val_loss_hist: List[float] = []
         self.epochs_done: int = 0
+        self.telemetry = FitTelemetry()
 
     @staticmethod
     def _device():
@@ -244,18 +272,18 @@ class TsConv1DModel:
     def _reshape_inputs(self, X: np.ndarray) -> torch.Tensor:
         if X.shape[1] != self.input_dim:
             raise ValueError(f"Expected {self.input_dim} input features, got {X.shape[1]}.")
-        return torch.from_numpy(X).reshape(X.shape[0], self.in_channels, self.sequence_length)
+        return input_tensor(X).reshape(X.shape[0], self.in_channels, self.sequence_length)
 
     def _prepare_xy(self, df: pd.DataFrame) -> Tuple[torch.Tensor, torch.Tensor]:
-        X = df.drop(columns=["t0"]).to_numpy().astype(np.float32)
-        y = df["t0"].to_numpy().astype(np.float32)
+        X = feature_matrix(df, exclude=["t0"])
+        y = column_array(df, "t0", np.float32)
         X = self._reshape_inputs(X)
-        y = torch.from_numpy(y).unsqueeze(-1)
+        y = input_tensor(y).unsqueeze(-1)
         return X, y
 
     @staticmethod
-    def _make_loader(X: torch.Tensor, y: torch.Tensor, batch_size: int, shuffle: bool) -> DataLoader:
-        return DataLoader(TensorDataset(X, y), batch_size=int(batch_size), shuffle=shuffle, drop_last=False)
+    def _make_loader(X: torch.Tensor, y: torch.Tensor, batch_size: int, shuffle: bool, batch_engine: str = "tensor", indices=None):
+        return batch_iterator((X, y), batch_size, shuffle, batch_engine=batch_engine, indices=indices)
 
     @staticmethod
     def _split_indices(n_samples: int, val_ratio: float) -> Tuple[np.ndarray, np.ndarray]:
@@ -270,30 +298,27 @@ class TsConv1DModel:
         idx = np.arange(n_samples)
         return idx[:-n_val], idx[-n_val:]
 
-    def _epoch(self, loader: DataLoader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module) -> float:
-        losses: List[float] = []
+    def _epoch(self, loader, optimizer: Optional[torch.optim.Optimizer], criterion: nn.Module, loss_weighting: str = "batch") -> float:
+        losses = LossAccumulator(loss_weighting)
         if optimizer is None:
             self.network.eval()
             with torch.no_grad():
                 for xb, yb in loader:
-                    xb = xb.float().to(self._device())
-                    yb = yb.float().to(self._device())
-                    losses.append(float(criterion(self.network(xb), yb).item()))
+                    losses.add(criterion(self.compiler(self.network)(xb), yb), xb.size(0))
         else:
             self.network.train()
             for xb, yb in loader:
-                xb = xb.float().to(self._device())
-                yb = yb.float().to(self._device())
                 optimizer.zero_grad()
-                loss = criterion(self.network(xb), yb)
+                loss = criterion(self.compiler(self.network)(xb), yb)
                 loss.backward()
                 optimizer.step()
-                losses.append(float(loss.item()))
-        return float(np.mean(losses)) if losses else 0.0
+                losses.add(loss, xb.size(0))
+        return losses.value()
 
     def fit(self, df_train: pd.DataFrame, config: _TrainingConfig):
 
         X_all, y_all = self._prepare_xy(df_train)
+        X_all, y_all = X_all.to(self._device()), y_all.to(self._device())
         criterion = nn.MSELoss()
         optimizer = torch.optim.Adam(self.network.parameters(), lr=float(config.lr))
         stopper = _StopController(
@@ -304,61 +329,76 @@ class TsConv1DModel:
             ema_alpha=config.ema_alpha,
             test_window=config.test_window,
             p_value=config.p_value,
+            lazy_best=config.lazy_best,
         )
 
-        self.train_loss_hist = []
-        self.val_loss_hist = []
-        self.epochs_done = 0
+        if not config.warm_start:
+            self.train_loss_hist = []
+            self.val_loss_hist = []
+            self.epochs_done = 0
+        self.telemetry = FitTelemetry(compiler=self.compiler)
+        checkpoint = TrainingCheckpoint(config.checkpoint, self, ("train_loss_hist", "val_loss_hist", "epochs_done"), {"network": self.network}, warm_start=config.warm_start, keep_state=config.keep_training_state)
+        checkpoint.begin()
 
         if self.validation_strategy == "static" and self.stopping_rule != "none":
             train_idx, val_idx = self._static_split_indices(X_all.shape[0], config.val_ratio)
-            X_train, y_train = X_all[train_idx], y_all[train_idx]
-            X_val, y_val = X_all[val_idx], y_all[val_idx]
-            train_loader = self._make_loader(X_train, y_train, config.batch_size, True)
-            val_loader = self._make_loader(X_val, y_val, config.batch_size, False)
+            train_loader = self._make_loader(X_all, y_all, config.batch_size, True, config.batch_engine, indices=train_idx)
+            val_loader = self._make_loader(X_all, y_all, config.batch_size, False, config.batch_engine, indices=val_idx)
         elif self.validation_strategy == "static":
-            train_loader = self._make_loader(X_all, y_all, config.batch_size, False)
+            train_loader = self._make_loader(X_all, y_all, config.batch_size, False, config.batch_engine)
             val_loader = None
         else:
             train_loader = None
             val_loader = None
 
-        for epoch in range(int(config.n_epochs)):
+        for epoch in checkpoint.epochs(int(config.n_epochs), {"optimizer": optimizer}, stopper):
+            self.telemetry.start_epoch()
             self.epochs_done += 1
 
             if self.validation_strategy == "dynamic":
                 train_idx, val_idx = self._split_indices(X_all.shape[0], config.val_ratio)
-                X_train, y_train = X_all[train_idx], y_all[train_idx]
-                X_val, y_val = X_all[val_idx], y_all[val_idx]
-                train_loader = self._make_loader(X_train, y_train, config.batch_size, True)
-                val_loader = self._make_loader(X_val, y_val, config.batch_size, False)
+                train_loader = self._make_loader(X_all, y_all, config.batch_size, True, config.batch_engine, indices=train_idx)
+                val_loader = self._make_loader(X_all, y_all, config.batch_size, False, config.batch_engine, indices=val_idx)
 
-            train_loss = self._epoch(train_loader, optimizer, criterion)
+            train_loss = self._epoch(self.telemetry.batches(train_loader), optimizer, criterion, config.loss_weighting)
             self.train_loss_hist.append(train_loss)
 
             if val_loader is not None:
-                val_loss = self._epoch(val_loader, None, criterion)
+                with self.telemetry.phase("validation"):
+                    val_loss = self._epoch(val_loader, None, criterion, config.loss_weighting)
                 self.val_loss_hist.append(val_loss)
-                if stopper.step(self.network, val_loss):
+                with self.telemetry.phase("snapshot"):
+                    stop = stopper.step(self.network, val_loss)
+                if stop:
                     break
 
+        self.telemetry.stop()
+        checkpoint.close()
         if stopper.best_state is not None:
             self.network.load_state_dict(stopper.best_state)
         return self
 
     def predict(self, df_test: pd.DataFrame, batch_size: int = 8):
-        X_test = df_test.drop(columns=["t0"], errors="ignore").to_numpy().astype(np.float32)
+        X_test = feature_matrix(df_test, exclude=["t0"])
         X_test = self._reshape_inputs(X_test)
-        loader = DataLoader(TensorDataset(X_test, torch.zeros(X_test.shape[0], 1)), batch_size=int(batch_size), shuffle=False, drop_last=False)
-        preds: List[torch.Tensor] = []
         self.network.eval()
-        with torch.no_grad():
-            for xb, _ in loader:
-                preds.append(self.network(xb.float().to(self._device())).detach().cpu())
-        return torch.vstack(preds).squeeze(-1).numpy()
+        network = self.compiler(self.network)
+        return batched_inference(lambda xb: network(xb).squeeze(-1), X_test, batch_size, self._device())
+
+    def _export_graphs(self):
+        return {"predict": ExportGraph(self.network, (self.in_channels, self.sequence_length), output="vector")}
+
 
+def ts_conv1d_create(in_channels, input_dim, sequence_length=None, conv_channels=None, kernel_sizes=None, strides=None, pooling="none", pool_kernel_size=2, dense_hidden_sizes=None, activation="relu", validation_strategy="static", stopping_rule="none", compile=False, precision="fp32", num_threads=None):
+    """Create a Conv1D forecaster over time series windows.
 
-def ts_conv1d_create(in_channels, input_dim, sequence_length=None, conv_channels=None, kernel_sizes=None, strides=None, pooling="none", pool_kernel_size=2, dense_hidden_sizes=None, activation="relu", validation_strategy="static", stopping_rule="none"):
+    ``compile=True`` runs the forwards through ``torch.compile`` and
+    ``precision="bf16"`` under bfloat16 autocast. The telemetry of every fit
+    then holds ``compile``: graphs built and the seconds spent compiling, in
+    compiled steps and in eager fallback, to judge whether compiling pays off;
+    ``model.compiler.report()`` has the same counters over the model's
+    lifetime, predictions included.
+    """
     return TsConv1DModel(
         int(in_channels),
         int(input_dim),
@@ -372,9 +412,13 @@ def ts_conv1d_create(in_channels, input_dim, sequence_length=None, conv_channels
         activation=activation,
         validation_strategy=validation_strategy,
         stopping_rule=stopping_rule,
+        compile=compile,
+        precision=precision,
+        num_threads=num_threads,
     )
 
 
+@uses_model_threads
 def ts_conv1d_fit(
     model,
     df_train,
@@ -390,6 +434,13 @@ def ts_conv1d_fit(
     ema_alpha=0.2,
     test_window=30,
     p_value=0.05,
+    batch_engine="tensor",
+    loss_weighting="batch",
+    lazy_best=False,
+    profile=None,
+    checkpoint=None,
+    warm_start=False,
+    keep_training_state=True,
 ):
     model.validation_strategy = str(validation_strategy).lower()
     model.stopping_rule = str(stopping_rule).lower()
@@ -404,9 +455,34 @@ def ts_conv1d_fit(
         ema_alpha=float(ema_alpha),
         test_window=int(test_window),
         p_value=float(p_value),
+        batch_engine=validate_batch_engine(batch_engine),
+        loss_weighting=validate_loss_weighting(loss_weighting),
+        lazy_best=bool(lazy_best),
+        checkpoint=checkpoint_options(checkpoint),
+        warm_start=bool(warm_start),
+        keep_training_state=bool(keep_training_state),
     )
-    return model.fit(df_train, config)
+    with profiling(profile, "ts_conv1d_fit", steps=True):
+        return model.fit(df_train, config)
+
+
+def ts_conv1d_partial_fit(model, df_train, n_epochs=1, **kwargs):
+    return ts_conv1d_fit(model, df_train, n_epochs=n_epochs, **partial_fit_args(model, kwargs))
+
+
+@uses_model_threads
+def ts_conv1d_predict(model, df_test, batch_size=8, profile=None):
+    with profiling(profile, "ts_conv1d_predict"):
+        return model.predict(df_test, batch_size=batch_size)
+
+
+def ts_conv1d_save(model, path, include_training_state=False):
+    return save_model(model, path, include_training_state=include_training_state)
+
+
+def ts_conv1d_load(path, mmap=True):
+    return load_model(path, TsConv1DModel, mmap=mmap)
 
 
-def ts_conv1d_predict(model, df_test, batch_size=8):
-    return model.predict(df_test, batch_size=batch_size)
+def ts_conv1d_export(model, path, formats=("torchscript", "onnx"), opset=17):
+    return export_model(model, path, formats=formats, opset=opset)